@@ -0,0 +1,211 @@
+########################################
+# pipeline benchmark
+#
+# for each data size: generate a synthetic sample (synth.py, cached by its
+# parameters), run src/main_ATAC.py on it with the stand-in tools of
+# bench/bin first on PATH, and read the per-step wall time, CPU time and
+# peak RSS back from the sample's timeline (steps/helpers.profile_step).
+# results go to a JSON file and are compared with a stored baseline; a step
+# that got slower than the tolerance (and by more than MIN_DELTA_S) is a
+# regression.
+#
+#   python bench/run.py --sizes 20000,200000                 # run + compare
+#   python bench/run.py --sizes 20000,200000 --save-baseline # new baseline
+#
+# multi-lane samples: merged FASTQs against lanes streamed into fastp
+# (options.stream_lanes), reported as "{pairs}x{lanes}" and
+# "{pairs}x{lanes}+streamed":
+#   python bench/run.py --sizes 2000000 --lanes 4 --steps trimming --compare-streamed
+########################################
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import argparse
+import platform
+import subprocess
+from typing import Dict, List
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+ROOT = os.path.dirname(HERE)
+sys.path.insert(0, HERE)
+
+import synth
+
+DEFAULT_SIZES = [20000, 100000]
+DEFAULT_STEPS = ["trimming", "align", "align_qc", "filter", "coverage", "macs3", "qc", "tsse", "tn5shift"]
+BASELINE = os.path.join(HERE, "baseline.json")
+TOLERANCE = 0.25
+# differences below this are timer noise
+MIN_DELTA_S = 0.5
+
+def _config(work: str, data: Dict[str, str], threads: int, options: Dict[str, object] = None) -> str:
+    """A config.yaml pointing every path into work/ and the references at the synthetic ones."""
+    out = os.path.join(work, "output")
+    paths = {
+        "RAW_input_dir": data["raw_dir"],
+        "Trimmed_dir": os.path.join(out, "temp_trimming"),
+        "aligned_dir": os.path.join(out, "temp_align"),
+        "Reads_quality_dir": os.path.join(out, "fastqc"),
+        "dedup_alignments_dir": os.path.join(out, "temp_align_dedup"),
+        "cleaned_alignments_dir": os.path.join(out, "clean_alignments"),
+        "macs3_dir": os.path.join(out, "macs3"),
+        "coverages_dir": os.path.join(out, "coverages"),
+        "other_qc_dir": os.path.join(out, "qc"),
+        "fastqc_untrimmed_dir": os.path.join(out, "qc", "fastqc_untrimmed"),
+        "fastqc_trimmed_dir": os.path.join(out, "qc", "fastqc_trimmed"),
+        "logs_dir": os.path.join(out, "logs"),
+        "reference_cache_dir": os.path.join(work, "reference_cache"),
+    }
+    references = {k: data[k] for k in ("bowtie2_index", "genome_fasta", "picard", "tss_bed")}
+    lines = ["paths:"] + [f"  {k}: {json.dumps(v)}" for k, v in paths.items()]
+    lines += ["references:"] + [f"  {k}: {json.dumps(v)}" for k, v in references.items()]
+    lines += ["options:", f"  threads: {threads}", f"  blacklist_bed: {json.dumps(data['blacklist_bed'])}"]
+    lines += [f"  {k}: {json.dumps(v)}" for k, v in (options or {}).items()]
+    path = os.path.join(work, "config.yaml")
+    with open(path, "w") as f:
+        f.write("\n".join(lines) + "\n")
+    return path
+
+def _dataset(data_dir: str, pairs: int, seed: int, lanes: int = 1) -> Dict[str, str]:
+    """The synthetic sample for (pairs, seed, lanes), generated once."""
+    target = os.path.join(data_dir, f"pairs{pairs}_seed{seed}" + (f"_lanes{lanes}" if lanes > 1 else ""))
+    params = os.path.join(target, "params.json")
+    if os.path.exists(params):
+        with open(params) as f:
+            return json.load(f)["paths"]
+    shutil.rmtree(target, ignore_errors=True)
+    return synth.generate(target, pairs=pairs, seed=seed, lanes=lanes)
+
+def _step_records(timeline: str) -> Dict[str, dict]:
+    steps = {}
+    with open(timeline) as f:
+        for line in f:
+            rec = json.loads(line)
+            if rec.get("kind") == "step":
+                steps[rec["label"]] = {
+                    "wall_s": rec["wall_s"],
+                    "cpu_s": round(rec["user_s"] + rec["sys_s"], 3),
+                    "max_rss_mb": round(rec["max_rss_kb"] / 1024, 1),
+                    "status": rec["status"],
+                }
+    return steps
+
+def run_size(pairs: int, *, steps: List[str], work_dir: str, seed: int, threads: int, repeat: int,
+             lanes: int = 1, options: Dict[str, object] = None, label: str = None) -> Dict[str, dict]:
+    """Per-step results for one data size (the fastest of `repeat` runs)."""
+    data = _dataset(os.path.join(work_dir, "data"), pairs, seed, lanes)
+    best: Dict[str, dict] = {}
+    for _ in range(repeat):
+        work = os.path.join(work_dir, f"run_{label or pairs}")
+        shutil.rmtree(work, ignore_errors=True)
+        os.makedirs(work)
+        config = _config(work, data, threads, options)
+        env = dict(os.environ, PATH=os.path.join(HERE, "bin") + os.pathsep + os.environ.get("PATH", ""))
+        cmd = [sys.executable, os.path.join(ROOT, "src", "main_ATAC.py"), "-i", data["sample"],
+               "--config", config, "--threads", str(threads), "--no-cache"]
+        for s in steps:
+            cmd += ["-s", s]
+        start = time.time()
+        with open(os.path.join(work, "run.log"), "w") as log:
+            rc = subprocess.call(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)
+        total = time.time() - start
+        if rc != 0:
+            raise RuntimeError(f"pipeline failed for {pairs} pairs (rc={rc}); see {os.path.join(work, 'run.log')}")
+
+        timeline = os.path.join(work, "output", "logs", data["sample"], f"{data['sample']}_timeline.jsonl")
+        results = _step_records(timeline)
+        results["total"] = {"wall_s": round(total, 3)}
+        for step, rec in results.items():
+            if step not in best or rec["wall_s"] < best[step]["wall_s"]:
+                best[step] = rec
+    return best
+
+def compare(results: dict, baseline: dict, tolerance: float) -> List[str]:
+    """Regressions of results against baseline, as printable lines."""
+    regressions = []
+    for size, steps in results["sizes"].items():
+        for step, rec in steps.items():
+            base = baseline.get("sizes", {}).get(size, {}).get(step)
+            if not base:
+                continue
+            delta = rec["wall_s"] - base["wall_s"]
+            ratio = rec["wall_s"] / base["wall_s"] if base["wall_s"] else float("inf")
+            if delta > MIN_DELTA_S and ratio > 1 + tolerance:
+                regressions.append(f"{size} pairs {step}: {base['wall_s']:.2f}s -> {rec['wall_s']:.2f}s ({ratio:.2f}x)")
+    return regressions
+
+def _print_table(results: dict, baseline: dict) -> None:
+    print(f"{'pairs':>16}  {'step':<12} {'wall_s':>8} {'base_s':>8} {'cpu_s':>8} {'rss_mb':>8}")
+    for size, steps in results["sizes"].items():
+        for step, rec in steps.items():
+            base = baseline.get("sizes", {}).get(size, {}).get(step, {}).get("wall_s")
+            base = f"{base:.2f}" if base is not None else "-"
+            print(f"{size:>16}  {step:<12} {rec['wall_s']:>8.2f} {base:>8} "
+                  f"{rec.get('cpu_s', '-'):>8} {rec.get('max_rss_mb', '-'):>8}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Time the pipeline on synthetic data with stand-in tools")
+    parser.add_argument("--sizes", default=",".join(map(str, DEFAULT_SIZES)), help="read pairs per run, comma-separated")
+    parser.add_argument("--steps", default=",".join(DEFAULT_STEPS))
+    parser.add_argument("--threads", type=int, default=4)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--lanes", type=int, default=1, help="lanes per synthetic sample")
+    parser.add_argument("--compare-streamed", action="store_true",
+                        help="also run each size with options.stream_lanes (multi-lane samples)")
+    parser.add_argument("--repeat", type=int, default=1, help="runs per size; the fastest counts")
+    parser.add_argument("--work-dir", default=os.path.join(ROOT, "bench_work"))
+    parser.add_argument("--out", default=None, help="results JSON (default: {work_dir}/results.json)")
+    parser.add_argument("--baseline", default=BASELINE)
+    parser.add_argument("--save-baseline", action="store_true", help="write the results as the new baseline")
+    parser.add_argument("--tolerance", type=float, default=TOLERANCE)
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s]
+    steps = [s for s in args.steps.split(",") if s]
+    results = {
+        "host": socket.gethostname(),
+        "python": platform.python_version(),
+        "threads": args.threads,
+        "seed": args.seed,
+        "lanes": args.lanes,
+        "steps": steps,
+        "sizes": {},
+    }
+    for pairs in sizes:
+        label = f"{pairs}x{args.lanes}" if args.lanes > 1 else str(pairs)
+        variants = [(label, None)]
+        if args.compare_streamed:
+            variants.append((label + "+streamed", {"stream_lanes": True}))
+        for name, options in variants:
+            print(f"[bench] {name} pairs ...", flush=True)
+            results["sizes"][name] = run_size(
+                pairs, steps=steps, work_dir=args.work_dir, seed=args.seed, threads=args.threads, repeat=args.repeat,
+                lanes=args.lanes, options=options, label=name,
+            )
+
+    out = args.out or os.path.join(args.work_dir, "results.json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    baseline = {}
+    if os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+    _print_table(results, baseline)
+
+    if args.save_baseline:
+        shutil.copyfile(out, args.baseline)
+        print(f"[bench] baseline written to {args.baseline}")
+        return 0
+    regressions = compare(results, baseline, args.tolerance)
+    for r in regressions:
+        print(f"[bench] REGRESSION {r}")
+    return 1 if regressions else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,255 @@
+#!/usr/bin/env python3
+########################################
+# stand-in executables for benchmarking the pipeline offline
+#
+# bench/bin/{bowtie2,fastp,samtools,java,macs3,bamCoverage,multiqc} link to
+# this file, which dispatches on the name it was called by. each accepts the
+# arguments the pipeline passes and writes the same kind of output, cheaply:
+#   - bowtie2: SAM from the true alignment in the synthetic read names (synth.py)
+#   - fastp: adapter and length trimming in Python, fastp-shaped JSON / HTML
+#   - samtools: the samtools bundled with pysam (real sort / index / view / cat)
+#   - java -jar picard.jar MarkDuplicates: collate | fixmate | sort | markdup
+#     with pysam's samtools, metrics in Picard's layout
+#   - macs3 callpeak: fragment pileup in bins, thresholded and merged
+#   - bamCoverage: the native pileup engine's raw track
+#   - multiqc: an index of the files it found
+# so a benchmark run times the pipeline's own orchestration and Python, not
+# the aligner.
+########################################
+
+import os
+import sys
+import io
+import gzip
+import json
+import shutil
+import stat
+import tempfile
+
+HERE = os.path.dirname(os.path.realpath(__file__))
+sys.path.insert(0, HERE)
+sys.path.insert(0, os.path.join(os.path.dirname(HERE), "src"))
+
+VERSION = "bench-standin"
+
+def _opt(argv, flag, default=None):
+    """Value after flag, or of flag=value."""
+    for i, a in enumerate(argv):
+        if a == flag and i + 1 < len(argv):
+            return argv[i + 1]
+        if a.startswith(flag + "="):
+            return a.split("=", 1)[1]
+    return default
+
+def bowtie2(argv):
+    import pysam
+    import synth
+
+    if "--version" in argv:
+        print(f"bowtie2 {VERSION}")
+        return 0
+    index = _opt(argv, "-x")
+    header = pysam.AlignmentHeader.from_dict(synth.sam_header(index + ".fa.fai"))
+    n = 0
+    with pysam.AlignmentFile("-", "w", header=header) as out:
+        for r1_path, r2_path in zip(_opt(argv, "-1").split(","), _opt(argv, "-2").split(",")):
+            with pysam.FastxFile(r1_path) as f1, pysam.FastxFile(r2_path) as f2:
+                for a, b in zip(f1, f2):
+                    for rec in synth.pair_records(header, a.name, a.sequence, b.sequence, a.quality, b.quality):
+                        out.write(rec)
+                    n += 1
+    sys.stderr.write(f"{n} reads; of these:\n  {n} (100.00%) were paired\n")
+    return 0
+
+def fastp(argv):
+    if "--version" in argv:
+        sys.stderr.write(f"fastp {VERSION}\n")
+        return 0
+    adapters = [_opt(argv, "--adapter_sequence", "AGATGTGTATAAGAGACAG"),
+                _opt(argv, "--adapter_sequence_r2", "AGATGTGTATAAGAGACAG")]
+    min_len = int(_opt(argv, "--length_required", 15))
+    probe = [a[:12] for a in adapters]
+    counts = {"before": [0, 0], "after": [0, 0]}
+
+    def records(f):
+        while True:
+            head = f.readline()
+            if not head:
+                return
+            seq, plus, qual = f.readline().rstrip("\n"), f.readline(), f.readline().rstrip("\n")
+            yield head, seq, plus, qual
+
+    if "--stdin" in argv:
+        # --stdin --interleaved_in: R1 and R2 records alternate on stdin
+        pairs = zip(*[iter(records(io.TextIOWrapper(sys.stdin.buffer)))] * 2)
+        i1 = i2 = None
+    else:
+        i1, i2 = gzip.open(_opt(argv, "-i"), "rt"), gzip.open(_opt(argv, "-I"), "rt")
+        pairs = zip(records(i1), records(i2))
+
+    with gzip.open(_opt(argv, "-o"), "wt", compresslevel=1) as o1, gzip.open(_opt(argv, "-O"), "wt", compresslevel=1) as o2:
+        for (h1, s1, p1, q1), (h2, s2, p2, q2) in pairs:
+            counts["before"][0] += 2
+            counts["before"][1] += len(s1) + len(s2)
+            cut1, cut2 = s1.find(probe[0]), s2.find(probe[1])
+            if cut1 >= 0:
+                s1, q1 = s1[:cut1], q1[:cut1]
+            if cut2 >= 0:
+                s2, q2 = s2[:cut2], q2[:cut2]
+            if len(s1) < min_len or len(s2) < min_len:
+                continue
+            counts["after"][0] += 2
+            counts["after"][1] += len(s1) + len(s2)
+            o1.write(f"{h1}{s1}\n{p1}{q1}\n")
+            o2.write(f"{h2}{s2}\n{p2}{q2}\n")
+    for f in (i1, i2):
+        if f is not None:
+            f.close()
+
+    summary = {
+        f"{k}_filtering": {"total_reads": reads, "total_bases": bases}
+        for k, (reads, bases) in counts.items()
+    }
+    with open(_opt(argv, "-j"), "w") as f:
+        json.dump({"summary": {"fastp_version": VERSION, **summary},
+                   "command": "fastp " + " ".join(argv)}, f, indent=1)
+    with open(_opt(argv, "-h"), "w") as f:
+        f.write(f"<html><body><pre>{json.dumps(summary, indent=1)}</pre></body></html>\n")
+    return 0
+
+def _samtools(args):
+    """Run pysam's samtools; output for "-" goes to the real stdout."""
+    import pysam
+
+    cmd, rest = args[0], list(args[1:])
+    func = getattr(pysam, cmd)
+    if stat.S_ISFIFO(os.fstat(1).st_mode):
+        func(*rest, save_stdout="/dev/stdout")
+        return
+    # regular file / terminal: never truncate what is already there
+    fd, tmp = tempfile.mkstemp()
+    os.close(fd)
+    try:
+        func(*rest, save_stdout=tmp)
+        with open(tmp, "rb") as f:
+            sys.stdout.flush()
+            shutil.copyfileobj(f, sys.stdout.buffer)
+    finally:
+        os.remove(tmp)
+
+def samtools(argv):
+    import pysam
+
+    if not argv or argv[0] in ("--version", "version"):
+        print(f"samtools {pysam.__samtools_version__} (pysam {pysam.__version__})")
+        return 0
+    _samtools(argv)
+    return 0
+
+def java(argv):
+    """java [opts] -jar picard.jar MarkDuplicates KEY=VALUE ..."""
+    import pysam
+    from steps import bamstats
+
+    tool_args = argv[argv.index("-jar") + 2:]
+    if "--version" in tool_args:
+        print(f"picard {VERSION}")
+        return 0
+    tool, opts = tool_args[0], dict(a.split("=", 1) for a in tool_args[1:] if "=" in a)
+    if tool != "MarkDuplicates":
+        sys.stderr.write(f"stand-in picard: unsupported tool {tool}\n")
+        return 2
+
+    work = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(opts["O"])))
+    try:
+        p = lambda name: os.path.join(work, name)
+        pysam.collate("-o", p("collated.bam"), opts["I"], p("collate"))
+        pysam.fixmate("-m", p("collated.bam"), p("fixmate.bam"))
+        pysam.sort("-o", p("sorted.bam"), "-T", p("sort"), p("fixmate.bam"))
+        remove = ["-r"] if opts.get("REMOVE_DUPLICATES", "false").lower() == "true" else []
+        pysam.markdup(*remove, "-s", "-f", p("stats.txt"), p("sorted.bam"), opts["O"])
+        bamstats.write_markdup_metrics(p("stats.txt"), opts["M"], library=os.path.basename(opts["I"]), input_path=opts["I"])
+        if opts.get("CREATE_INDEX", "false").lower() == "true":
+            pysam.index(opts["O"], opts["O"] + ".bai")
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+    return 0
+
+def macs3(argv):
+    """macs3 callpeak -f BAMPE -n NAME -t BAM --outdir DIR: bins with at least 5x the mean fragment coverage."""
+    import numpy as np
+    from steps import pileup
+
+    if "--version" in argv:
+        print(f"macs3 {VERSION}")
+        return 0
+    name, bam, out_dir = _opt(argv, "-n"), _opt(argv, "-t"), _opt(argv, "--outdir", ".")
+    bin_size = 50
+    sizes, chroms, _ = pileup.pileup_tracks(bam, ["raw"], bin_size=bin_size, min_mapq=0,
+                                            exclude_flags=1804, require_flags=2)
+    values = np.concatenate([v["raw"] for _, v in chroms]) if chroms else np.zeros(0)
+    cutoff = max(5 * values.mean(), 1.0) if len(values) else 1.0
+
+    peaks = []
+    for chrom, v in chroms:
+        high = np.concatenate([[False], v["raw"] >= cutoff, [False]])
+        edges = np.flatnonzero(high[1:] != high[:-1])
+        for lo, hi in zip(edges[::2], edges[1::2]):
+            summit = lo + int(np.argmax(v["raw"][lo:hi]))
+            peaks.append((chrom, lo * bin_size, min(hi * bin_size, sizes[chrom]), float(v["raw"][lo:hi].max()),
+                          (summit - lo) * bin_size + bin_size // 2))
+
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, f"{name}_peaks.narrowPeak"), "w") as np_out, \
+            open(os.path.join(out_dir, f"{name}_summits.bed"), "w") as summits:
+        for k, (chrom, start, end, height, summit) in enumerate(peaks, 1):
+            fold = height / cutoff * 5
+            np_out.write(f"{chrom}\t{start}\t{end}\t{name}_peak_{k}\t{int(min(1000, 10 * fold))}\t.\t"
+                         f"{fold:.5f}\t{fold:.5f}\t{fold:.5f}\t{summit}\n")
+            summits.write(f"{chrom}\t{start + summit}\t{start + summit + 1}\t{name}_peak_{k}\t{fold:.5f}\n")
+    with open(os.path.join(out_dir, f"{name}_peaks.xls"), "w") as xls:
+        xls.write(f"# This file is generated by MACS version {VERSION}\n")
+    return 0
+
+def bamCoverage(argv):
+    from steps import pileup
+
+    if "--version" in argv:
+        print(f"bamCoverage {VERSION}")
+        return 0
+    pileup.write_tracks(
+        _opt(argv, "-b"), {"raw": _opt(argv, "-o")},
+        bin_size=int(_opt(argv, "--binSize", 50)),
+        min_mapq=int(_opt(argv, "--minMappingQuality", 0)),
+        exclude_flags=int(_opt(argv, "--samFlagExclude", 0)),
+        require_flags=int(_opt(argv, "--samFlagInclude", 0)),
+        threads=int(_opt(argv, "-p", 1)),
+    )
+    return 0
+
+def multiqc(argv):
+    if "--version" in argv:
+        print(f"multiqc {VERSION}")
+        return 0
+    out_dir = _opt(argv, "-o", ".")
+    scan = [a for a in argv if not a.startswith("-") and a != out_dir]
+    found = []
+    for d in scan:
+        for root, _, files in os.walk(d):
+            found += [os.path.join(root, f) for f in files]
+    os.makedirs(out_dir, exist_ok=True)
+    with open(os.path.join(out_dir, "multiqc_report.html"), "w") as f:
+        f.write("<html><body><ul>\n" + "".join(f"<li>{p}</li>\n" for p in sorted(found)) + "</ul></body></html>\n")
+    return 0
+
+TOOLS = {f.__name__: f for f in (bowtie2, fastp, samtools, java, macs3, bamCoverage, multiqc)}
+
+def main():
+    name = os.path.basename(sys.argv[0])
+    if name not in TOOLS:
+        sys.stderr.write(f"stand-in tools: unknown name {name} (expected one of {sorted(TOOLS)})\n")
+        return 2
+    return TOOLS[name](sys.argv[1:])
+
+if __name__ == "__main__":
+    sys.exit(main())
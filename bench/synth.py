@@ -0,0 +1,336 @@
+########################################
+# synthetic paired-end ATAC-seq data
+#
+# a random genome (a few autosomes, chrX and chrM) with TSSs, peaks and a
+# blacklist, and FASTQ pairs drawn from it:
+#   - fragment lengths: a nucleosome-free component plus mono-, di- and
+#     tri-nucleosome components, with the ~10.4 bp helical periodicity
+#   - a chrM fraction, a share of fragments in peaks (mostly nucleosome-free,
+#     TSS peaks among them), PCR duplicates, low-MAPQ and unmapped pairs
+#   - adapter read-through for fragments shorter than the reads
+# each read name carries the pair's true alignment
+# ({sample}:{n}:{chrom}:{start}:{length}:{orientation}:{mapq}), which the
+# stand-in bowtie2 (standins.py) turns back into SAM records, so an
+# "alignment" costs no more than parsing the FASTQ. the aligned BAM can also
+# be written directly (--bam).
+#
+#   python bench/synth.py OUT_DIR --pairs 200000 --seed 1
+########################################
+
+import os
+import gzip
+import json
+import argparse
+from typing import Dict, Optional
+
+import numpy as np
+
+READ_LENGTH = 50
+# read-through adapter; the pipeline's default options.adapter_sequence
+ADAPTER = "AGATGTGTATAAGAGACAG"
+MAPQ = 42
+
+CHROM_SIZES = {
+    "chr1": 2_000_000,
+    "chr2": 1_500_000,
+    "chr3": 1_200_000,
+    "chrX": 800_000,
+    "chrM": 16_569,
+}
+
+# (weight, mean, sd) of the nucleosomal fragment length components
+NUCLEOSOMAL = [(0.55, 200, 25), (0.30, 390, 35), (0.15, 580, 45)]
+HELICAL_PERIOD = 10.4
+MIN_FRAGMENT, MAX_FRAGMENT = 20, 1000
+
+_COMPLEMENT = bytes.maketrans(b"ACGTN", b"TGCAN")
+
+def sample_name(pairs: int) -> str:
+    return f"BENCH{pairs}_ATAC"
+
+def read_name(sample: str, n: int, chrom: str, start: int, length: int, orientation: int, mapq: int) -> str:
+    return f"{sample}:{n}:{chrom}:{start}:{length}:{orientation}:{mapq}"
+
+def parse_name(name: str):
+    """(chrom, start, length, orientation, mapq) from a synthetic read name; chrom "*" is unmapped."""
+    _, _, chrom, start, length, orientation, mapq = name.split(" ")[0].rsplit(":", 6)
+    return chrom, int(start), int(length), int(orientation), int(mapq)
+
+def _fragment_lengths(rng, n: int, nfr_share: float) -> np.ndarray:
+    """Fragment lengths: nucleosome-free share from a gamma, the rest from NUCLEOSOMAL, with helical periodicity."""
+    out = np.empty(0, dtype=np.int64)
+    while len(out) < n:
+        m = 2 * (n - len(out)) + 16
+        nfr = rng.random(m) < nfr_share
+        comp = rng.choice(len(NUCLEOSOMAL), size=m, p=[w for w, _, _ in NUCLEOSOMAL])
+        means = np.array([mu for _, mu, _ in NUCLEOSOMAL])[comp]
+        sds = np.array([sd for _, _, sd in NUCLEOSOMAL])[comp]
+        lengths = np.where(nfr, rng.gamma(4.0, 16.0, m) + 25, rng.normal(means, sds))
+        lengths = np.rint(lengths).astype(np.int64)
+        # rejection sampling against the 10.4 bp modulation
+        keep = rng.random(m) < (1 + 0.3 * np.cos(2 * np.pi * lengths / HELICAL_PERIOD)) / 1.3
+        keep &= (lengths >= MIN_FRAGMENT) & (lengths <= MAX_FRAGMENT)
+        out = np.concatenate([out, lengths[keep]])
+    return out[:n]
+
+def _write_fasta(path: str, genome: Dict[str, bytes]) -> None:
+    """FASTA (60 columns) and its .fai."""
+    with open(path, "wb") as fa, open(path + ".fai", "w") as fai:
+        offset = 0
+        for chrom, seq in genome.items():
+            head = f">{chrom}\n".encode()
+            fa.write(head)
+            offset += len(head)
+            fai.write(f"{chrom}\t{len(seq)}\t{offset}\t60\t61\n")
+            for i in range(0, len(seq), 60):
+                fa.write(seq[i:i + 60] + b"\n")
+            offset += len(seq) + -(-len(seq) // 60)
+
+def _random_seq(rng, n: int) -> str:
+    return rng.choice(np.frombuffer(b"ACGT", dtype=np.uint8), size=n).tobytes().decode()
+
+def _read(genome: Dict[str, bytes], chrom: str, start: int, length: int, reverse: bool, read_length: int) -> str:
+    """A read of the fragment [start, start + length): from its left end, or its right end reverse-complemented."""
+    frag = genome[chrom][start:start + length]
+    if reverse:
+        frag = frag.translate(_COMPLEMENT)[::-1]
+    seq = frag[:read_length].decode()
+    if len(seq) < read_length:
+        seq = (seq + ADAPTER + "A" * read_length)[:read_length]
+    return seq
+
+def generate(
+    out_dir: str,
+    *,
+    pairs: int,
+    seed: int = 1,
+    sample: Optional[str] = None,
+    chrom_sizes: Optional[Dict[str, int]] = None,
+    chrm_fraction: float = 0.15,
+    peak_fraction: float = 0.35,
+    dup_fraction: float = 0.10,
+    low_mapq_fraction: float = 0.05,
+    unmapped_fraction: float = 0.02,
+    n_genes: int = 600,
+    lanes: int = 1,
+    read_length: int = READ_LENGTH,
+    bam: bool = False,
+) -> Dict[str, str]:
+    """
+    Write a synthetic sample under out_dir and return its paths:
+      reference/genome.fa (+ .fai, the stand-in bowtie2 index), tss.bed,
+      peaks.bed (truth), blacklist.bed, picard.jar (placeholder),
+      raw/{sample}/{sample}_L00{n}_R1/R2.fastq.gz, and with bam=True
+      aligned/{sample}_align.bam (+ .bai). The parameters go to params.json.
+    """
+    rng = np.random.default_rng(seed)
+    sample = sample or sample_name(pairs)
+    sizes = dict(chrom_sizes or CHROM_SIZES)
+    nuclear = [c for c in sizes if c != "chrM"]
+
+    ref_dir = os.path.join(out_dir, "reference")
+    raw_dir = os.path.join(out_dir, "raw", sample)
+    os.makedirs(ref_dir, exist_ok=True)
+    os.makedirs(raw_dir, exist_ok=True)
+    paths = {
+        "genome_fasta": os.path.join(ref_dir, "genome.fa"),
+        "bowtie2_index": os.path.join(ref_dir, "genome"),
+        "tss_bed": os.path.join(ref_dir, "tss.bed"),
+        "peaks_bed": os.path.join(ref_dir, "peaks.bed"),
+        "blacklist_bed": os.path.join(ref_dir, "blacklist.bed"),
+        "picard": os.path.join(ref_dir, "picard.jar"),
+        "raw_dir": os.path.dirname(raw_dir),
+        "sample": sample,
+    }
+
+    # genome and annotation
+    genome = {c: _random_seq(rng, n).encode() for c, n in sizes.items()}
+    _write_fasta(paths["genome_fasta"], genome)
+    open(paths["picard"], "w").close()
+
+    weights = np.array([sizes[c] for c in nuclear], dtype=np.float64)
+    weights /= weights.sum()
+    gene_chrom = rng.choice(len(nuclear), size=n_genes, p=weights)
+    gene_pos = np.array([rng.integers(5000, sizes[nuclear[i]] - 5000) for i in gene_chrom])
+    gene_strand = rng.choice(["+", "-"], size=n_genes)
+    order = np.lexsort((gene_pos, gene_chrom))
+    with open(paths["tss_bed"], "w") as f:
+        for k, i in enumerate(order):
+            f.write(f"{nuclear[gene_chrom[i]]}\t{gene_pos[i]}\t{gene_pos[i] + 1}\tgene{k}\t0\t{gene_strand[i]}\n")
+
+    # peaks: most TSSs, plus distal sites
+    tss_peaks = rng.random(n_genes) < 0.6
+    n_distal = n_genes // 2
+    distal_chrom = rng.choice(len(nuclear), size=n_distal, p=weights)
+    distal_pos = np.array([rng.integers(5000, sizes[nuclear[i]] - 5000) for i in distal_chrom])
+    peak_chrom = np.concatenate([gene_chrom[tss_peaks], distal_chrom])
+    peak_centre = np.concatenate([gene_pos[tss_peaks], distal_pos])
+    peak_width = rng.integers(200, 800, size=len(peak_centre))
+    peak_weight = rng.gamma(1.5, 1.0, size=len(peak_centre))
+    peak_weight /= peak_weight.sum()
+    order = np.lexsort((peak_centre, peak_chrom))
+    with open(paths["peaks_bed"], "w") as f:
+        for k, i in enumerate(order):
+            half = peak_width[i] // 2
+            f.write(f"{nuclear[peak_chrom[i]]}\t{peak_centre[i] - half}\t{peak_centre[i] + half}\tpeak{k}\n")
+
+    with open(paths["blacklist_bed"], "w") as f:
+        for c in nuclear[:3]:
+            start = int(rng.integers(10000, sizes[c] - 20000))
+            f.write(f"{c}\t{start}\t{start + 5000}\n")
+
+    # unique fragments, then duplicates of some of them
+    n_unique = max(1, int(round(pairs * (1 - dup_fraction))))
+    kind = rng.choice(3, size=n_unique, p=[chrm_fraction, peak_fraction, 1 - chrm_fraction - peak_fraction])
+    chroms = np.empty(n_unique, dtype=object)
+    starts = np.zeros(n_unique, dtype=np.int64)
+    lengths = np.zeros(n_unique, dtype=np.int64)
+
+    mito = kind == 0
+    lengths[mito] = _fragment_lengths(rng, int(mito.sum()), 0.5)
+    chroms[mito] = "chrM"
+    starts[mito] = rng.integers(0, sizes["chrM"] - lengths[mito])
+
+    in_peak = kind == 1
+    lengths[in_peak] = _fragment_lengths(rng, int(in_peak.sum()), 0.7)
+    pk = rng.choice(len(peak_centre), size=int(in_peak.sum()), p=peak_weight)
+    centre = np.rint(rng.normal(peak_centre[pk], peak_width[pk] / 4)).astype(np.int64)
+    chroms[in_peak] = [nuclear[i] for i in peak_chrom[pk]]
+    starts[in_peak] = centre - lengths[in_peak] // 2
+
+    background = kind == 2
+    lengths[background] = _fragment_lengths(rng, int(background.sum()), 0.25)
+    bg_chrom = rng.choice(len(nuclear), size=int(background.sum()), p=weights)
+    chroms[background] = [nuclear[i] for i in bg_chrom]
+    starts[background] = (rng.random(len(bg_chrom)) * np.array([sizes[nuclear[i]] for i in bg_chrom])).astype(np.int64)
+
+    limits = np.array([sizes[c] for c in chroms])
+    starts = np.clip(starts, 0, limits - lengths)
+
+    dups = rng.integers(0, n_unique, size=pairs - n_unique)
+    idx = rng.permutation(np.concatenate([np.arange(n_unique), dups]))
+    orientation = rng.integers(0, 2, size=pairs)
+    mapq = np.full(pairs, MAPQ)
+    low = rng.random(pairs) < low_mapq_fraction
+    mapq[low] = rng.choice([0, 1, 3, 12], size=int(low.sum()))
+    unmapped = rng.random(pairs) < unmapped_fraction
+
+    # FASTQs, lanes split evenly
+    quality = "I" * read_length
+    bounds = np.linspace(0, pairs, lanes + 1).astype(int)
+    for lane in range(lanes):
+        r1_path = os.path.join(raw_dir, f"{sample}_L{lane + 1:03d}_R1.fastq.gz")
+        r2_path = os.path.join(raw_dir, f"{sample}_L{lane + 1:03d}_R2.fastq.gz")
+        with gzip.open(r1_path, "wt", compresslevel=1) as r1, gzip.open(r2_path, "wt", compresslevel=1) as r2:
+            for n in range(bounds[lane], bounds[lane + 1]):
+                i = idx[n]
+                if unmapped[n]:
+                    name = read_name(sample, n, "*", 0, 0, 0, 0)
+                    s1, s2 = (_random_seq(rng, read_length) for _ in range(2))
+                else:
+                    c, s, L, o = chroms[i], int(starts[i]), int(lengths[i]), int(orientation[n])
+                    name = read_name(sample, n, c, s, L, o, int(mapq[n]))
+                    fwd = _read(genome, c, s, L, False, read_length)
+                    rev = _read(genome, c, s, L, True, read_length)
+                    s1, s2 = (fwd, rev) if o == 0 else (rev, fwd)
+                r1.write(f"@{name}/1\n{s1}\n+\n{quality}\n")
+                r2.write(f"@{name}/2\n{s2}\n+\n{quality}\n")
+        paths.setdefault("fastq", []).extend([r1_path, r2_path])
+
+    if bam:
+        paths["bam"] = write_aligned_bam(paths, os.path.join(out_dir, "aligned"))
+
+    params = dict(pairs=pairs, seed=seed, sample=sample, chrom_sizes=sizes, chrm_fraction=chrm_fraction,
+                  peak_fraction=peak_fraction, dup_fraction=dup_fraction, low_mapq_fraction=low_mapq_fraction,
+                  unmapped_fraction=unmapped_fraction, n_genes=n_genes, lanes=lanes, read_length=read_length)
+    with open(os.path.join(out_dir, "params.json"), "w") as f:
+        json.dump({"params": params, "paths": paths}, f, indent=2)
+    return paths
+
+def sam_header(fai: str) -> dict:
+    with open(fai) as f:
+        sq = [{"SN": line.split("\t")[0], "LN": int(line.split("\t")[1])} for line in f if line.strip()]
+    return {"HD": {"VN": "1.6", "SO": "unsorted"}, "SQ": sq}
+
+def pair_records(header, name: str, seq1: str, seq2: str, qual1: str, qual2: str):
+    """The two SAM records bowtie2 would write for a synthetic pair (adapter-trimmed or not)."""
+    import pysam
+
+    qname = name.split(" ")[0]
+    if qname.endswith(("/1", "/2")):
+        qname = qname[:-2]
+    chrom, start, length, orientation, mapq = parse_name(qname)
+    # orientation 0: R1 on the + strand at the fragment start, R2 on the - strand at its end
+    records = []
+    for is_first, seq, qual in ((True, seq1, qual1), (False, seq2, qual2)):
+        reverse = chrom != "*" and (orientation == 1) == is_first
+        if reverse:
+            # SAM holds the reference strand
+            seq, qual = seq.encode().translate(_COMPLEMENT)[::-1].decode(), qual[::-1]
+        r = pysam.AlignedSegment(header)
+        r.query_name = qname
+        r.query_sequence = seq
+        r.query_qualities = pysam.qualitystring_to_array(qual)
+        if chrom == "*":
+            r.flag = 77 if is_first else 141
+        else:
+            r.reference_id = header.get_tid(chrom)
+            r.reference_start = start + length - len(seq) if reverse else start
+            r.cigarstring = f"{len(seq)}M"
+            r.mapping_quality = mapq
+            r.flag = 1 | 2 | (64 if is_first else 128) | (16 if reverse else 32)
+        records.append(r)
+    r1, r2 = records
+    if chrom == "*":
+        return records
+
+    for r, mate in ((r1, r2), (r2, r1)):
+        r.next_reference_id = mate.reference_id
+        r.next_reference_start = mate.reference_start
+        left = min(r1.reference_start, r2.reference_start)
+        right = max(r1.reference_end, r2.reference_end)
+        r.template_length = (right - left) if not r.is_reverse else -(right - left)
+    return records
+
+def write_aligned_bam(paths: Dict[str, str], out_dir: str) -> str:
+    """What align_bowtie writes for the sample (coordinate-sorted + .bai), without trimming."""
+    import pysam
+
+    os.makedirs(out_dir, exist_ok=True)
+    sample = paths["sample"]
+    unsorted = os.path.join(out_dir, f"{sample}_unsorted.bam")
+    out = os.path.join(out_dir, f"{sample}_align.bam")
+    header = pysam.AlignmentHeader.from_dict(sam_header(paths["genome_fasta"] + ".fai"))
+    with pysam.AlignmentFile(unsorted, "wb", header=header) as bam:
+        fastqs = paths["fastq"]
+        for r1_path, r2_path in zip(fastqs[::2], fastqs[1::2]):
+            with pysam.FastxFile(r1_path) as f1, pysam.FastxFile(r2_path) as f2:
+                for a, b in zip(f1, f2):
+                    for rec in pair_records(header, a.name, a.sequence, b.sequence, a.quality, b.quality):
+                        bam.write(rec)
+    pysam.sort("-o", out, unsorted)
+    pysam.index(out)
+    os.remove(unsorted)
+    return out
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic paired-end ATAC-seq sample")
+    parser.add_argument("out_dir")
+    parser.add_argument("--pairs", type=int, default=100000)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--sample", default=None)
+    parser.add_argument("--lanes", type=int, default=1)
+    parser.add_argument("--chrm-fraction", type=float, default=0.15)
+    parser.add_argument("--peak-fraction", type=float, default=0.35)
+    parser.add_argument("--dup-fraction", type=float, default=0.10)
+    parser.add_argument("--bam", action="store_true", help="also write the aligned, sorted BAM")
+    args = parser.parse_args()
+    paths = generate(
+        args.out_dir, pairs=args.pairs, seed=args.seed, sample=args.sample, lanes=args.lanes,
+        chrm_fraction=args.chrm_fraction, peak_fraction=args.peak_fraction,
+        dup_fraction=args.dup_fraction, bam=args.bam,
+    )
+    print(json.dumps(paths, indent=2))
+
+if __name__ == "__main__":
+    main()
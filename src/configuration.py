@@ -35,20 +35,53 @@ class Config:
         self.fastqc_untrimmed_dir = os.path.join(repo_root, "data", "output", "qc", "fastqc_untrimmed")
         self.fastqc_trimmed_dir = os.path.join(repo_root, "data", "output", "qc", "fastqc_trimmed")
         self.logs_dir = os.path.join(repo_root, "data", "logs")
+        self.reference_cache_dir = os.path.join(repo_root, "data", "reference_cache")
+        self.preview_dir = None    # --preview output tree; None: "preview" under the common output root
+        self.consensus_dir = None  # consensus_peaks outputs; None: {macs3_dir}/consensus
 
         # References (left None by default; must be provided by config for real runs)
         self.bowtie2_index = None
         self.genome_fasta = None
         self.picard = None
+        self.tss_bed = None        # TSS sites BED for FRiP(TSS); qc.py has a site default
 
         # Options
         self.force = False
-        self.threads = 8
+        self.threads = 8           # "auto": every core of the allocation (resources.py)
         self.blacklist_bed = None
         self.atacseqqc_dir = None
+        self.frip_mode = "read"    # "read" or "fragment"
+        self.frip_regions = {}     # extra FRiP region sets: {name: bed_path}
+        self.min_mapq = 30
+        self.coverage_engine = "bamcoverage"  # "bamcoverage" or "native" (steps/pileup.py)
+        self.markdup_engine = "picard"  # "picard" or "native" (steps/markdup.py, no JVM)
+        self.qc_gates = None            # true (built-in rules) or {gate: [rules], cheap_skip: [...]} (steps/gates.py)
+        self.consensus_mode = "summit"  # "summit" (fixed-width, iterative overlap removal) or "union" (steps/consensus.py)
+        self.consensus_width = 500      # summit mode window, bp
+        self.consensus_min_samples = 1  # keep consensus peaks found in at least this many samples
+        self.coverage_tracks = ["raw", "cpm", "cutsites", "nfr"]  # native engine tracks
+        self.coverage_bin_size = 50
+        self.effective_genome_size = None  # RPGC track; None uses the summed contig lengths
+        self.shifted_outputs = []  # extra outputs of the Tn5 shift step: "bed" and / or "fragments"
+        self.streaming_alignment = False  # align -> markdup -> filter in one stream, no intermediate BAMs
+        self.fragments_input = False      # qc / tsse / native coverage read {sample}_fragments.tsv.gz, not the BAM
+        self.adapter_sequence = "AGATGTGTATAAGAGACAG"
+        self.adapter_sequence_r2 = "AGATGTGTATAAGAGACAG"
+        self.stream_lanes = False  # feed multi-lane samples to fastp's stdin instead of writing _merged_R1/R2 FASTQs
+        self.pipeline_timeout = None    # seconds before an external tool pipeline is stopped; None: no limit
+        self.step_cache = True          # skip steps whose manifest is current
+        self.cache_hash_inputs = False  # fingerprint inputs by sha256 instead of size/mtime
+        self.trust_existing = False     # adopt outputs that predate the step cache
+        self.reference_cache = True     # serve TSS windows / blacklist / region sets from reference_cache_dir
 
         # Runtime
         self.file_to_process = None
+        self.preview = None              # --preview: {"fraction", "pairs", "seed"} (steps/preview.py)
+        self.preview_source_dir = None   # the real RAW_input_dir in preview mode
+        # a task's grant, set by the scheduler (resources.apply)
+        self.mem_gb = None
+        self.java_heap_gb = 8
+        self.sort_mem = "768M"
         self.analysis_type = None
         self.input_background = None
 
@@ -96,11 +129,44 @@ class Config:
         # options
         opts = cfg.get("options", {}) or {}
         if "threads" in opts and opts["threads"] is not None:
-            self.threads = int(opts["threads"])
+            self.threads = "auto" if str(opts["threads"]) == "auto" else int(opts["threads"])
         if "blacklist_bed" in opts:
             self.blacklist_bed = _resolve(opts["blacklist_bed"])
         if "atacseqqc_dir" in opts:
             self.atacseqqc_dir = _resolve(opts["atacseqqc_dir"])
+        if "frip_mode" in opts and opts["frip_mode"] is not None:
+            self.frip_mode = str(opts["frip_mode"])
+        if "frip_regions" in opts:
+            self.frip_regions = {k: _resolve(v) for k, v in (opts["frip_regions"] or {}).items()}
+        if "coverage_engine" in opts and opts["coverage_engine"] is not None:
+            self.coverage_engine = str(opts["coverage_engine"])
+        if "markdup_engine" in opts and opts["markdup_engine"] is not None:
+            self.markdup_engine = str(opts["markdup_engine"])
+        if "qc_gates" in opts:
+            self.qc_gates = opts["qc_gates"] or None
+        if "consensus_mode" in opts and opts["consensus_mode"] is not None:
+            self.consensus_mode = str(opts["consensus_mode"])
+        for k in ("consensus_width", "consensus_min_samples"):
+            if k in opts and opts[k] is not None:
+                setattr(self, k, int(opts[k]))
+        if "coverage_tracks" in opts and opts["coverage_tracks"]:
+            self.coverage_tracks = [str(v) for v in opts["coverage_tracks"]]
+        for k in ("coverage_bin_size", "effective_genome_size"):
+            if k in opts and opts[k] is not None:
+                setattr(self, k, int(opts[k]))
+        if "shifted_outputs" in opts:
+            self.shifted_outputs = [str(v) for v in (opts["shifted_outputs"] or [])]
+        if opts.get("pipeline_timeout") is not None:
+            self.pipeline_timeout = float(opts["pipeline_timeout"])
+        if "min_mapq" in opts and opts["min_mapq"] is not None:
+            self.min_mapq = int(opts["min_mapq"])
+        for k in ("adapter_sequence", "adapter_sequence_r2"):
+            if opts.get(k):
+                setattr(self, k, str(opts[k]))
+        for k in ("step_cache", "cache_hash_inputs", "streaming_alignment", "stream_lanes", "reference_cache",
+                  "fragments_input"):
+            if k in opts and opts[k] is not None:
+                setattr(self, k, bool(opts[k]))
 
     def _init_logging(self):
         handler = logging.StreamHandler()
@@ -16,7 +16,10 @@ import os
 import glob
 import argparse
 import logging
-from steps import fastqc, trimming, align, coverage, macs3, qc, ATACseqQC, multiqc
+import pipeline
+import resources
+from scheduler import SUCCEEDED, Scheduler
+from stepcache import probe_tools, run_cached
 
 
 if __name__=="__main__":
@@ -28,8 +31,26 @@ if __name__=="__main__":
     parser.add_argument("-s",'--steps', dest='step', action='append', required=False,
                         help='chose steps instead of running everything')
     parser.add_argument("--force", action="store_true", help="Overwrite outputs if they already exist")
+    parser.add_argument("--no-cache", action="store_true",
+                        help="Ignore step manifests; only check that outputs exist (previous behaviour)")
+    parser.add_argument("--trust-existing", action="store_true",
+                        help="Record manifests for existing outputs that have none instead of recomputing them")
     parser.add_argument("--config", default=None, help="Path to YAML config file")
-    parser.add_argument("--threads", type=int, default=None, help="Override threads in config")
+    parser.add_argument("--threads", default=None,
+                        help="Override threads in config (a number, or auto: every core of the allocation)")
+    parser.add_argument("--samples", default=None,
+                        help="Sample sheet (one sample per line): run the whole cohort with the scheduler")
+    parser.add_argument("--all-samples", action="store_true",
+                        help="Run every sample in RAW_input_dir with the scheduler")
+    parser.add_argument("--max-cores", type=int, default=None,
+                        help="Scheduler core budget shared by all tasks (default: cores allocated to this job)")
+    parser.add_argument("--max-mem", type=float, default=None,
+                        help="Scheduler memory budget in GB (default: memory allocated to this job)")
+    parser.add_argument("--preview", default=None,
+                        help="Fast preview on a subsample: a fraction of read pairs (0.05) or a number of pairs (2000000); "
+                             "outputs go under paths.preview_dir")
+    parser.add_argument("--preview-seed", type=int, default=0,
+                        help="Seed of the --preview fraction subsample")
 
     # parse arguments
     args = parser.parse_args()
@@ -38,13 +59,48 @@ if __name__=="__main__":
     Configuration = Config(config_path=args.config)
     Configuration.force = bool(args.force)
     Configuration.analysis_type = "ATAC"
+    if args.no_cache:
+        Configuration.step_cache = False
+    Configuration.trust_existing = bool(args.trust_existing)
 
     # CLI threads overrides config
     if args.threads is not None:
-        Configuration.threads = int(args.threads)
+        Configuration.threads = args.threads if args.threads == "auto" else int(args.threads)
+
+    # what this job may use (SLURM / cgroup / affinity / RAM); threads never exceed it
+    allocation = resources.detect()
+    Configuration.threads = resources.resolve_threads(Configuration, allocation)
+    max_mem_gb = args.max_mem or allocation.mem_gb
+    logging.info(f"[resources] {allocation}; {Configuration.threads} threads per step")
+
+    # preview mode: every output (and the subsampled FASTQs) under preview_dir
+    if args.preview:
+        from steps.preview import apply_preview
+        apply_preview(Configuration, args.preview, seed=args.preview_seed)
+
+    # cohort mode: (sample, step) task graph under one core / memory budget
+    if args.samples or args.all_samples:
+        samples = pipeline.read_sample_sheet(args.samples) if args.samples else pipeline.discover_samples(Configuration)
+        if not samples:
+            logging.error("There were no samples to process")
+            raise Exception
+        for s in samples:
+            os.makedirs(os.path.join(Configuration.cleaned_alignments_dir, s), exist_ok=True)
+
+        steps = pipeline.select_steps(args.step, Configuration)
+        probe_tools(steps, Configuration)
+        tasks = pipeline.build_tasks(samples, steps, Configuration)
+        states = Scheduler(
+            tasks,
+            Configuration,
+            max_cores=args.max_cores or allocation.cores,
+            max_mem_gb=max_mem_gb,
+            runner=run_cached,
+        ).run()
+        raise SystemExit(0 if all(s in SUCCEEDED for s in states.values()) else 1)
 
     if args.infile == None:
-        all_raws_present = [os.path.basename(x) for x in glob.glob(Configuration.RAW_input_dir + "/*ATAC")]
+        all_raws_present = [os.path.basename(x) for x in glob.glob((Configuration.preview_source_dir or Configuration.RAW_input_dir) + "/*ATAC")]
 
         all_processed = [os.path.basename(x) for x in glob.glob(Configuration.cleaned_alignments_dir + "/*ATAC")]
         # chose the first one of the ones that are still not processed and run 
@@ -64,56 +120,18 @@ if __name__=="__main__":
     
     logging.info(f"This script will run the file : {Configuration.file_to_process}")
 
-    if args.step == None:
-            
-
-        # call trimming
-        trimming.run_fastp(Configuration)
-
-        # run bowtie2 alignment
-        align.align_bowtie(Configuration)
-
-        # run QC and dedup
-        align.dedup_QC_alignments(Configuration)
-	
-        # run filter on alignment
-        align.filter_alignments(Configuration)
-	
-        # run coverage
-        coverage.coverage(Configuration)
-
-        # run macs3
-        macs3.run_macs3_ATAC(Configuration)
-
-        # qc
-        qc.run_qc(Configuration)
-        
-        # ATACseqQC
-        ATACseqQC.run_ATACseqQC(Configuration)
-
-        # multiqc
-        multiqc.run_multiqc(Configuration)
-
-    else:
-        if "fastqc_before_trimming" in args.step:
-            fastqc.qc_before_trimming(Configuration)
-        if "trimming" in args.step:
-            trimming.run_fastp(Configuration)
-        if "fastqc_after_trimming" in args.step:
-            fastqc.qc_after_trimming(Configuration)
-        if "align" in args.step:
-            align.align_bowtie(Configuration)
-        if "align_qc" in args.step:
-            align.dedup_QC_alignments(Configuration)
-        if "filter" in args.step:
-            align.filter_alignments(Configuration)
-        if "coverage" in args.step:
-            coverage.coverage(Configuration)
-        if "macs3" in args.step:
-            macs3.run_macs3_ATAC(Configuration)
-        if "qc" in args.step:
-            qc.run_qc(Configuration)
-        if "ATACseqQC" in args.step:
-            ATACseqQC.run_ATACseqQC(Configuration)
-        if "multiqc" in args.step:
-            multiqc.run_multiqc(Configuration)
+    # independent steps (coverage, macs3, qc, ATACseqQC after filter) run
+    # concurrently and share Configuration.threads; the first failure
+    # cancels the others
+    steps = pipeline.select_steps(args.step, Configuration)
+    probe_tools(steps, Configuration)
+    tasks = pipeline.build_tasks([Configuration.file_to_process], steps, Configuration)
+    states = Scheduler(
+        tasks,
+        Configuration,
+        max_cores=Configuration.threads,
+        max_mem_gb=max_mem_gb,
+        runner=run_cached,
+    ).run()
+    if not all(s in SUCCEEDED for s in states.values()):
+        raise SystemExit(1)
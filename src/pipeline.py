@@ -0,0 +1,414 @@
+########################################
+# step table and task graph construction
+#
+# every pipeline step is described once here (function, resources, scope)
+# so main_ATAC.py and the scheduler build their run order from the same table.
+# step modules are named, not imported: a module (and pandas / pysam /
+# matplotlib behind it) is only loaded in the task that runs its step
+########################################
+
+import os
+import glob
+import logging
+import importlib
+from typing import Dict, List, Optional
+
+from scheduler import Task
+
+# path templates, formatted with the Configuration attributes and {sample}
+RAW_DIR = "{RAW_input_dir}/{sample}"
+TRIMMED_R1 = "{Trimmed_dir}/{sample}/{sample}_trimmed_R1.fastq.gz"
+TRIMMED_R2 = "{Trimmed_dir}/{sample}/{sample}_trimmed_R2.fastq.gz"
+FASTP_JSON = "{Reads_quality_dir}/{sample}/{sample}.fastp.json"
+FASTP_HTML = "{Reads_quality_dir}/{sample}/{sample}.fastp.html"
+ALIGNED_BAM = "{aligned_dir}/{sample}/{sample}_align.bam"
+DEDUP_BAM = "{dedup_alignments_dir}/{sample}/{sample}_align_dedup.bam"
+MARKDUP_METRICS = "{other_qc_dir}/{sample}/{sample}_markdup_qc.txt"
+ALIGN_METRICS = "{other_qc_dir}/{sample}/{sample}_alignment_metrics_qc.txt"
+IDXSTATS = "{other_qc_dir}/{sample}/{sample}_idxstats.txt"
+FRAGLEN = "{other_qc_dir}/{sample}/{sample}_fragment_length_count.txt"
+FRAGLEN_NPY = "{other_qc_dir}/{sample}/{sample}_fragment_lengths.npy"
+FILTERED_BAM = "{cleaned_alignments_dir}/{sample}/{sample}_align_dedup_filtered.bam"
+FRAGMENTS = "{cleaned_alignments_dir}/{sample}/{sample}_fragments.tsv.gz"
+COVERAGE_BW = "{coverages_dir}/{sample}/{sample}_coverage.bw"
+NARROWPEAK = "{macs3_dir}/{sample}/{sample}_peaks.narrowPeak"
+QC_METRICS = "{other_qc_dir}/{sample}/{sample}_qc_metrics.tsv"
+COMPLEXITY_CURVE = "{other_qc_dir}/{sample}/{sample}_complexity_curve.tsv"
+
+def _module(name: str):
+    """steps.<name>, imported on first use."""
+    return importlib.import_module(f"steps.{name}")
+
+def _filter_params(Configuration) -> dict:
+    align = _module("align")
+    return {
+        "min_mapq": Configuration.min_mapq,
+        "exclude_contigs": list(align.FILTER_EXCLUDE_CONTIGS),
+        "exclude_flags": align.FILTER_EXCLUDE_FLAGS,
+        "require_flags": align.FILTER_REQUIRE_FLAGS,
+    }
+
+def _align_qc_outputs(Configuration, sample):
+    outputs = [DEDUP_BAM, DEDUP_BAM + ".bai", MARKDUP_METRICS, ALIGN_METRICS, IDXSTATS, FRAGLEN, FRAGLEN_NPY]
+    if Configuration.markdup_engine == "native":
+        outputs.append(COMPLEXITY_CURVE)
+    return Step._resolve(outputs, Configuration, sample)
+
+def _atacseqqc_outputs(Configuration, sample):
+    out_dir = _module("ATACseqQC").get_output_dir(Configuration, sample)
+    return [
+        os.path.join(out_dir, f"{sample}_shifted.bam"),
+        os.path.join(out_dir, f"{sample}_TSSEscore.txt"),
+    ]
+
+def _coverage_outputs(Configuration, sample):
+    return list(_module("coverage").track_paths(Configuration, sample).values())
+
+def _fragments_inputs(Configuration, sample):
+    # the aligned BAM gives the duplicate counts (absent when streaming)
+    extra = [] if Configuration.streaming_alignment else [ALIGNED_BAM]
+    return Step._resolve([FILTERED_BAM] + extra, Configuration, sample)
+
+def _reads_inputs(Configuration, sample):
+    """The filtered BAM, and with options.fragments_input the fragments file read in its place."""
+    return Step._resolve([FILTERED_BAM] + ([FRAGMENTS] if Configuration.fragments_input else []),
+                         Configuration, sample)
+
+def _coverage_inputs(Configuration, sample):
+    if Configuration.coverage_engine != "native":
+        return Step._resolve([FILTERED_BAM], Configuration, sample)
+    return _reads_inputs(Configuration, sample)
+
+def _coverage_params(Configuration) -> dict:
+    if Configuration.coverage_engine != "native":
+        return {"engine": Configuration.coverage_engine}
+    return {
+        "engine": Configuration.coverage_engine,
+        "fragments_input": Configuration.fragments_input,
+        "tracks": list(Configuration.coverage_tracks),
+        "bin_size": Configuration.coverage_bin_size,
+        "min_mapq": Configuration.min_mapq,
+        "effective_genome_size": Configuration.effective_genome_size,
+    }
+
+def _tn5shift_outputs(Configuration, sample):
+    out_dir = _module("ATACseqQC").get_output_dir(Configuration, sample)
+    extra = getattr(Configuration, "shifted_outputs", None) or []
+    return list(_module("tn5shift").output_paths(out_dir, sample, extra).values())
+
+def _qc_inputs(Configuration, sample):
+    gates = _module("gates")
+    return (_reads_inputs(Configuration, sample)
+            + Step._resolve([NARROWPEAK, IDXSTATS, MARKDUP_METRICS, FRAGLEN_NPY], Configuration, sample)
+            + [gates.record_path(Configuration, sample, g) for g in gates.rules(Configuration)])
+
+def _gate_step(gate, *, inputs):
+    return Step(f"gate_{gate}", f"gates:gate_{gate}",
+                inputs=inputs, outputs=lambda c, s: [_module("gates").record_path(c, s, gate)],
+                threads=1, mem_gb=0.5, default=False, gate=gate, tools=["pysam"] if gate == "align" else [],
+                params=lambda c: {"rules": _module("gates").rules(c).get(gate, [])})
+
+def _tsse_outputs(Configuration, sample):
+    out_dir = _module("ATACseqQC").get_output_dir(Configuration, sample)
+    return list(_module("tsse").output_paths(out_dir, sample).values())
+
+def _preview_source(Configuration, sample):
+    return [os.path.join(Configuration.preview_source_dir, sample)]
+
+def _preview_sampling(Configuration, sample):
+    return Step._resolve([_module("preview").SAMPLING_JSON], Configuration, sample)
+
+def _preview_report_inputs(Configuration, sample):
+    return (_preview_sampling(Configuration, sample)
+            + Step._resolve([QC_METRICS, MARKDUP_METRICS, FRAGLEN_NPY], Configuration, sample)
+            + _tsse_outputs(Configuration, sample)[:1])
+
+def _preview_report_outputs(Configuration, sample):
+    return Step._resolve([_module("preview").PREVIEW_REPORT], Configuration, sample)
+
+class Step:
+    """
+    One pipeline step.
+
+    - func: "module:function" in steps/ (imported when the step first runs),
+      or a callable
+    - inputs / outputs: files the step reads / writes, as path templates
+      (or callables (Configuration, sample) -> list of paths). Within a
+      sample, a step depends on every earlier selected step that produces
+      one of its inputs; steps with no link between them run concurrently.
+    - threads: "multi" for tools that scale with Configuration.threads,
+      or 1 for (mostly) single-threaded ones (MACS3, R, MultiQC)
+    - mem_gb: rough peak memory, used against the scheduler's memory budget
+    - mem_per_input_gb: extra memory per GB of input files, for steps whose
+      peak grows with the library (resources.step_memory)
+    - scope: "sample" (one task per sample), "cohort" (one task per run,
+      after every sample has finished) or "reference" (one task per run,
+      before any sample step starts)
+    - exclusive: tasks sharing this group never run at the same time
+      (e.g. steps that rewrite cohort-level files)
+    - default: part of a run without --steps
+    - gate: name of the QC gate this step evaluates (steps/gates.py). Every
+      later step of the sample waits for it, and the scheduler applies its
+      decision (halt / cheap mode) when it finishes
+    - params / references / tools: what the step cache (stepcache.py) keys
+      on besides the inputs: a callable Configuration -> dict of parameter
+      values, Configuration attributes naming reference files, and the
+      tools whose versions matter
+    """
+
+    def __init__(self, name, func, *, inputs=(), outputs=(), threads="multi", mem_gb=2,
+                 mem_per_input_gb=0.0, scope="sample", exclusive=None, default=True, params=None, references=(), tools=(),
+                 gate=None):
+        self.name = name
+        self._func = func
+        self.inputs = inputs
+        self.outputs = outputs
+        self.params = params
+        self.references = list(references)
+        self.tools = list(tools)
+        self.threads = threads
+        self.mem_gb = mem_gb
+        self.mem_per_input_gb = mem_per_input_gb
+        self.scope = scope
+        self.exclusive = exclusive
+        self.default = default
+        self.gate = gate
+
+    def __repr__(self):
+        return f"Step({self.name})"
+
+    @property
+    def func(self):
+        if isinstance(self._func, str):
+            module, attr = self._func.split(":")
+            self._func = getattr(_module(module), attr)
+        return self._func
+
+    @staticmethod
+    def _resolve(spec, Configuration, sample) -> List[str]:
+        if callable(spec):
+            return list(spec(Configuration, sample))
+        values = dict(vars(Configuration), sample=sample)
+        return [os.path.normpath(t.format_map(values)) for t in spec]
+
+    def input_paths(self, Configuration, sample) -> List[str]:
+        return self._resolve(self.inputs, Configuration, sample)
+
+    def output_paths(self, Configuration, sample) -> List[str]:
+        return self._resolve(self.outputs, Configuration, sample)
+
+    def param_values(self, Configuration) -> dict:
+        return self.params(Configuration) if self.params else {}
+
+    def decision(self, Configuration, sample):
+        """(status, steps to skip; None: all) of a gate step that has run."""
+        return _module("gates").decision(Configuration, sample, self.gate)
+
+# in pipeline order
+STEPS = [
+    Step("prepare_references", "refcache:prepare_references",
+         threads=1, mem_gb=2, scope="reference"),
+    # --preview only (see select_steps): subsampled raw FASTQs in the preview tree
+    Step("preview_subsample", "preview:subsample",
+         inputs=_preview_source, outputs=[RAW_DIR],
+         threads=1, mem_gb=1, default=False,
+         params=lambda c: dict(c.preview or {})),
+    Step("fastqc_before_trimming", "fastqc:qc_before_trimming",
+         inputs=[RAW_DIR], outputs=["{fastqc_untrimmed_dir}/{sample}"],
+         mem_gb=2, default=False, tools=["fastqc"]),
+    Step("trimming", "trimming:run_fastp",
+         inputs=[RAW_DIR], outputs=[TRIMMED_R1, TRIMMED_R2, FASTP_JSON, FASTP_HTML],
+         mem_gb=4, tools=["fastp"],
+         params=lambda c: {
+             "adapter_sequence": c.adapter_sequence,
+             "adapter_sequence_r2": c.adapter_sequence_r2,
+             "length_required": _module("trimming").LENGTH_REQUIRED,
+         }),
+    # options.qc_gates only (see select_steps)
+    _gate_step("trimming", inputs=[FASTP_JSON]),
+    Step("fastqc_after_trimming", "fastqc:qc_after_trimming",
+         inputs=[TRIMMED_R1, TRIMMED_R2], outputs=["{fastqc_trimmed_dir}/{sample}"],
+         mem_gb=2, default=False, tools=["fastqc"]),
+    Step("align", "align:align_bowtie",
+         inputs=[TRIMMED_R1, TRIMMED_R2], outputs=[ALIGNED_BAM, ALIGNED_BAM + ".bai"],
+         mem_gb=8, references=["bowtie2_index"], tools=["bowtie2", "samtools"],
+         params=lambda c: {"bowtie2_args": _module("align").BOWTIE2_ARGS}),
+    _gate_step("align", inputs=[ALIGNED_BAM, ALIGNED_BAM + ".bai"]),
+    Step("align_qc", "align:dedup_QC_alignments",
+         inputs=[ALIGNED_BAM], outputs=_align_qc_outputs,
+         mem_gb=4, mem_per_input_gb=1.0, references=["picard"], tools=["picard", "pysam"],
+         params=lambda c: {"markdup_engine": c.markdup_engine}),
+    # options.streaming_alignment: replaces align, align_qc and filter (see select_steps)
+    Step("align_stream", "align:align_stream_filtered",
+         inputs=[TRIMMED_R1, TRIMMED_R2],
+         outputs=[FILTERED_BAM, FILTERED_BAM + ".bai", MARKDUP_METRICS, ALIGN_METRICS, IDXSTATS, FRAGLEN, FRAGLEN_NPY],
+         mem_gb=12, default=False, references=["bowtie2_index", "blacklist_bed"],
+         tools=["bowtie2", "samtools", "pysam"],
+         params=lambda c: dict(_filter_params(c), bowtie2_args=_module("align").BOWTIE2_ARGS)),
+    _gate_step("dedup", inputs=[MARKDUP_METRICS, IDXSTATS]),
+    Step("filter", "align:filter_alignments",
+         inputs=[DEDUP_BAM], outputs=[FILTERED_BAM, FILTERED_BAM + ".bai"],
+         mem_gb=2, references=["blacklist_bed"], tools=["pysam", "samtools"],
+         params=_filter_params),
+    Step("fragments", "fragments:run_fragments",
+         inputs=_fragments_inputs, outputs=[FRAGMENTS, FRAGMENTS + ".tbi"],
+         mem_gb=2, references=["blacklist_bed"], tools=["pysam"], default=False,
+         params=lambda c: dict(_filter_params(c), duplicate_counts=not c.streaming_alignment)),
+    Step("coverage", "coverage:coverage",
+         inputs=_coverage_inputs, outputs=_coverage_outputs,
+         mem_gb=4, tools=["bamCoverage", "pysam"], params=_coverage_params),
+    Step("macs3", "macs3:run_macs3_ATAC",
+         inputs=[FILTERED_BAM], outputs=[NARROWPEAK],
+         threads=1, mem_gb=2, mem_per_input_gb=0.5, tools=["macs3"]),
+    Step("qc", "qc:run_qc",
+         inputs=_qc_inputs, outputs=[QC_METRICS],
+         threads=1, mem_gb=4, references=["tss_bed"], tools=["pysam"],
+         params=lambda c: {"frip_mode": c.frip_mode, "frip_regions": c.frip_regions,
+                           "fragments_input": c.fragments_input}),
+    Step("tsse", "tsse:run_tsse",
+         inputs=_reads_inputs, outputs=_tsse_outputs,
+         mem_gb=4, references=["tss_bed"], tools=["pysam"],
+         params=lambda c: {"fragments_input": c.fragments_input}),
+    Step("tn5shift", "tn5shift:run_tn5shift",
+         inputs=[FILTERED_BAM], outputs=_tn5shift_outputs,
+         mem_gb=2, tools=["samtools", "pysam"],
+         params=lambda c: {"shifted_outputs": sorted(c.shifted_outputs)}),
+    Step("ATACseqQC", "ATACseqQC:run_ATACseqQC",
+         inputs=[FILTERED_BAM], outputs=_atacseqqc_outputs,
+         threads=1, mem_gb=8, mem_per_input_gb=6.0, default=False, tools=["Rscript"]),
+    Step("preview_report", "preview:preview_report",
+         inputs=_preview_report_inputs, outputs=_preview_report_outputs,
+         threads=1, mem_gb=1, default=False),
+    Step("qc_report", "qcstore:qc_report",
+         threads=1, mem_gb=2, scope="cohort"),
+    Step("consensus_peaks", "consensus:run_consensus",
+         threads="multi", mem_gb=4, scope="cohort", default=False),
+    Step("multiqc", "multiqc:run_multiqc",
+         threads=1, mem_gb=4, scope="cohort"),
+    Step("profile_report", "profiling:profile_report",
+         threads=1, mem_gb=2, scope="cohort", default=False),
+]
+
+STEPS_BY_NAME = {s.name: s for s in STEPS}
+
+# the steps align_stream stands in for when options.streaming_alignment is set
+FUSED_STEPS = ("align", "align_qc", "filter")
+
+# native steps writing the same files as the R ATACseqQC step; selecting
+# ATACseqQC drops them
+ATACSEQQC_REPLACED = ("tsse", "tn5shift")
+
+# steps that read the fragments file instead of the BAM with options.fragments_input
+# (coverage: the native engine only)
+FRAGMENTS_READERS = ("qc", "tsse", "coverage")
+
+# QC gate -> the steps whose outputs it checks (any of them brings the gate in)
+GATED_STEPS = {
+    "trimming": ("trimming",),
+    "align": ("align",),
+    "dedup": ("align_qc", "align_stream"),
+}
+
+def select_steps(names: Optional[List[str]], Configuration=None) -> List[Step]:
+    """
+    Steps to run, in pipeline order: the defaults, or exactly `names`.
+    With options.streaming_alignment, any of align / align_qc / filter
+    selects align_stream instead. In preview mode (--preview) trimming
+    brings preview_subsample with it, and preview_report is added. With
+    options.qc_gates, each configured gate comes with the step it checks,
+    and with options.fragments_input the steps reading the fragments file
+    bring the fragments step. The R ATACseqQC step writes the native
+    ATACSEQQC_REPLACED steps' files, so selecting it drops them.
+    """
+    if not names:
+        names = [s.name for s in STEPS if s.default]
+    else:
+        unknown = [n for n in names if n not in STEPS_BY_NAME]
+        if unknown:
+            raise ValueError(f"Unknown step(s): {unknown}. Known steps: {list(STEPS_BY_NAME)}")
+
+    if "ATACseqQC" in names and any(n in ATACSEQQC_REPLACED for n in names):
+        logging.warning(f"ATACseqQC writes the outputs of {list(ATACSEQQC_REPLACED)}; not running those")
+        names = [n for n in names if n not in ATACSEQQC_REPLACED]
+    if getattr(Configuration, "streaming_alignment", False) and any(n in FUSED_STEPS for n in names):
+        names = [n for n in names if n not in FUSED_STEPS] + ["align_stream"]
+    if getattr(Configuration, "preview", None):
+        names = list(names) + ["preview_report"] + (["preview_subsample"] if "trimming" in names else [])
+    if getattr(Configuration, "qc_gates", None):
+        names = list(names) + [f"gate_{g}" for g in _module("gates").rules(Configuration)
+                               if any(n in names for n in GATED_STEPS[g])]
+    if getattr(Configuration, "fragments_input", False) and any(
+            n in FRAGMENTS_READERS and (n != "coverage" or Configuration.coverage_engine == "native") for n in names):
+        names = list(names) + ["fragments"]
+    return [s for s in STEPS if s.name in names]
+
+def read_sample_sheet(path: str) -> List[str]:
+    """One sample per line; blank lines and '#' comments are ignored."""
+    samples = []
+    with open(path) as f:
+        for line in f:
+            line = line.split("#", 1)[0].strip()
+            if line:
+                samples.append(line.split()[0])
+    if not samples:
+        raise ValueError(f"No samples found in sample sheet: {path}")
+    return samples
+
+def discover_samples(Configuration) -> List[str]:
+    """All sample directories under RAW_input_dir (same *ATAC pattern as single-sample mode)."""
+    raw_dir = Configuration.preview_source_dir or Configuration.RAW_input_dir
+    return sorted(os.path.basename(x) for x in glob.glob(os.path.join(raw_dir, "*ATAC")))
+
+def build_tasks(samples: List[str], steps: List[Step], Configuration) -> Dict[tuple, Task]:
+    """
+    Task graph of (sample, step) nodes.
+
+    Within a sample, edges come from the steps' declared inputs and outputs,
+    and every step after a QC gate waits for the gate; reference-scope steps
+    run first, cohort-scope steps run once every sample has finished
+    (successfully or not).
+    """
+    tasks: Dict[tuple, Task] = {}
+    reference_steps = [s for s in steps if s.scope == "reference"]
+    sample_steps = [s for s in steps if s.scope == "sample"]
+    cohort_steps = [s for s in steps if s.scope == "cohort"]
+
+    reference_tasks = []
+    for j, step in enumerate(reference_steps):
+        task = Task(None, step, priority=(-1, j))
+        tasks[task.key] = task
+        reference_tasks.append(task.key)
+
+    all_sample_tasks = []
+    for i, sample in enumerate(samples):
+        produced = {}   # output path -> task key of the step writing it
+        gate = None     # the sample's latest QC gate task
+        for j, step in enumerate(sample_steps):
+            deps = {produced[p] for p in step.input_paths(Configuration, sample) if p in produced}
+            deps.update(reference_tasks)
+            if gate:
+                deps.add(gate)
+            task = Task(sample, step, deps=deps, priority=(i, j))
+            tasks[task.key] = task
+            all_sample_tasks.append(task.key)
+            if step.gate:
+                gate = task.key
+            for p in step.output_paths(Configuration, sample):
+                if p in produced:
+                    raise ValueError(
+                        f"Steps {produced[p][1]} and {step.name} both write {p}; select only one of them"
+                    )
+                produced[p] = task.key
+
+    prev = None
+    for j, step in enumerate(cohort_steps):
+        deps = list(all_sample_tasks) + ([prev] if prev else [])
+        task = Task(None, step, deps=deps, priority=(len(samples), j), soft_deps=True)
+        tasks[task.key] = task
+        prev = task.key
+
+    for t in tasks.values():
+        if t.sample is not None:
+            logging.debug(f"task {t.label} <- {sorted(d[1] for d in t.deps)}")
+    logging.info(f"task graph: {len(tasks)} tasks for {len(samples)} sample(s), steps: {[s.name for s in steps]}")
+    return tasks
@@ -0,0 +1,157 @@
+########################################
+# resource planner
+#
+# works out what this job may use (SLURM allocation, cgroup limits, CPU
+# affinity, physical memory) and, per task, how many threads and how much
+# memory a step gets from its declared base, its input size and the free
+# budget. the grant is handed to the step through its Configuration copy:
+# threads, mem_gb, java_heap_gb (Picard -Xmx) and sort_mem (samtools sort
+# -m, per thread).
+########################################
+
+import os
+import logging
+from typing import List, Optional
+
+# leave this much of the allocation to the pipeline itself / page cache
+MEM_RESERVE_GB = 1.0
+# JVM heap as a share of the step's grant (the rest is metaspace, GC, buffers)
+JAVA_HEAP_SHARE = 0.8
+# share of the step's grant that samtools sort buffers may take
+SORT_MEM_SHARE = 0.5
+SORT_MEM_MIN_MB = 256
+SORT_MEM_MAX_MB = 4096
+
+class Allocation:
+    """Cores and memory (GB) this job may use, with where each limit came from."""
+
+    def __init__(self, cores: int, mem_gb: Optional[float], sources: List[str]):
+        self.cores = cores
+        self.mem_gb = mem_gb
+        self.sources = sources
+
+    def __repr__(self):
+        mem = f"{self.mem_gb:.1f}G" if self.mem_gb is not None else "unknown memory"
+        return f"Allocation({self.cores} cores, {mem}; {', '.join(self.sources)})"
+
+def _read(path: str) -> Optional[str]:
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except OSError:
+        return None
+
+def _cgroup_dirs() -> List[str]:
+    """This process's cgroup directories (v2 unified and v1 cpu / memory)."""
+    dirs = []
+    text = _read("/proc/self/cgroup") or ""
+    for line in text.splitlines():
+        parts = line.split(":", 2)
+        if len(parts) != 3:
+            continue
+        _, controllers, rel = parts
+        if controllers == "":
+            dirs.append(os.path.join("/sys/fs/cgroup", rel.lstrip("/")))
+        for c in controllers.split(","):
+            if c in ("memory", "cpu"):
+                dirs.append(os.path.join("/sys/fs/cgroup", c, rel.lstrip("/")))
+    dirs.append("/sys/fs/cgroup")
+    return dirs
+
+def _cgroup_cpus() -> Optional[float]:
+    for d in _cgroup_dirs():
+        v2 = _read(os.path.join(d, "cpu.max"))
+        if v2:
+            quota, _, period = v2.partition(" ")
+            if quota != "max" and period:
+                return int(quota) / int(period)
+            continue
+        quota, period = _read(os.path.join(d, "cpu.cfs_quota_us")), _read(os.path.join(d, "cpu.cfs_period_us"))
+        if quota and period and int(quota) > 0:
+            return int(quota) / int(period)
+    return None
+
+def _cgroup_mem_gb() -> Optional[float]:
+    for d in _cgroup_dirs():
+        for name in ("memory.max", "memory.limit_in_bytes"):
+            v = _read(os.path.join(d, name))
+            # v1 reports "no limit" as a huge number
+            if v and v != "max" and int(v) < (1 << 60):
+                return int(v) / 1024 ** 3
+    return None
+
+def _physical_mem_gb() -> Optional[float]:
+    for line in (_read("/proc/meminfo") or "").splitlines():
+        if line.startswith("MemTotal:"):
+            return int(line.split()[1]) / 1024 ** 2
+    return None
+
+def detect() -> Allocation:
+    """The smallest of every limit that applies to this job."""
+    from scheduler import available_cores
+
+    cores = [(available_cores(), "affinity")]
+    if os.environ.get("SLURM_CPUS_PER_TASK"):
+        cores.append((int(os.environ["SLURM_CPUS_PER_TASK"]), "SLURM_CPUS_PER_TASK"))
+    cg = _cgroup_cpus()
+    if cg:
+        cores.append((max(1, int(cg)), "cgroup cpu"))
+
+    mem = []
+    if os.environ.get("SLURM_MEM_PER_NODE"):
+        mem.append((int(os.environ["SLURM_MEM_PER_NODE"]) / 1024, "SLURM_MEM_PER_NODE"))
+    elif os.environ.get("SLURM_MEM_PER_CPU"):
+        n = int(os.environ.get("SLURM_CPUS_PER_TASK") or 1)
+        mem.append((int(os.environ["SLURM_MEM_PER_CPU"]) * n / 1024, "SLURM_MEM_PER_CPU"))
+    cg_mem = _cgroup_mem_gb()
+    if cg_mem:
+        mem.append((cg_mem, "cgroup memory"))
+    phys = _physical_mem_gb()
+    if phys:
+        mem.append((phys, "MemTotal"))
+
+    n_cores, core_src = min(cores)
+    if mem:
+        mem_gb, mem_src = min(mem)
+        mem_gb = max(1.0, mem_gb - MEM_RESERVE_GB)
+    else:
+        mem_gb, mem_src = None, "no memory limit found"
+    return Allocation(n_cores, mem_gb, [f"cores from {core_src}", f"memory from {mem_src}"])
+
+def input_gb(paths: List[str]) -> float:
+    """Total size of the existing files among paths (directories: their files)."""
+    total = 0
+    for p in paths:
+        if os.path.isdir(p):
+            for root, _, files in os.walk(p):
+                total += sum(os.path.getsize(os.path.join(root, f)) for f in files)
+        elif os.path.exists(p):
+            total += os.path.getsize(p)
+    return total / 1024 ** 3
+
+def step_memory(step, size_gb: float, max_mem_gb: Optional[float]) -> float:
+    """A step's memory: its base plus mem_per_input_gb per GB of input, capped by the budget."""
+    mem = step.mem_gb + step.mem_per_input_gb * size_gb
+    if max_mem_gb is not None:
+        mem = min(mem, max_mem_gb)
+    return round(max(mem, 0.5), 1)
+
+def apply(Configuration, *, threads: int, mem_gb: float) -> None:
+    """Set the task's grant on its Configuration copy."""
+    threads = max(1, int(threads))
+    Configuration.threads = threads
+    Configuration.mem_gb = mem_gb
+    Configuration.java_heap_gb = max(1, int(mem_gb * JAVA_HEAP_SHARE))
+    sort_mb = int(mem_gb * SORT_MEM_SHARE * 1024 / threads)
+    Configuration.sort_mem = f"{min(SORT_MEM_MAX_MB, max(SORT_MEM_MIN_MB, sort_mb))}M"
+
+def resolve_threads(Configuration, allocation: Allocation) -> int:
+    """options.threads ("auto" = every allocated core), never more than the allocation."""
+    requested = Configuration.threads
+    if requested in (None, "auto", 0):
+        threads = allocation.cores
+    else:
+        threads = min(int(requested), allocation.cores)
+        if threads < int(requested):
+            logging.info(f"[resources] threads {requested} -> {threads} (allocation has {allocation.cores} cores)")
+    return threads
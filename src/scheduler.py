@@ -0,0 +1,288 @@
+########################################
+# DAG scheduler with a shared core / memory budget
+#
+# each (sample, step) task runs in its own process (and process group, so
+# the tools it starts can be stopped with it). ready tasks are packed into
+# the free cores: single-threaded steps take one core each and the rest is
+# split between the ready multi-threaded steps (up to Configuration.threads
+# each). a task's memory is its step's base plus a share of its input size
+# (resources.py), worked out once its inputs exist; the grant (threads,
+# memory, JVM heap, sort buffers) is set on the task's Configuration copy.
+# when a step fails, its sample's running steps are cancelled. when a QC
+# gate step finishes, its decision may halt the rest of the sample or skip
+# its expensive steps (steps/gates.py).
+########################################
+
+import os
+import copy
+import time
+import signal
+import logging
+import multiprocessing as mp
+from multiprocessing.connection import wait
+from typing import Dict, Optional
+
+import resources
+from steps.helpers import profile_step
+
+# a multi-threaded step is only started with fewer cores than it asked for
+# when at least this many are free (or nothing else is running)
+MIN_MULTI_CORES = 2
+
+FINISHED = ("done", "failed", "cancelled", "skipped", "halted")
+# end states that count as success (halted: stopped by a QC gate)
+SUCCEEDED = ("done", "halted")
+
+def available_cores() -> int:
+    """Cores this process may run on (respects SLURM / taskset CPU binding)."""
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return os.cpu_count() or 1
+
+class Task:
+    """One (sample, step) node of the task graph. sample is None for cohort steps."""
+
+    def __init__(self, sample, step, *, deps=(), priority=(0, 0), soft_deps=False):
+        self.sample = sample
+        self.step = step
+        self.deps = set(deps)
+        # soft deps only need to have finished, not succeeded (cohort steps
+        # still run over the samples that did complete)
+        self.soft_deps = soft_deps
+        self.priority = priority
+        self.state = "pending"     # pending -> running -> done | failed | cancelled | skipped | halted
+        self.cpus = 0
+        self.mem_gb = None         # set when the task first becomes ready
+        self.proc = None
+        self.started = None
+
+    @property
+    def key(self) -> tuple:
+        return (self.sample, self.step.name)
+
+    @property
+    def label(self) -> str:
+        return f"{self.sample or self.step.scope}/{self.step.name}"
+
+def _call_step(step, Configuration) -> None:
+    step.func(Configuration)
+
+def _run_task(runner, step, Configuration) -> None:
+    # own process group: cancelling the task also stops bowtie2, java, R, ...
+    os.setpgrp()
+    with profile_step(Configuration, step.name):
+        runner(step, Configuration)
+
+class Scheduler:
+    """
+    Run a task graph under a core budget (and optional memory budget, GB).
+
+    A failed task cancels the running tasks of its sample and skips the
+    sample's remaining ones; other samples keep running. A QC gate task
+    can halt some or all of its sample's remaining tasks.
+
+    runner(step, Configuration) executes one task in the child process
+    (default: call step.func).
+    """
+
+    def __init__(self, tasks: Dict[tuple, Task], Configuration, *, max_cores: int,
+                 max_mem_gb: Optional[float] = None, runner=None):
+        self.tasks = tasks
+        self.runner = runner or _call_step
+        self.Configuration = Configuration
+        self.max_cores = max(1, int(max_cores))
+        self.max_mem_gb = max_mem_gb
+        self.per_task_threads = max(1, int(Configuration.threads))
+        self._ctx = mp.get_context("fork")
+
+    # ---- resource accounting
+
+    def _running(self):
+        return [t for t in self.tasks.values() if t.state == "running"]
+
+    def _free_cores(self) -> int:
+        return self.max_cores - sum(t.cpus for t in self._running())
+
+    def _free_mem(self) -> Optional[float]:
+        if self.max_mem_gb is None:
+            return None
+        return self.max_mem_gb - sum(t.mem_gb for t in self._running())
+
+    def _task_mem(self, task: Task) -> float:
+        """The task's memory (GB), from its step and the size of its inputs (which exist once it is ready)."""
+        if task.mem_gb is None:
+            size = resources.input_gb(task.step.input_paths(self.Configuration, task.sample)) if task.step.inputs else 0.0
+            task.mem_gb = resources.step_memory(task.step, size, self.max_mem_gb)
+        return task.mem_gb
+
+    def _fit(self, task: Task, share: Optional[int] = None) -> int:
+        """
+        Cores to start task with now, or 0 if it has to wait. share caps a
+        multi-threaded step when several are ready at once.
+        """
+        free = self._free_cores()
+        idle = not self._running()
+
+        free_mem = self._free_mem()
+        if free_mem is not None and self._task_mem(task) > free_mem and not idle:
+            return 0
+
+        if task.step.threads == "multi":
+            want = min(self.per_task_threads, self.max_cores, share or self.max_cores)
+            if free >= want:
+                return want
+            if free >= MIN_MULTI_CORES or (idle and free >= 1):
+                return free
+            return 0
+
+        want = int(task.step.threads)
+        return want if free >= want or idle else 0
+
+    def _exclusive_busy(self, task: Task) -> bool:
+        group = task.step.exclusive
+        return group is not None and any(t.step.exclusive == group for t in self._running())
+
+    # ---- state transitions
+
+    def _deps_met(self, task: Task) -> bool:
+        states = [self.tasks[d].state for d in task.deps]
+        if task.soft_deps:
+            return all(s in FINISHED for s in states) and (not states or "done" in states)
+        return all(s == "done" for s in states)
+
+    def _ready(self):
+        ready = [t for t in self.tasks.values() if t.state == "pending" and self._deps_met(t)]
+        return sorted(ready, key=lambda t: t.priority)
+
+    def _start(self, task: Task, cpus: int) -> None:
+        cfg = copy.copy(self.Configuration)
+        cfg.file_to_process = task.sample
+        resources.apply(cfg, threads=cpus, mem_gb=self._task_mem(task))
+
+        task.cpus = cpus
+        task.state = "running"
+        task.started = time.time()
+        task.proc = self._ctx.Process(target=_run_task, args=(self.runner, task.step, cfg), name=task.label)
+        task.proc.start()
+        logging.info(
+            f"[scheduler] start {task.label} (cores={cpus}, mem~{cfg.mem_gb}G, "
+            f"java -Xmx{cfg.java_heap_gb}G, sort -m {cfg.sort_mem})"
+        )
+
+    def _finish(self, task: Task) -> None:
+        task.proc.join()
+        task.cpus = 0
+        elapsed = time.time() - task.started
+        if task.proc.exitcode == 0:
+            task.state = "done"
+            logging.info(f"[scheduler] done  {task.label} ({elapsed:.0f}s)")
+            if task.step.gate:
+                self._apply_gate(task)
+        else:
+            task.state = "failed"
+            logging.error(f"[scheduler] FAILED {task.label} (exit code {task.proc.exitcode}, {elapsed:.0f}s)")
+            self._fail_sample(task)
+
+    def _fail_sample(self, failed: Task) -> None:
+        """Fail fast: cancel the sample's running siblings and skip the rest of it."""
+        if failed.sample is None:
+            return
+        siblings = [t for t in self._running() if t.sample == failed.sample]
+        if siblings:
+            logging.warning(f"[scheduler] cancelling {[t.label for t in siblings]} after {failed.label} failed")
+            self.cancel(siblings)
+        for t in self.tasks.values():
+            if t.sample == failed.sample and t.state == "pending":
+                t.state = "skipped"
+                logging.warning(f"[scheduler] skip  {t.label} ({failed.step.name} failed)")
+
+    def _apply_gate(self, gate: Task) -> None:
+        """Halt the sample's pending tasks the gate's decision skips, and whatever needs them."""
+        status, skip = gate.step.decision(self.Configuration, gate.sample)
+        if status not in ("halt", "cheap"):
+            return
+        halted = [t for t in self.tasks.values()
+                  if t.sample == gate.sample and t.state == "pending" and (skip is None or t.step.name in skip)]
+        for t in halted:
+            t.state = "halted"
+        changed = True
+        while changed:
+            changed = False
+            for t in self.tasks.values():
+                if (t.sample == gate.sample and t.state == "pending" and not t.soft_deps
+                        and any(self.tasks[d].state == "halted" for d in t.deps)):
+                    t.state = "halted"
+                    halted.append(t)
+                    changed = True
+        if halted:
+            logging.warning(f"[scheduler] {gate.label}: {status}, halting {[t.label for t in halted]}")
+
+    def cancel(self, tasks=None) -> None:
+        """Stop running tasks (default: all) and the tools they started."""
+        tasks = self._running() if tasks is None else tasks
+        for t in tasks:
+            try:
+                os.killpg(t.proc.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+        for t in tasks:
+            t.proc.join()
+            t.state = "cancelled"
+            t.cpus = 0
+
+    # ---- main loop
+
+    def run(self) -> Dict[tuple, str]:
+        logging.info(
+            f"[scheduler] {len(self.tasks)} tasks, budget: {self.max_cores} cores"
+            + (f", {self.max_mem_gb}G" if self.max_mem_gb is not None else "")
+            + f", up to {self.per_task_threads} threads per multi-threaded step"
+        )
+        try:
+            while any(t.state in ("pending", "running") for t in self.tasks.values()):
+                ready = self._ready()
+                single = [t for t in ready if t.step.threads != "multi"]
+                multi = [t for t in ready if t.step.threads == "multi"]
+
+                # single-threaded steps first, then split what is left
+                # between the multi-threaded ones
+                for task in single:
+                    if not self._exclusive_busy(task):
+                        cpus = self._fit(task)
+                        if cpus:
+                            self._start(task, cpus)
+                for n, task in enumerate(multi):
+                    if self._exclusive_busy(task):
+                        continue
+                    share = max(MIN_MULTI_CORES, self._free_cores() // (len(multi) - n))
+                    cpus = self._fit(task, share)
+                    if cpus:
+                        self._start(task, cpus)
+
+                running = self._running()
+                if not running:
+                    # nothing runnable and nothing running: remaining tasks can never start
+                    for t in self.tasks.values():
+                        if t.state == "pending":
+                            t.state = "skipped"
+                    break
+
+                finished = wait([t.proc.sentinel for t in running])
+                for t in running:
+                    if t.proc.sentinel in finished:
+                        self._finish(t)
+        except BaseException:
+            self.cancel()
+            raise
+
+        states = {k: t.state for k, t in self.tasks.items()}
+        failed = [t.label for t in self.tasks.values() if t.state not in SUCCEEDED]
+        halted = [t.label for t in self.tasks.values() if t.state == "halted"]
+        if halted:
+            logging.warning(f"[scheduler] {len(halted)} task(s) halted by QC gates: {halted}")
+        if failed:
+            logging.error(f"[scheduler] {len(failed)} task(s) did not complete: {failed}")
+        else:
+            logging.info("[scheduler] all tasks finished")
+        return states
@@ -0,0 +1,227 @@
+########################################
+# content-addressed step cache
+#
+# a step's key is a hash of its input fingerprints (size/mtime, or sha256
+# with options.cache_hash_inputs), its parameters, the reference files it
+# uses and the versions of the tools it runs. the key and the fingerprints of
+# the outputs are stored in a manifest next to the outputs; the step is
+# skipped only when the key matches and the outputs are unchanged.
+# downstream keys include upstream output fingerprints, so a rerun cascades.
+########################################
+
+import os
+import glob
+import json
+import shutil
+import hashlib
+import logging
+import subprocess
+from functools import lru_cache
+from typing import Optional
+
+from steps.helpers import outputs_exist, sha256_file
+from steps.procpipe import partial_path
+
+MANIFEST_VERSION = 1
+
+# how to ask each tool for its version (first non-empty output line is kept)
+TOOL_VERSION_CMDS = {
+    "fastp": ["fastp", "--version"],
+    "fastqc": ["fastqc", "--version"],
+    "bowtie2": ["bowtie2", "--version"],
+    "samtools": ["samtools", "--version"],
+    "picard": ["java", "-jar", "{picard}", "MarkDuplicates", "--version"],
+    "bamCoverage": ["bamCoverage", "--version"],
+    "macs3": ["macs3", "--version"],
+    "Rscript": ["Rscript", "--version"],
+}
+
+def fingerprint(path: str, *, content_hash: bool = False):
+    """
+    Cheap identity of a file (size + mtime, or size + sha256) or of a
+    directory (fingerprints of the files below it). None if missing.
+    """
+    if os.path.isdir(path):
+        entries = {}
+        for root, _, files in os.walk(path):
+            for f in sorted(files):
+                p = os.path.join(root, f)
+                entries[os.path.relpath(p, path)] = fingerprint(p, content_hash=content_hash)
+        return entries
+    if not os.path.exists(path):
+        return None
+    st = os.stat(path)
+    if content_hash:
+        return {"size": st.st_size, "sha256": sha256_file(path)}
+    return {"size": st.st_size, "mtime_ns": st.st_mtime_ns}
+
+def _reference_fingerprint(path: Optional[str], content_hash: bool):
+    """Reference files may be prefixes (bowtie2 index): fingerprint prefix.* then."""
+    if not path:
+        return None
+    if os.path.exists(path):
+        return fingerprint(path, content_hash=content_hash)
+    return {os.path.basename(p): fingerprint(p) for p in sorted(glob.glob(path + ".*"))}
+
+@lru_cache(maxsize=None)
+def tool_version(name: str, picard: Optional[str] = None) -> str:
+    if name == "pysam":
+        try:
+            import pysam
+            return pysam.__version__
+        except ImportError:
+            return "unavailable"
+
+    cmd = [c.format(picard=picard) for c in TOOL_VERSION_CMDS.get(name, [name, "--version"])]
+    try:
+        res = subprocess.run(cmd, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, timeout=60)
+    except (OSError, subprocess.TimeoutExpired):
+        return "unavailable"
+    for line in res.stdout.decode(errors="replace").splitlines():
+        if line.strip():
+            return line.strip()
+    return "unknown"
+
+def probe_tools(steps, Configuration) -> None:
+    """
+    Versions of the tools in the steps' cache keys, probed once in the
+    parent (Configuration.tool_versions) so forked tasks do not rerun the
+    probes.
+    """
+    if not getattr(Configuration, "step_cache", True):
+        return
+    names = sorted({t for s in steps if s.scope == "sample" for t in s.tools})
+    Configuration.tool_versions = {t: tool_version(t, getattr(Configuration, "picard", None)) for t in names}
+
+class StepCache:
+    """Manifest-backed freshness check for one (sample, step)."""
+
+    def __init__(self, step, Configuration, sample: str):
+        self.step = step
+        self.Configuration = Configuration
+        self.sample = sample
+        self.content_hash = bool(getattr(Configuration, "cache_hash_inputs", False))
+        self.outputs = step.output_paths(Configuration, sample)
+        self.inputs = step.input_paths(Configuration, sample)
+        self._described = None
+
+        # next to the first output; named per sample so that directory outputs
+        # (fastqc) keep their manifest beside, not inside, the directory
+        self.manifest_path = os.path.join(
+            os.path.dirname(self.outputs[0]), f".{sample}.{step.name}.manifest.json"
+        )
+
+    def _description(self) -> dict:
+        """Computed once: the step does not change its inputs, so record() reuses status()'s."""
+        if self._described is None:
+            self._described = self._describe()
+        return self._described
+
+    def _describe(self) -> dict:
+        cfg = self.Configuration
+        versions = getattr(cfg, "tool_versions", None) or {}
+        return {
+            "version": MANIFEST_VERSION,
+            "step": self.step.name,
+            "sample": self.sample,
+            "inputs": {p: fingerprint(p, content_hash=self.content_hash) for p in self.inputs},
+            "params": self.step.param_values(cfg),
+            "references": {
+                attr: {
+                    "path": getattr(cfg, attr, None),
+                    "fingerprint": _reference_fingerprint(getattr(cfg, attr, None), self.content_hash),
+                }
+                for attr in self.step.references
+            },
+            "tools": {
+                t: versions[t] if t in versions else tool_version(t, getattr(cfg, "picard", None))
+                for t in self.step.tools
+            },
+        }
+
+    @staticmethod
+    def _key(description: dict) -> str:
+        return hashlib.sha256(json.dumps(description, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _load(self) -> Optional[dict]:
+        try:
+            with open(self.manifest_path) as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def status(self) -> str:
+        """'current', or the reason the step has to run."""
+        manifest = self._load()
+        if manifest is None:
+            return "no manifest"
+        if not outputs_exist(self.outputs):
+            return "outputs missing"
+
+        description = self._description()
+        if manifest.get("key") != self._key(description):
+            old = manifest.get("description", {})
+            changed = [k for k in ("inputs", "params", "references", "tools") if old.get(k) != description[k]]
+            return f"changed: {', '.join(changed) or 'manifest format'}"
+
+        recorded = manifest.get("outputs", {})
+        for p in self.outputs:
+            if recorded.get(p) != fingerprint(p):
+                return f"output modified: {os.path.basename(p)}"
+        return "current"
+
+    def record(self) -> None:
+        """Write the manifest for the outputs that now exist."""
+        description = self._description()
+        manifest = {
+            "key": self._key(description),
+            "description": description,
+            "outputs": {p: fingerprint(p) for p in self.outputs},
+        }
+        os.makedirs(os.path.dirname(self.manifest_path), exist_ok=True)
+        tmp = self.manifest_path + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.manifest_path)
+
+def _clear_outputs(paths) -> None:
+    """
+    Remove a step's declared outputs (and partial files) so its own
+    outputs_exist check cannot accept them. Unlike --force, which lets
+    steps empty whole directories, this leaves other steps' files alone.
+    """
+    for p in paths:
+        for path in (p, partial_path(p)):
+            if os.path.isdir(path):
+                shutil.rmtree(path)
+            elif os.path.exists(path):
+                os.remove(path)
+
+def run_cached(step, Configuration) -> None:
+    """
+    Scheduler runner: skip the step when its manifest is current, otherwise
+    remove its stale outputs, run it and record a new manifest on success.
+    Only an explicit --force reaches the steps as Configuration.force.
+    """
+    sample = Configuration.file_to_process
+    if step.scope != "sample" or not step.outputs or not getattr(Configuration, "step_cache", True):
+        step.func(Configuration)
+        return
+
+    cache = StepCache(step, Configuration, sample)
+    status = "forced" if Configuration.force else cache.status()
+
+    if status == "current":
+        logging.info(f"{step.name}: cached result is current; skipping")
+        return
+
+    if status == "no manifest" and getattr(Configuration, "trust_existing", False) and outputs_exist(cache.outputs):
+        logging.info(f"{step.name}: adopting existing outputs (no manifest yet)")
+        cache.record()
+        return
+
+    logging.info(f"{step.name}: running ({status})")
+    if not Configuration.force:
+        _clear_outputs(cache.outputs)
+    step.func(Configuration)
+    cache.record()
@@ -2,7 +2,14 @@ import os
 import logging
 import subprocess
 import shlex
-from steps.helpers import outputs_exist, clean_dir
+from steps.helpers import outputs_exist
+
+def get_output_dir(Configuration, sample: str) -> str:
+    """{other_qc_dir}/{sample}/ATACseqQC, or {atacseqqc_dir}/{sample} when overridden."""
+    base_qc_dir = getattr(Configuration, "atacseqqc_dir", None)
+    if base_qc_dir is None:
+        return os.path.join(Configuration.other_qc_dir, sample, "ATACseqQC")
+    return os.path.join(base_qc_dir, sample)
 
 def run_ATACseqQC(Configuration):
     """
@@ -24,12 +31,7 @@ def run_ATACseqQC(Configuration):
     if not os.path.exists(bam_file):
         raise FileNotFoundError(f"ATACseqQC input BAM not found: {bam_file}")
 
-    base_qc_dir = getattr(Configuration, "atacseqqc_dir", None)
-    if base_qc_dir is None:
-        out_dir = os.path.join(Configuration.other_qc_dir, sample, "ATACseqQC")
-    else:
-        out_dir = os.path.join(base_qc_dir, sample)
-
+    out_dir = get_output_dir(Configuration, sample)
     os.makedirs(out_dir, exist_ok=True)
 
     expected = [
@@ -44,7 +46,11 @@ def run_ATACseqQC(Configuration):
         return
 
     if Configuration.force:
-        clean_dir(out_dir)
+        # only this step's files: the directory also holds the native tsse /
+        # tn5shift outputs (profile, matrix, BED exports)
+        for p in expected:
+            if os.path.exists(p):
+                os.remove(p)
 
     r_script = "/mnt/jw01-aruk-home01/projects/oa_functional_genomics/projects/ATAC_seq/analyses/master_pipeline/scripts/ATACseqQC_for_pipeline.r"
     conda_activate = "/mnt/jw01-aruk-home01/projects/functional_genomics/common_files/bin/tools/miniforge/24.3.0-0/bin/activate"
@@ -5,7 +5,19 @@
 import os
 import glob
 import logging
-from steps.helpers import clean_dir, outputs_exist, run_cmd, run_pipe
+from steps.helpers import clean_dir, outputs_exist, run_cmd
+from steps.procpipe import partial_path, run_pipeline
+
+# the pysam / numpy engines (steps.bamstats, bamfilter, bamstream, refcache)
+# are imported by the functions that use them, so align_bowtie does not load them
+
+BOWTIE2_ARGS = ["--very-sensitive", "-k", "1", "-X", "2000"]
+
+# filtered BAM criteria (see filter_alignments); MAPQ can be set with options.min_mapq
+FILTER_EXCLUDE_CONTIGS = ("chrM",)
+FILTER_MIN_MAPQ = 30
+FILTER_EXCLUDE_FLAGS = 1804
+FILTER_REQUIRE_FLAGS = 2
 
 def _require_single_glob(pattern: str, label: str) -> str:
     matches = sorted(glob.glob(pattern))
@@ -15,6 +27,38 @@ def _require_single_glob(pattern: str, label: str) -> str:
         raise RuntimeError(f"[{label}] Expected 1 file, found {len(matches)}: {matches}")
     return matches[0]
 
+def _trimmed_fastqs(Configuration, sample):
+    trimmed_dir = os.path.join(Configuration.Trimmed_dir, sample)
+    R1_file = _require_single_glob(os.path.join(trimmed_dir, "*trimmed_R1.fastq.gz"), "Trimmed R1")
+    R2_file = _require_single_glob(os.path.join(trimmed_dir, "*trimmed_R2.fastq.gz"), "Trimmed R2")
+    return R1_file, R2_file
+
+def _bowtie2_cmd(Configuration, R1_file, R2_file, threads):
+    return (
+        ["bowtie2"] + BOWTIE2_ARGS +
+        ["-x", Configuration.bowtie2_index,
+         "-1", R1_file, "-2", R2_file,
+         "-p", str(threads)]
+    )
+
+def _filter_options(Configuration) -> dict:
+    """filter_bam / ReadFilter arguments for the filtered BAM."""
+    from steps import refcache
+
+    # Optional blacklist removal (BED or BED.GZ), as a sorted index from the
+    # reference cache
+    blacklist = refcache.blacklist(Configuration)
+    if blacklist is not None:
+        logging.info(f"Applying blacklist filter: {Configuration.blacklist_bed}")
+
+    return dict(
+        exclude_contigs=FILTER_EXCLUDE_CONTIGS,
+        min_mapq=int(getattr(Configuration, "min_mapq", FILTER_MIN_MAPQ)),
+        exclude_flags=FILTER_EXCLUDE_FLAGS,
+        require_flags=FILTER_REQUIRE_FLAGS,
+        blacklist=blacklist,
+    )
+
 def align_bowtie(Configuration):
     """
     Align trimmed FASTQs with bowtie2 -> sort BAM.
@@ -23,9 +67,7 @@ def align_bowtie(Configuration):
     sample = Configuration.file_to_process
     logging.info("starting bowtie2 mapping")
 
-    trimmed_dir = os.path.join(Configuration.Trimmed_dir, sample)
-    R1_file = _require_single_glob(os.path.join(trimmed_dir, "*trimmed_R1.fastq.gz"), "Trimmed R1")
-    R2_file = _require_single_glob(os.path.join(trimmed_dir, "*trimmed_R2.fastq.gz"), "Trimmed R2")
+    R1_file, R2_file = _trimmed_fastqs(Configuration, sample)
 
     align_output_dir = os.path.join(Configuration.aligned_dir, sample)
     os.makedirs(align_output_dir, exist_ok=True)
@@ -40,26 +82,33 @@ def align_bowtie(Configuration):
     if Configuration.force:
         clean_dir(align_output_dir)
 
-    threads = str(getattr(Configuration, "threads", 6))
+    threads = str(Configuration.threads)
 
-    run_pipe(
-        ["bowtie2", "--very-sensitive", "-k", "1", "-X", "2000",
-         "-x", Configuration.bowtie2_index,
-         "-1", R1_file, "-2", R2_file,
-         "-p", threads],
-        ["samtools", "sort", "-@", threads, "-o", bam_out, "-"]
+    # the sorted BAM gets its name only when bowtie2 and the sort both succeed
+    run_pipeline(
+        [
+            _bowtie2_cmd(Configuration, R1_file, R2_file, threads),
+            ["samtools", "sort", "-@", threads, "-m", Configuration.sort_mem, "-o", partial_path(bam_out), "-"],
+        ],
+        outputs=[bam_out],
+        timeout=Configuration.pipeline_timeout,
     )
 
     run_cmd(["samtools", "index", bam_out], check=True)
 
 def dedup_QC_alignments(Configuration):
     """
-    Runs Picard MarkDuplicates (REMOVE_DUPLICATES=true) and alignment QC.
+    Runs Picard MarkDuplicates (REMOVE_DUPLICATES=true), or with
+    options.markdup_engine: native the built-in marker (steps.markdup, which
+    also writes {sample}_complexity_curve.tsv), then collects the alignment
+    summary, idxstats, flagstat and fragment length counts in a single pass
+    over the dedup BAM (steps.bamstats).
     Skips if outputs exist (unless Configuration.force).
     """
     import os
     import logging
     from steps.helpers import clean_dir, outputs_exist, run_cmd
+    from steps.bamstats import write_dedup_stats
 
     sample = Configuration.file_to_process
 
@@ -80,8 +129,14 @@ def dedup_QC_alignments(Configuration):
     align_metrics = os.path.join(qc_dir, f"{sample}_alignment_metrics_qc.txt")
     idxstats_out = os.path.join(qc_dir, f"{sample}_idxstats.txt")
     fraglen_out = os.path.join(qc_dir, f"{sample}_fragment_length_count.txt")
-
-    expected = [dedup_bam, dedup_bai, markdup_metrics, align_metrics, idxstats_out, fraglen_out]
+    fraglen_npy = os.path.join(qc_dir, f"{sample}_fragment_lengths.npy")
+    flagstat_out = os.path.join(qc_dir, f"{sample}_flagstat.txt")
+    complexity_out = os.path.join(qc_dir, f"{sample}_complexity_curve.tsv")
+    native = Configuration.markdup_engine == "native"
+
+    expected = [dedup_bam, dedup_bai, markdup_metrics, align_metrics, idxstats_out, fraglen_out, fraglen_npy]
+    if native:
+        expected.append(complexity_out)
     if (not Configuration.force) and outputs_exist(expected):
         logging.info("dedup_QC_alignments: outputs exist; skipping (use --force to overwrite)")
         return
@@ -90,35 +145,34 @@ def dedup_QC_alignments(Configuration):
         clean_dir(dedup_dir)
         clean_dir(qc_dir)
 
-    # Picard threads: keep conservative
-    picard_gc_threads = str(min(4, int(getattr(Configuration, "threads", 8))))
+    if native:
+        from steps.markdup import mark_duplicates
 
-    logging.info("running Picard MarkDuplicates")
-    run_cmd(
-        f"java -XX:ParallelGCThreads={picard_gc_threads} -Xmx8G -jar {Configuration.picard} "
-        f"MarkDuplicates QUIET=true REMOVE_DUPLICATES=true CREATE_INDEX=true "
-        f"I={alignment_file} O={dedup_bam} M={markdup_metrics}",
-        shell=True,
-        check=True
-    )
-
-    logging.info("running Picard CollectAlignmentSummaryMetrics")
-    run_cmd(
-        f"java -XX:ParallelGCThreads={picard_gc_threads} -Xmx8G -jar {Configuration.picard} "
-        f"CollectAlignmentSummaryMetrics R={Configuration.genome_fasta} I={dedup_bam} O={align_metrics}",
-        shell=True,
-        check=True
-    )
-
-    logging.info("running samtools idxstats")
-    run_cmd(f"samtools idxstats {dedup_bam} > {idxstats_out}", shell=True, check=True)
-
-    logging.info("computing fragment length counts")
-    run_cmd(
-        f"samtools view {dedup_bam} | awk '$9>0' | cut -f 9 | sort | uniq -c | "
-        f"sort -b -k2,2n | sed -e 's/^[ \\t]*//' > {fraglen_out}",
-        shell=True,
-        check=True
+        logging.info("running native duplicate marking")
+        mark_duplicates(alignment_file, dedup_bam, markdup_metrics,
+                        complexity_path=complexity_out, threads=Configuration.threads,
+                        tmp_dir=os.environ.get("TMPDIR"))
+    else:
+        # heap and GC threads from the task's grant (resources.apply)
+        logging.info(f"running Picard MarkDuplicates (-Xmx{Configuration.java_heap_gb}G)")
+        run_cmd(
+            f"java -XX:ParallelGCThreads={Configuration.threads} -Xmx{Configuration.java_heap_gb}G -jar {Configuration.picard} "
+            f"MarkDuplicates QUIET=true REMOVE_DUPLICATES=true CREATE_INDEX=true "
+            f"I={alignment_file} O={dedup_bam} M={markdup_metrics}",
+            shell=True,
+            check=True
+        )
+
+    # alignment summary, idxstats, flagstat and fragment lengths in one BAM pass
+    logging.info("collecting alignment statistics (single pass)")
+    write_dedup_stats(
+        dedup_bam,
+        align_metrics=align_metrics,
+        idxstats_out=idxstats_out,
+        fraglen_out=fraglen_out,
+        fraglen_npy=fraglen_npy,
+        flagstat_out=flagstat_out,
+        threads=Configuration.threads,
     )
 
 def filter_alignments(Configuration):
@@ -127,14 +181,15 @@ def filter_alignments(Configuration):
 
     Filters:
       - remove chrM
-      - MAPQ >= 30
+      - MAPQ >= 30 (options.min_mapq)
       - proper pairs (-f 2)
       - exclude flags 1804
       - OPTIONAL: remove ENCODE blacklist regions (Configuration.blacklist_bed)
     """
     import os
     import logging
-    from steps.helpers import clean_dir, outputs_exist, run_cmd
+    from steps.helpers import clean_dir, outputs_exist
+    from steps.bamfilter import filter_bam
 
     sample = Configuration.file_to_process
     logging.info("creating filtered bam file")
@@ -157,37 +212,85 @@ def filter_alignments(Configuration):
     if Configuration.force:
         clean_dir(out_dir)
 
-    # Base filtering command (chrM removal + mapq + flags)
-    base_cmd = (
-        f"samtools view -h {dedup_bam} | "
-        f"grep -v chrM | "
-        f"samtools view -h -q 30 - | "
-        f"samtools view -h -b -F 1804 -f 2"
+    threads = Configuration.threads
+
+    # contigs are read through the index, so chrM is never decoded; the input
+    # is coordinate-sorted already, so no re-sort and the index is written in
+    # the same pass
+    filter_bam(
+        dedup_bam,
+        filtered_bam,
+        threads=threads,
+        timeout=Configuration.pipeline_timeout,
+        **_filter_options(Configuration),
     )
 
-    # Optional blacklist removal (BED or BED.GZ)
-    bl = getattr(Configuration, "blacklist_bed", None)
-    threads = str(getattr(Configuration, "threads", 8))
-
-    if bl:
-        logging.info(f"Applying blacklist filter: {bl}")
-        if bl.endswith(".gz"):
-            cmd = (
-                base_cmd + " | "
-                f"bedtools intersect -v -abam - -b <(zcat '{bl}') | "
-                f"samtools sort -@ {threads} -O bam -o '{filtered_bam}'"
-            )
-            run_cmd(cmd, shell=True, check=True, env=None)  # needs bash for process substitution
-        else:
-            cmd = (
-                base_cmd + " | "
-                f"bedtools intersect -v -abam - -b '{bl}' | "
-                f"samtools sort -@ {threads} -O bam -o '{filtered_bam}'"
-            )
-            run_cmd(cmd, shell=True, check=True)
-    else:
-        cmd = base_cmd + f" | samtools sort -@ {threads} -O bam -o '{filtered_bam}'"
-        run_cmd(cmd, shell=True, check=True)
+def align_stream_filtered(Configuration):
+    """
+    Streaming alternative to align_bowtie + dedup_QC_alignments +
+    filter_alignments (options.streaming_alignment):
+
+      bowtie2 | samtools fixmate -m | sort | markdup -r  ->  filtered BAM
+
+    The deduplicated stream is never written: the markdup metrics (Picard
+    layout, from samtools markdup -s), alignment summary, idxstats, flagstat
+    and fragment length counts are collected from it on the way to the
+    filtered BAM, so qc.run_qc and MultiQC find the same files.
+    Skips if outputs exist (unless Configuration.force).
+    """
+    from steps.bamfilter import ReadFilter
+    from steps.bamstream import markdup_commands, stream_dedup_filter
+
+    sample = Configuration.file_to_process
+    logging.info("starting streaming bowtie2 -> markdup -> filter")
+
+    R1_file, R2_file = _trimmed_fastqs(Configuration, sample)
+
+    out_dir = os.path.join(Configuration.cleaned_alignments_dir, sample)
+    os.makedirs(out_dir, exist_ok=True)
+    filtered_bam = os.path.join(out_dir, f"{sample}_align_dedup_filtered.bam")
+
+    qc_dir = os.path.join(Configuration.other_qc_dir, sample)
+    os.makedirs(qc_dir, exist_ok=True)
+    markdup_metrics = os.path.join(qc_dir, f"{sample}_markdup_qc.txt")
+    markdup_stats = os.path.join(qc_dir, f"{sample}_markdup_samtools_stats.txt")
+    align_metrics = os.path.join(qc_dir, f"{sample}_alignment_metrics_qc.txt")
+    idxstats_out = os.path.join(qc_dir, f"{sample}_idxstats.txt")
+    fraglen_out = os.path.join(qc_dir, f"{sample}_fragment_length_count.txt")
+    fraglen_npy = os.path.join(qc_dir, f"{sample}_fragment_lengths.npy")
+    flagstat_out = os.path.join(qc_dir, f"{sample}_flagstat.txt")
+
+    expected = [filtered_bam, filtered_bam + ".bai", markdup_metrics, align_metrics, idxstats_out, fraglen_out, fraglen_npy]
+    if (not Configuration.force) and outputs_exist(expected):
+        logging.info("align_stream_filtered: outputs exist; skipping (use --force to overwrite)")
+        return
+
+    if Configuration.force:
+        clean_dir(out_dir)
+        clean_dir(qc_dir)
 
-    logging.info("indexing filtered bam")
-    run_cmd(["samtools", "index", filtered_bam], check=True)
\ No newline at end of file
+    threads = Configuration.threads
+    # sort / markdup spill files: node-local scratch when the job has one
+    tmp_prefix = os.path.join(os.environ.get("TMPDIR", out_dir), f"{sample}.stream")
+
+    stream_dedup_filter(
+        markdup_commands(
+            _bowtie2_cmd(Configuration, R1_file, R2_file, threads),
+            markdup_stats=markdup_stats,
+            tmp_prefix=tmp_prefix,
+            threads=threads,
+            sort_mem=Configuration.sort_mem,
+        ),
+        filtered_bam,
+        read_filter=ReadFilter(**_filter_options(Configuration)),
+        markdup_stats=markdup_stats,
+        markdup_metrics=markdup_metrics,
+        align_metrics=align_metrics,
+        idxstats_out=idxstats_out,
+        fraglen_out=fraglen_out,
+        fraglen_npy=fraglen_npy,
+        flagstat_out=flagstat_out,
+        library=sample,
+        threads=threads,
+        timeout=Configuration.pipeline_timeout,
+    )
\ No newline at end of file
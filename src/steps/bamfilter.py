@@ -0,0 +1,153 @@
+########################################
+# index-driven BAM filtering
+#
+# replaces samtools view -h | grep -v chrM | samtools view -q | samtools view
+# -F -f | bedtools intersect -v | samtools sort. contigs are visited through
+# the BAM index (excluded contigs are never decoded), predicates are applied
+# to decoded records and the output is written in the input (sorted) order
+# with its index built on the fly.
+########################################
+
+import os
+import logging
+from typing import Iterable, Optional
+
+import pysam
+
+from steps import shards
+from steps.bamio import IndexedBamWriter
+from steps.intervals import IntervalSet
+
+class ReadFilter:
+    """
+    The filtered-BAM predicate, applied to coordinate-sorted records.
+
+    A record is kept when:
+      - its contig is not in exclude_contigs
+      - MAPQ >= min_mapq
+      - no bit of exclude_flags is set and all bits of require_flags are set
+      - its aligned span does not overlap the blacklist (bedtools intersect -v)
+
+    counts holds the number of records examined / kept / dropped per reason.
+    """
+
+    def __init__(
+        self,
+        *,
+        exclude_contigs: Iterable[str] = ("chrM",),
+        min_mapq: int = 30,
+        exclude_flags: int = 1804,
+        require_flags: int = 2,
+        blacklist: Optional[IntervalSet] = None,
+    ):
+        self.exclude = set(exclude_contigs)
+        self.min_mapq = min_mapq
+        self.exclude_flags = exclude_flags
+        self.require_flags = require_flags
+        self.blacklist = blacklist
+        self.counts = {"examined": 0, "kept": 0, "contig": 0, "mapq": 0, "flags": 0, "blacklist": 0}
+        self._contig = None
+        self._skip_contig = False
+        self._in_blacklist = None
+
+    def _enter_contig(self, contig) -> None:
+        # the blacklist sweeper only moves forward, so start a new one per contig
+        self._contig = contig
+        self._skip_contig = contig in self.exclude
+        if self.blacklist is not None and contig is not None:
+            self._in_blacklist = self.blacklist.sweeper(contig)
+        else:
+            self._in_blacklist = None
+
+    def __call__(self, read) -> bool:
+        counts = self.counts
+        counts["examined"] += 1
+        contig = read.reference_name
+        if contig != self._contig:
+            self._enter_contig(contig)
+        if self._skip_contig:
+            counts["contig"] += 1
+            return False
+        flag = read.flag
+        if flag & self.exclude_flags or (flag & self.require_flags) != self.require_flags:
+            counts["flags"] += 1
+            return False
+        if read.mapping_quality < self.min_mapq:
+            counts["mapq"] += 1
+            return False
+        if self._in_blacklist is not None and self._in_blacklist(read.reference_start, read.reference_end):
+            counts["blacklist"] += 1
+            return False
+        counts["kept"] += 1
+        return True
+
+    def log(self, out_bam: str) -> None:
+        c = self.counts
+        logging.info(
+            f"filter_bam: {os.path.basename(out_bam)} kept {c['kept']} of {c['examined']} "
+            f"(flags={c['flags']}, mapq={c['mapq']}, blacklist={c['blacklist']}, contig={c['contig']}; "
+            f"skipped contigs: {','.join(sorted(self.exclude)) or 'none'})"
+        )
+
+def _filter_shard(shard, *, in_bam: str, work: str, filter_args: dict) -> dict:
+    """Records of one shard passing ReadFilter(**filter_args), to an uncompressed shard BAM."""
+    keep = ReadFilter(**filter_args)
+    with pysam.AlignmentFile(in_bam, "rb") as bam, \
+            shards.shard_writer(os.path.join(work, shard.name + ".bam"), bam.header) as out:
+        for read in shards.fetch(bam, shard):
+            if keep(read):
+                out.write(read)
+    return keep.counts
+
+def filter_bam(
+    in_bam: str,
+    out_bam: str,
+    *,
+    exclude_contigs: Iterable[str] = ("chrM",),
+    min_mapq: int = 30,
+    exclude_flags: int = 1804,
+    require_flags: int = 2,
+    blacklist: Optional[IntervalSet] = None,
+    threads: int = 1,
+    timeout: Optional[float] = None,
+) -> dict:
+    """
+    Write records of in_bam that pass ReadFilter to out_bam (+ .bai).
+    Excluded contigs are skipped through the index, not decoded. With
+    threads > 1 the shards of in_bam (steps/shards.py) are filtered in
+    parallel and concatenated in order (a pipeline stopped after timeout
+    seconds).
+
+    Returns a dict of counts for logging / QC.
+    """
+    filter_args = dict(
+        exclude_contigs=exclude_contigs,
+        min_mapq=min_mapq,
+        exclude_flags=exclude_flags,
+        require_flags=require_flags,
+        blacklist=blacklist,
+    )
+    keep = ReadFilter(**filter_args)
+
+    if threads > 1:
+        plan = shards.plan(in_bam, exclude=keep.exclude)
+        shards.log_plan("filter_bam", plan, threads)
+        with shards.workdir(out_bam, os.environ.get("TMPDIR")) as work:
+            counts = shards.run(_filter_shard, plan, threads=threads, in_bam=in_bam, work=work, filter_args=filter_args)
+            shards.concat_bams([os.path.join(work, s.name + ".bam") for s in plan], out_bam,
+                               header_from=in_bam, threads=threads, timeout=timeout)
+        keep.counts.update(shards.sum_counts(counts))
+        keep.log(out_bam)
+        return keep.counts
+
+    with pysam.AlignmentFile(in_bam, "rb", threads=max(1, threads)) as bam:
+        contigs = [c for c in bam.references if c not in keep.exclude]
+
+        with IndexedBamWriter(out_bam, bam.header, threads=threads) as out:
+            for contig in contigs:
+                for read in bam.fetch(contig):
+                    if keep(read):
+                        out.write(read)
+
+    keep.log(out_bam)
+    return keep.counts
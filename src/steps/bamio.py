@@ -0,0 +1,141 @@
+########################################
+# BAM reading / writing helpers shared by the native BAM steps
+########################################
+
+import os
+import time
+import logging
+import subprocess
+from typing import Optional
+
+import pysam
+
+from steps.helpers import wait_profiled
+from steps.procpipe import Watchdog, partial_path
+
+class IndexedBamWriter:
+    """
+    Write coordinate-sorted records to a BAM and build its .bai in the same
+    pass. Records are handed to `samtools view --write-index` as
+    uncompressed BAM, so compression is multi-threaded and there is no
+    separate `samtools index` read-back.
+
+    The BAM and .bai are written under procpipe.partial_path and renamed on
+    a clean exit; with deferred=True the caller renames them with commit()
+    once its own input is known to be complete (a pipe whose upstream
+    stages may still fail).
+
+    Usage:
+        with IndexedBamWriter(out_bam, header, threads=8) as out:
+            out.write(read)
+    """
+
+    def __init__(self, path: str, header, *, threads: int = 1, deferred: bool = False):
+        self.path = path
+        self.index_path = path + ".bai"
+        self.header = header
+        self.threads = max(1, int(threads))
+        self.deferred = deferred
+        self.written = 0
+        self._proc = None
+        self._bam = None
+
+    def __enter__(self) -> "IndexedBamWriter":
+        cmd = [
+            "samtools", "view", "-b", "-@", str(self.threads),
+            "--write-index", "-o", f"{partial_path(self.path)}##idx##{partial_path(self.index_path)}", "-",
+        ]
+        self._cmd = " ".join(cmd)
+        logging.info(f"CMD: {self._cmd}")
+        self._start = time.time()
+        self._proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+        self._bam = pysam.AlignmentFile(self._proc.stdin, "wbu", header=self.header)
+        return self
+
+    def write(self, read) -> None:
+        self._bam.write(read)
+        self.written += 1
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        self._bam.close()
+        self._proc.stdin.close()
+        rc = wait_profiled(self._proc, self._cmd, self._start)
+        if exc_type is not None or rc != 0:
+            self.discard()
+        if exc_type is None and rc != 0:
+            raise RuntimeError(f"samtools view --write-index failed (rc={rc}) for {self.path}")
+        if exc_type is None and not self.deferred:
+            self.commit()
+
+    def commit(self) -> None:
+        """Give the BAM and its index their final names."""
+        os.replace(partial_path(self.path), self.path)
+        os.replace(partial_path(self.index_path), self.index_path)
+
+    def discard(self) -> None:
+        for p in (self.path, self.index_path):
+            if os.path.exists(partial_path(p)):
+                os.remove(partial_path(p))
+
+class BamPipeReader:
+    """
+    Read BAM records from the end of a chain of commands (cmds[0] | cmds[1]
+    | ...), without the stream touching disk. Every command is reaped and
+    profiled on exit; a failing command raises, as does a chain still
+    running after timeout seconds (it is stopped).
+
+    Usage:
+        with BamPipeReader([bowtie2_cmd, sort_cmd]) as bam:
+            for read in bam:
+                ...
+    """
+
+    def __init__(self, cmds, *, threads: int = 1, timeout: Optional[float] = None):
+        self.cmds = cmds
+        self.threads = max(1, int(threads))
+        self.timeout = timeout
+        self.header = None
+        self._procs = []
+        self._bam = None
+        self._watchdog = None
+
+    def __enter__(self) -> "BamPipeReader":
+        logging.info("PIPE: " + " | ".join(" ".join(c) for c in self.cmds))
+        self._start = time.time()
+        stdin = None
+        for cmd in self.cmds:
+            p = subprocess.Popen(cmd, stdin=stdin, stdout=subprocess.PIPE)
+            if stdin is not None:
+                stdin.close()
+            stdin = p.stdout
+            self._procs.append(p)
+        self._watchdog = Watchdog(self._procs, self.timeout)
+        try:
+            self._bam = pysam.AlignmentFile(self._procs[-1].stdout, "rb", threads=self.threads)
+        except BaseException as exc:
+            # no header (a stage died first): reap the chain, and name the cause
+            self.__exit__(type(exc), exc, exc.__traceback__)
+            raise
+        self.header = self._bam.header
+        return self
+
+    def __iter__(self):
+        return self._bam.fetch(until_eof=True)
+
+    def __exit__(self, exc_type, exc, tb) -> None:
+        if exc_type is not None:
+            self._watchdog.kill()
+        if self._bam is not None:
+            self._bam.close()
+        self._procs[-1].stdout.close()
+        failed = []
+        for cmd, p in zip(reversed(self.cmds), reversed(self._procs)):
+            rc = wait_profiled(p, " ".join(cmd), self._start)
+            if rc != 0:
+                failed.append(f"{cmd[0]} {cmd[1] if len(cmd) > 1 else ''}".strip() + f" (rc={rc})")
+        self._watchdog.cancel()
+        if self._watchdog.expired and (failed or exc_type is not None):
+            # the truncated stream is only a symptom
+            raise RuntimeError(f"Pipe timed out after {self.timeout}s: {', '.join(failed)}")
+        if exc_type is None and failed:
+            raise RuntimeError(f"Pipe failed: {', '.join(failed)}")
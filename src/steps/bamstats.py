@@ -0,0 +1,529 @@
+########################################
+# single-pass BAM statistics engine
+#
+# decodes a BAM once and feeds every record to a list of accumulators.
+# each accumulator writes the same text file the external tool used to
+# (samtools idxstats / flagstat, Picard CollectAlignmentSummaryMetrics,
+# the samtools view | awk | sort | uniq -c fragment length chain)
+########################################
+
+import os
+import logging
+import datetime
+from typing import Dict, List, Optional
+
+import pysam
+
+from steps import fraglen, shards
+
+# BAM flag bits used below
+FPAIRED = 0x1
+FPROPER_PAIR = 0x2
+FUNMAP = 0x4
+FMUNMAP = 0x8
+FREVERSE = 0x10
+FREAD1 = 0x40
+FREAD2 = 0x80
+FSECONDARY = 0x100
+FQCFAIL = 0x200
+FDUP = 0x400
+FSUPPLEMENTARY = 0x800
+
+def write_picard_metrics(
+    path: str,
+    program: str,
+    metrics_class: str,
+    rows: List[Dict[str, object]],
+    *,
+    columns: List[str],
+    histogram: Optional[List[tuple]] = None,
+    histogram_header: Optional[List[str]] = None,
+    input_path: Optional[str] = None,
+) -> None:
+    """
+    Write a metrics file in Picard's layout so MultiQC and
+    qc._parse_picard_markdup read it exactly like the JVM output.
+    """
+    def _fmt(v):
+        if v is None:
+            return ""
+        if isinstance(v, float):
+            return f"{v:.6f}"
+        return str(v)
+
+    with open(path, "w") as f:
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write(f"# {program} INPUT={input_path or ''} OUTPUT={path}\n")
+        f.write("## htsjdk.samtools.metrics.StringHeader\n")
+        f.write(f"# Started on: {datetime.datetime.now().strftime('%a %b %d %H:%M:%S %Y')}\n")
+        f.write("\n")
+        f.write(f"## METRICS CLASS\t{metrics_class}\n")
+        f.write("\t".join(columns) + "\n")
+        for row in rows:
+            f.write("\t".join(_fmt(row.get(c)) for c in columns) + "\n")
+        f.write("\n")
+        if histogram:
+            f.write("## HISTOGRAM\tjava.lang.Double\n")
+            f.write("\t".join(histogram_header or ["BIN", "VALUE"]) + "\n")
+            for entry in histogram:
+                f.write("\t".join(_fmt(v) for v in entry) + "\n")
+            f.write("\n")
+
+class Accumulator:
+    """
+    Base class for a per-record statistic.
+
+    start() is called with the BAM header before the pass, add() once per
+    record, and write() after the pass has finished. merge() adds another
+    accumulator's counts (from a shard of the same BAM) to this one.
+    """
+
+    def start(self, header) -> None:
+        pass
+
+    def add(self, read) -> None:
+        raise NotImplementedError
+
+    def merge(self, other: "Accumulator") -> None:
+        raise NotImplementedError
+
+    def write(self, path: str) -> None:
+        raise NotImplementedError
+
+class FragmentLengthHistogram(Accumulator):
+    """
+    Histogram of positive TLEN values (one count per pair, like awk '$9>0').
+
+    Lengths up to max_length live in a fixed-size list; the rare longer
+    (discordant) TLENs go to an overflow dict so the output stays exact.
+    """
+
+    def __init__(self, max_length: int = 2000):
+        self.max_length = max_length
+        self.counts = [0] * (max_length + 1)
+        self.overflow: Dict[int, int] = {}
+
+    def add(self, read) -> None:
+        tlen = read.template_length
+        if tlen <= 0:
+            return
+        if tlen <= self.max_length:
+            self.counts[tlen] += 1
+        else:
+            self.overflow[tlen] = self.overflow.get(tlen, 0) + 1
+
+    def merge(self, other: "FragmentLengthHistogram") -> None:
+        self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+        for length, n in other.overflow.items():
+            self.overflow[length] = self.overflow.get(length, 0) + n
+
+    def items(self):
+        """(length, count) pairs with non-zero count, in length order."""
+        for length, n in enumerate(self.counts):
+            if n:
+                yield length, n
+        for length in sorted(self.overflow):
+            yield length, self.overflow[length]
+
+    def to_array(self):
+        """Fixed-bin uint64 array (steps.fraglen layout)."""
+        return fraglen.from_pairs(self.items())
+
+    def write_array(self, path: str) -> None:
+        fraglen.save(path, self.to_array())
+
+    def write(self, path: str) -> None:
+        # same "count length" layout as uniq -c | sort -k2,2n | sed 's/^[ \t]*//'
+        with open(path, "w") as f:
+            for length, n in self.items():
+                f.write(f"{n} {length}\n")
+
+class ContigCounts(Accumulator):
+    """Per-contig mapped/unmapped counts in samtools idxstats layout."""
+
+    def start(self, header) -> None:
+        self.names = list(header.references)
+        self.lengths = list(header.lengths)
+        self.mapped = [0] * len(self.names)
+        self.unmapped = [0] * len(self.names)
+        self.unplaced = 0
+
+    def add(self, read) -> None:
+        tid = read.reference_id
+        if tid < 0:
+            self.unplaced += 1
+        elif read.flag & FUNMAP:
+            self.unmapped[tid] += 1
+        else:
+            self.mapped[tid] += 1
+
+    def merge(self, other: "ContigCounts") -> None:
+        self.mapped = [a + b for a, b in zip(self.mapped, other.mapped)]
+        self.unmapped = [a + b for a, b in zip(self.unmapped, other.unmapped)]
+        self.unplaced += other.unplaced
+
+    def write(self, path: str) -> None:
+        with open(path, "w") as f:
+            for name, length, m, u in zip(self.names, self.lengths, self.mapped, self.unmapped):
+                f.write(f"{name}\t{length}\t{m}\t{u}\n")
+            f.write(f"*\t0\t0\t{self.unplaced}\n")
+
+class FlagstatCounts(Accumulator):
+    """Counts in samtools flagstat layout (QC-passed + QC-failed columns)."""
+
+    _FIELDS = [
+        "total", "primary", "secondary", "supplementary", "duplicates",
+        "primary_duplicates", "mapped", "primary_mapped", "paired", "read1",
+        "read2", "properly_paired", "both_mapped", "singletons",
+        "mate_diff_chr", "mate_diff_chr_mapq5",
+    ]
+
+    def __init__(self):
+        # index 0 = QC-passed, 1 = QC-failed
+        self.counts = {k: [0, 0] for k in self._FIELDS}
+
+    def add(self, read) -> None:
+        flag = read.flag
+        c = self.counts
+        i = 1 if flag & FQCFAIL else 0
+
+        c["total"][i] += 1
+        if flag & FSECONDARY:
+            c["secondary"][i] += 1
+        elif flag & FSUPPLEMENTARY:
+            c["supplementary"][i] += 1
+        else:
+            c["primary"][i] += 1
+            if flag & FDUP:
+                c["primary_duplicates"][i] += 1
+            if not flag & FUNMAP:
+                c["primary_mapped"][i] += 1
+            if flag & FPAIRED:
+                c["paired"][i] += 1
+                if flag & FREAD1:
+                    c["read1"][i] += 1
+                if flag & FREAD2:
+                    c["read2"][i] += 1
+                if not flag & FUNMAP:
+                    if flag & FPROPER_PAIR:
+                        c["properly_paired"][i] += 1
+                    if flag & FMUNMAP:
+                        c["singletons"][i] += 1
+                    else:
+                        c["both_mapped"][i] += 1
+                        if read.reference_id != read.next_reference_id:
+                            c["mate_diff_chr"][i] += 1
+                            if read.mapping_quality >= 5:
+                                c["mate_diff_chr_mapq5"][i] += 1
+        if flag & FDUP:
+            c["duplicates"][i] += 1
+        if not flag & FUNMAP:
+            c["mapped"][i] += 1
+
+    def merge(self, other: "FlagstatCounts") -> None:
+        for k, (p, f) in other.counts.items():
+            self.counts[k][0] += p
+            self.counts[k][1] += f
+
+    def write(self, path: str) -> None:
+        c = self.counts
+
+        def _pct(num, den):
+            return f"{100.0 * num / den:.2f}%" if den else "N/A"
+
+        def _line(key, label, den_key=None):
+            p, f = c[key]
+            if den_key is None:
+                return f"{p} + {f} {label}\n"
+            return f"{p} + {f} {label} ({_pct(p, c[den_key][0])} : {_pct(f, c[den_key][1])})\n"
+
+        with open(path, "w") as out:
+            out.write(_line("total", "in total (QC-passed reads + QC-failed reads)"))
+            out.write(_line("primary", "primary"))
+            out.write(_line("secondary", "secondary"))
+            out.write(_line("supplementary", "supplementary"))
+            out.write(_line("duplicates", "duplicates"))
+            out.write(_line("primary_duplicates", "primary duplicates"))
+            out.write(_line("mapped", "mapped", "total"))
+            out.write(_line("primary_mapped", "primary mapped", "primary"))
+            out.write(_line("paired", "paired in sequencing"))
+            out.write(_line("read1", "read1"))
+            out.write(_line("read2", "read2"))
+            out.write(_line("properly_paired", "properly paired", "paired"))
+            out.write(_line("both_mapped", "with itself and mate mapped"))
+            out.write(_line("singletons", "singletons", "paired"))
+            out.write(_line("mate_diff_chr", "with mate mapped to a different chr"))
+            out.write(_line("mate_diff_chr_mapq5", "with mate mapped to a different chr (mapQ>=5)"))
+
+class AlignmentSummary(Accumulator):
+    """
+    Picard CollectAlignmentSummaryMetrics fields that can be derived from the
+    records alone (no reference needed): read/aligned/HQ counts and bases,
+    NM-based mismatch rate, indel rate, pairing, strand balance and chimeras.
+    Only primary records are counted, as Picard does.
+    """
+
+    COLUMNS = [
+        "CATEGORY", "TOTAL_READS", "PF_READS", "PCT_PF_READS", "PF_NOISE_READS",
+        "PF_READS_ALIGNED", "PCT_PF_READS_ALIGNED", "PF_ALIGNED_BASES",
+        "PF_HQ_ALIGNED_READS", "PF_HQ_ALIGNED_BASES", "PF_MISMATCH_RATE",
+        "PF_INDEL_RATE", "MEAN_READ_LENGTH", "READS_ALIGNED_IN_PAIRS",
+        "PCT_READS_ALIGNED_IN_PAIRS", "PF_READS_IMPROPER_PAIRS",
+        "PCT_PF_READS_IMPROPER_PAIRS", "STRAND_BALANCE", "PCT_CHIMERAS",
+        "SAMPLE", "LIBRARY", "READ_GROUP",
+    ]
+
+    _KEYS = [
+        "total", "pf", "aligned", "aligned_bases", "hq_reads", "hq_bases",
+        "mismatches", "indels", "read_bases", "in_pairs", "improper",
+        "forward", "chimeras",
+    ]
+
+    def __init__(self, min_hq_mapq: int = 20, max_insert_size: int = 100000, input_path: Optional[str] = None):
+        self.min_hq_mapq = min_hq_mapq
+        self.max_insert_size = max_insert_size
+        self.input_path = input_path
+        self.stats = {cat: dict.fromkeys(self._KEYS, 0) for cat in ("FIRST_OF_PAIR", "SECOND_OF_PAIR", "UNPAIRED")}
+
+    def add(self, read) -> None:
+        flag = read.flag
+        if flag & (FSECONDARY | FSUPPLEMENTARY):
+            return
+
+        if flag & FPAIRED:
+            s = self.stats["FIRST_OF_PAIR" if flag & FREAD1 else "SECOND_OF_PAIR"]
+        else:
+            s = self.stats["UNPAIRED"]
+
+        s["total"] += 1
+        if flag & FQCFAIL:
+            return
+        s["pf"] += 1
+        s["read_bases"] += read.infer_read_length() or 0
+
+        if flag & FUNMAP:
+            return
+        s["aligned"] += 1
+
+        aligned = 0
+        indel_bases = 0
+        indel_events = 0
+        for op, length in read.cigartuples or ():
+            if op in (0, 7, 8):        # M, =, X
+                aligned += length
+            elif op in (1, 2):         # I, D
+                indel_bases += length
+                indel_events += 1
+        s["aligned_bases"] += aligned
+        s["indels"] += indel_events
+        if read.has_tag("NM"):
+            s["mismatches"] += max(0, read.get_tag("NM") - indel_bases)
+
+        if read.mapping_quality >= self.min_hq_mapq:
+            s["hq_reads"] += 1
+            s["hq_bases"] += aligned
+
+        if not flag & FREVERSE:
+            s["forward"] += 1
+
+        if flag & FPAIRED and not flag & FMUNMAP:
+            s["in_pairs"] += 1
+            if not flag & FPROPER_PAIR:
+                s["improper"] += 1
+            if read.reference_id != read.next_reference_id or abs(read.template_length) > self.max_insert_size:
+                s["chimeras"] += 1
+
+    def merge(self, other: "AlignmentSummary") -> None:
+        for cat, values in other.stats.items():
+            for k, v in values.items():
+                self.stats[cat][k] += v
+
+    def _row(self, category: str, s: dict) -> dict:
+        def _div(a, b):
+            return a / b if b else 0.0
+
+        return {
+            "CATEGORY": category,
+            "TOTAL_READS": s["total"],
+            "PF_READS": s["pf"],
+            "PCT_PF_READS": _div(s["pf"], s["total"]),
+            "PF_NOISE_READS": 0,
+            "PF_READS_ALIGNED": s["aligned"],
+            "PCT_PF_READS_ALIGNED": _div(s["aligned"], s["pf"]),
+            "PF_ALIGNED_BASES": s["aligned_bases"],
+            "PF_HQ_ALIGNED_READS": s["hq_reads"],
+            "PF_HQ_ALIGNED_BASES": s["hq_bases"],
+            "PF_MISMATCH_RATE": _div(s["mismatches"], s["aligned_bases"]),
+            "PF_INDEL_RATE": _div(s["indels"], s["aligned_bases"]),
+            "MEAN_READ_LENGTH": _div(s["read_bases"], s["pf"]),
+            "READS_ALIGNED_IN_PAIRS": s["in_pairs"],
+            "PCT_READS_ALIGNED_IN_PAIRS": _div(s["in_pairs"], s["aligned"]),
+            "PF_READS_IMPROPER_PAIRS": s["improper"],
+            "PCT_PF_READS_IMPROPER_PAIRS": _div(s["improper"], s["aligned"]),
+            "STRAND_BALANCE": _div(s["forward"], s["aligned"]),
+            "PCT_CHIMERAS": _div(s["chimeras"], s["in_pairs"]),
+        }
+
+    def rows(self) -> List[dict]:
+        rows = []
+        paired = [c for c in ("FIRST_OF_PAIR", "SECOND_OF_PAIR") if self.stats[c]["total"]]
+        for cat in paired:
+            rows.append(self._row(cat, self.stats[cat]))
+        if paired:
+            pair = {k: sum(self.stats[c][k] for c in paired) for k in self._KEYS}
+            rows.append(self._row("PAIR", pair))
+        if self.stats["UNPAIRED"]["total"]:
+            rows.append(self._row("UNPAIRED", self.stats["UNPAIRED"]))
+        return rows
+
+    def write(self, path: str) -> None:
+        write_picard_metrics(
+            path,
+            "picard.analysis.CollectAlignmentSummaryMetrics",
+            "picard.analysis.AlignmentSummaryMetrics",
+            self.rows(),
+            columns=self.COLUMNS,
+            input_path=self.input_path,
+        )
+
+def _collect_shard(shard, *, bam_path: str, accumulators: List[Accumulator]):
+    """(accumulators fed with one shard's records, record count); unplaced reads when shard is None."""
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        for acc in accumulators:
+            acc.start(bam.header)
+        adders = [acc.add for acc in accumulators]
+        n = 0
+        reads = bam.fetch("*") if shard is None else shards.fetch(bam, shard)
+        for read in reads:
+            for add in adders:
+                add(read)
+            n += 1
+    return accumulators, n
+
+def collect_bam_stats(bam_path: str, accumulators: List[Accumulator], *, threads: int = 1) -> List[Accumulator]:
+    """
+    Decode bam_path once (in file order, unmapped reads included) and feed
+    every record to each accumulator. An indexed BAM with threads > 1 is
+    read as shards (steps/shards.py) in parallel and the per-shard
+    accumulators are merged.
+    """
+    with pysam.AlignmentFile(bam_path, "rb", threads=max(1, threads)) as bam:
+        for acc in accumulators:
+            acc.start(bam.header)
+        indexed = bam.has_index()
+
+        if threads > 1 and indexed:
+            plan = shards.plan(bam_path, include_unmapped=True)
+            shards.log_plan("bamstats", plan, threads)
+            # fresh (pickled) copies of the accumulators go to each shard
+            results = shards.run(_collect_shard, plan + [None], threads=threads,
+                                 bam_path=bam_path, accumulators=accumulators)
+            n = 0
+            for parts, count in results:
+                for acc, part in zip(accumulators, parts):
+                    acc.merge(part)
+                n += count
+        else:
+            adders = [acc.add for acc in accumulators]
+            n = 0
+            for read in bam.fetch(until_eof=True):
+                for add in adders:
+                    add(read)
+                n += 1
+
+    logging.info(f"bamstats: {n} records from {os.path.basename(bam_path)}")
+    return accumulators
+
+def write_dedup_stats(
+    bam_path: str,
+    *,
+    align_metrics: str,
+    idxstats_out: str,
+    fraglen_out: str,
+    fraglen_npy: Optional[str] = None,
+    flagstat_out: Optional[str] = None,
+    threads: int = 1,
+) -> None:
+    """
+    One pass over the dedup BAM producing the files dedup_QC_alignments
+    used to get from Picard, samtools idxstats and the fragment length chain
+    (plus the fixed-bin fragment length array, fraglen_npy).
+    """
+    fragments = FragmentLengthHistogram(max_length=fraglen.MAX_LENGTH)
+    outputs = [
+        (AlignmentSummary(input_path=bam_path), align_metrics),
+        (ContigCounts(), idxstats_out),
+        (fragments, fraglen_out),
+    ]
+    if flagstat_out:
+        outputs.append((FlagstatCounts(), flagstat_out))
+
+    collect_bam_stats(bam_path, [acc for acc, _ in outputs], threads=threads)
+
+    for acc, path in outputs:
+        acc.write(path)
+    if fraglen_npy:
+        fragments.write_array(fraglen_npy)
+
+DUPLICATION_COLUMNS = [
+    "LIBRARY", "UNPAIRED_READS_EXAMINED", "READ_PAIRS_EXAMINED", "SECONDARY_OR_SUPPLEMENTARY_RDS",
+    "UNMAPPED_READS", "UNPAIRED_READ_DUPLICATES", "READ_PAIR_DUPLICATES", "READ_PAIR_OPTICAL_DUPLICATES",
+    "PERCENT_DUPLICATION", "ESTIMATED_LIBRARY_SIZE",
+]
+
+def read_markdup_stats(path: str) -> Dict[str, int]:
+    """`samtools markdup -s -f path` output as {"READ": n, "DUPLICATE PAIR": n, ...}."""
+    stats = {}
+    with open(path) as f:
+        for line in f:
+            key, sep, value = line.partition(":")
+            if not sep or key == "COMMAND":
+                continue
+            try:
+                stats[key.strip()] = int(value.strip())
+            except ValueError:
+                pass
+    return stats
+
+def write_markdup_metrics(
+    stats_path: str,
+    path: str,
+    *,
+    library: str,
+    unmapped: int = 0,
+    secondary_or_supplementary: int = 0,
+    input_path: Optional[str] = None,
+) -> None:
+    """
+    Convert samtools markdup statistics into Picard's DuplicationMetrics file
+    (what MarkDuplicates M= writes), so qc.run_qc and MultiQC read the
+    streaming mode's duplicate rate like Picard's.
+
+    samtools counts paired reads; Picard counts pairs.
+    """
+    s = read_markdup_stats(stats_path)
+    unpaired = s.get("SINGLE", 0)
+    pairs = s.get("PAIRED", 0) // 2
+    unpaired_dups = s.get("DUPLICATE SINGLE", 0)
+    pair_dups = s.get("DUPLICATE PAIR", 0) // 2
+    examined = unpaired + 2 * pairs
+    row = {
+        "LIBRARY": library,
+        "UNPAIRED_READS_EXAMINED": unpaired,
+        "READ_PAIRS_EXAMINED": pairs,
+        "SECONDARY_OR_SUPPLEMENTARY_RDS": secondary_or_supplementary,
+        "UNMAPPED_READS": unmapped,
+        "UNPAIRED_READ_DUPLICATES": unpaired_dups,
+        "READ_PAIR_DUPLICATES": pair_dups,
+        "READ_PAIR_OPTICAL_DUPLICATES": s.get("DUPLICATE PAIR OPTICAL", 0) // 2,
+        "PERCENT_DUPLICATION": (unpaired_dups + 2 * pair_dups) / examined if examined else 0.0,
+        "ESTIMATED_LIBRARY_SIZE": s.get("ESTIMATED_LIBRARY_SIZE") or None,
+    }
+    write_picard_metrics(
+        path,
+        "picard.sam.markduplicates.MarkDuplicates (samtools markdup)",
+        "picard.sam.DuplicationMetrics",
+        [row],
+        columns=DUPLICATION_COLUMNS,
+        input_path=input_path,
+    )
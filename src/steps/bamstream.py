@@ -0,0 +1,114 @@
+########################################
+# fused align -> markdup -> filter stream
+#
+# bowtie2 | samtools fixmate -m | samtools sort | samtools markdup -r is read
+# back here as uncompressed BAM; the stream is the same set of records the
+# dedup BAM used to hold, so the dedup statistics are collected from it and
+# the filtered BAM is written from it directly. neither the aligned nor the
+# dedup BAM is ever written.
+########################################
+
+import os
+import logging
+from typing import List, Optional
+
+from steps import fraglen
+from steps.bamio import BamPipeReader, IndexedBamWriter
+from steps.bamfilter import ReadFilter
+from steps.bamstats import (
+    AlignmentSummary, ContigCounts, FlagstatCounts, FragmentLengthHistogram, write_markdup_metrics,
+)
+
+# per-thread memory for samtools sort (default; scheduled tasks get resources.apply's sort_mem)
+SORT_MEM = "768M"
+
+def markdup_commands(
+    align_cmd: List[str],
+    *,
+    markdup_stats: str,
+    tmp_prefix: str,
+    threads: int = 1,
+    sort_mem: str = SORT_MEM,
+) -> List[List[str]]:
+    """The aligner followed by fixmate / sort / markdup, all uncompressed between stages."""
+    t = str(max(1, threads))
+    return [
+        align_cmd,
+        ["samtools", "fixmate", "-m", "-u", "-@", t, "-", "-"],
+        ["samtools", "sort", "-u", "-@", t, "-m", sort_mem, "-T", tmp_prefix + ".sort", "-"],
+        ["samtools", "markdup", "-r", "-s", "-f", markdup_stats, "-u", "-@", t,
+         "-T", tmp_prefix + ".markdup", "-", "-"],
+    ]
+
+def stream_dedup_filter(
+    cmds: List[List[str]],
+    out_bam: str,
+    *,
+    read_filter: ReadFilter,
+    markdup_stats: str,
+    markdup_metrics: str,
+    align_metrics: str,
+    idxstats_out: str,
+    fraglen_out: str,
+    fraglen_npy: Optional[str] = None,
+    flagstat_out: Optional[str] = None,
+    library: str = "",
+    threads: int = 1,
+    timeout: Optional[float] = None,
+) -> dict:
+    """
+    Run cmds (see markdup_commands), collect the dedup statistics over every
+    record of the stream and write the records passing read_filter to
+    out_bam (+ .bai). Returns the filter counts. A stream still running
+    after timeout seconds is stopped and raises.
+    """
+    flagstat = FlagstatCounts()
+    fragments = FragmentLengthHistogram(max_length=fraglen.MAX_LENGTH)
+    outputs = [
+        (AlignmentSummary(input_path=out_bam), align_metrics),
+        (ContigCounts(), idxstats_out),
+        (fragments, fraglen_out),
+        (flagstat, flagstat_out),
+    ]
+    accumulators = [acc for acc, _ in outputs]
+
+    # a stage dying part-way looks like end-of-input to the stages after
+    # it, so the filtered BAM is renamed into place only once the reader
+    # has seen every stage exit 0
+    out = None
+    try:
+        with BamPipeReader(cmds, threads=threads, timeout=timeout) as bam:
+            for acc in accumulators:
+                acc.start(bam.header)
+            adders = [acc.add for acc in accumulators]
+
+            with IndexedBamWriter(out_bam, bam.header, threads=threads, deferred=True) as out:
+                for read in bam:
+                    for add in adders:
+                        add(read)
+                    if read_filter(read):
+                        out.write(read)
+    except BaseException:
+        if out is not None:
+            out.discard()
+        raise
+    out.commit()
+
+    for acc, path in outputs:
+        if path:
+            acc.write(path)
+    if fraglen_npy:
+        fragments.write_array(fraglen_npy)
+
+    c = flagstat.counts
+    write_markdup_metrics(
+        markdup_stats,
+        markdup_metrics,
+        library=library,
+        unmapped=sum(c["primary"]) - sum(c["primary_mapped"]),
+        secondary_or_supplementary=sum(c["secondary"]) + sum(c["supplementary"]),
+        input_path=out_bam,
+    )
+    read_filter.log(out_bam)
+    logging.info(f"bamstream: {read_filter.counts['examined']} deduplicated records streamed into {os.path.basename(out_bam)}")
+    return read_filter.counts
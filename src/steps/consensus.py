@@ -0,0 +1,297 @@
+########################################
+# cohort consensus peaks and fragment-count matrix (consensus_peaks step)
+#
+# merges every sample's MACS3 narrowPeak into one peak set, then counts the
+# fragments of each filtered BAM over it:
+#   - summit: a fixed-width window around each summit; overlapping windows
+#     (from any sample) are resolved by keeping the strongest, where a
+#     peak's strength is its -log10(p) rank within its own sample, so deep
+#     and shallow libraries weigh the same
+#   - union: the merged union of all peak intervals (widths vary, and dense
+#     regions can chain into wide peaks)
+# peaks are held as one sorted array of genome-wide coordinates (contig index
+# in the high bits), so support, overlap and counting are all searchsorted
+# over sorted arrays. each BAM is read once, contig by contig through its
+# index (contigs without peaks are never read), one sample per process.
+#
+# outputs under consensus_dir (default {macs3_dir}/consensus):
+#   consensus_peaks.bed  peaks in matrix row order
+#   peaks.tsv            name, position, score, supporting samples, counts
+#   samples.tsv          matrix columns: fragments, fragments in peaks, FRiP
+#   counts.mtx.gz        peaks x samples fragment counts (Matrix Market)
+########################################
+
+import os
+import gzip
+import glob
+import logging
+import multiprocessing
+from array import array
+from functools import partial
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+CONSENSUS_MODES = ("summit", "union")
+# contig index << SHIFT | position; contigs are shorter than 2**SHIFT
+SHIFT = 33
+CHUNK = 500000
+
+def output_dir(Configuration) -> str:
+    return Configuration.consensus_dir or os.path.join(Configuration.macs3_dir, "consensus")
+
+def cohort_inputs(Configuration) -> List[Tuple[str, str, str]]:
+    """(sample, narrowPeak, filtered BAM) for every sample with both."""
+    found = []
+    for peaks in sorted(glob.glob(os.path.join(Configuration.macs3_dir, "*", "*_peaks.narrowPeak"))):
+        sample = os.path.basename(os.path.dirname(peaks))
+        if os.path.basename(peaks) != f"{sample}_peaks.narrowPeak":
+            continue
+        bam = os.path.join(Configuration.cleaned_alignments_dir, sample, f"{sample}_align_dedup_filtered.bam")
+        if os.path.exists(bam):
+            found.append((sample, peaks, bam))
+        else:
+            logging.warning(f"consensus: {sample} has peaks but no filtered BAM; left out")
+    return found
+
+def _read_narrowpeak(path: str, contigs: Dict[str, int]) -> Dict[str, np.ndarray]:
+    """Peaks on known contigs: contig index, start, end, summit position, -log10(p), within-sample rank."""
+    import pandas as pd
+
+    df = pd.read_csv(path, sep="\t", header=None, usecols=[0, 1, 2, 7, 9],
+                     names=["chrom", "start", "end", "pval", "summit"], dtype={0: str}, comment="#")
+    df = df[df["chrom"].isin(contigs)]
+    start = df["start"].to_numpy(np.int64)
+    end = df["end"].to_numpy(np.int64)
+    offset = df["summit"].to_numpy(np.int64)
+    pval = df["pval"].to_numpy(np.float64)
+    # 1 for the sample's strongest peak, down to 1/n
+    rank = np.empty(len(pval))
+    rank[np.argsort(pval, kind="stable")] = np.arange(1, len(pval) + 1) / max(1, len(pval))
+    return {
+        "tid": df["chrom"].map(contigs).to_numpy(np.int64),
+        "start": start,
+        "end": end,
+        # -1: no summit given, use the middle
+        "summit": np.where(offset >= 0, start + offset, (start + end) // 2),
+        "pval": pval,
+        "rank": rank,
+    }
+
+def _windows(peaks: dict, width: int, sizes: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Fixed-width summit windows, clipped to the contig."""
+    start = np.maximum(0, peaks["summit"] - width // 2)
+    end = np.minimum(sizes[peaks["tid"]], start + width)
+    return (peaks["tid"] << SHIFT) | start, (peaks["tid"] << SHIFT) | end
+
+def summit_consensus(key: np.ndarray, score: np.ndarray, tiebreak: np.ndarray, width: int) -> np.ndarray:
+    """
+    Indices of the windows kept by iterative overlap removal, in genome
+    order: walk windows from the highest score down, keeping each one that
+    overlaps no window kept so far. key is each window's genome-wide start
+    (all windows share one width, so two overlap when their starts differ by
+    less than it).
+
+    Done in rounds rather than one window at a time: the best window of each
+    cluster of overlapping windows is kept (no stronger window overlaps it),
+    every window overlapping a kept one is dropped, and the rest go round
+    again. Same result as the one-at-a-time walk, in a handful of passes.
+    Equal scores are ordered by tiebreak, then position.
+    """
+    remaining = np.argsort(key, kind="stable")
+    kept = []
+    while len(remaining):
+        k = key[remaining]
+        new = np.empty(len(k), dtype=bool)
+        new[0] = True
+        new[1:] = np.diff(k) >= width
+        cluster = np.cumsum(new) - 1
+        # by cluster, then score descending
+        order = np.lexsort((np.arange(len(k)), -tiebreak[remaining], -score[remaining], cluster))
+        best = remaining[order[np.flatnonzero(new)]]
+        kept.append(best)
+
+        kb = key[best]
+        i = np.searchsorted(kb, k)
+        near_right = (i < len(kb)) & (kb[np.minimum(i, len(kb) - 1)] - k < width)
+        near_left = (i > 0) & (k - kb[np.maximum(i - 1, 0)] < width)
+        remaining = remaining[~(near_right | near_left)]
+    if not kept:
+        return np.zeros(0, dtype=np.int64)
+    kept = np.concatenate(kept)
+    return kept[np.argsort(key[kept], kind="stable")]
+
+def union_consensus(starts: np.ndarray, ends: np.ndarray, score: np.ndarray):
+    """Merged union of genome-wide intervals: (starts, ends, best score of the merged peaks)."""
+    if len(starts) == 0:
+        return starts, ends, score
+    order = np.argsort(starts, kind="stable")
+    starts, ends, score = starts[order], ends[order], score[order]
+    running_end = np.maximum.accumulate(ends)
+    new = np.empty(len(starts), dtype=bool)
+    new[0] = True
+    new[1:] = starts[1:] >= running_end[:-1]
+    first = np.flatnonzero(new)
+    last = np.append(first[1:], len(starts)) - 1
+    return starts[first], running_end[last], np.maximum.reduceat(score, first)
+
+def _overlap_counts(p_start: np.ndarray, p_end: np.ndarray, q_start: np.ndarray, q_end: np.ndarray):
+    """
+    For sorted, disjoint peaks: how many of the query intervals overlap each
+    peak, and how many query intervals overlap any peak.
+    """
+    n = len(p_start)
+    # query i overlaps peaks lo[i] .. hi[i] - 1
+    lo = np.searchsorted(p_end, q_start, side="right")
+    hi = np.searchsorted(p_start, q_end, side="left")
+    hit = hi > lo
+    diff = np.bincount(lo[hit], minlength=n + 1) - np.bincount(hi[hit], minlength=n + 1)
+    return np.cumsum(diff)[:n], int(hit.sum())
+
+def count_fragments(bam_path: str, contigs: List[str], p_start: np.ndarray, p_end: np.ndarray) -> dict:
+    """
+    Fragments of one BAM overlapping each consensus peak, counted once per
+    pair (the mate with positive TLEN, as in frip's fragment mode). Only the
+    contigs holding peaks are read.
+    """
+    import pysam
+
+    n = len(p_start)
+    counts = np.zeros(n, dtype=np.int64)
+    in_peaks = 0
+    tids = (p_start >> SHIFT).astype(np.int64)
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        fragments = sum(s.mapped for s in bam.get_index_statistics()) // 2
+        for tid in np.unique(tids):
+            contig = contigs[tid]
+            if bam.get_tid(contig) < 0:
+                continue
+            base = int(tid) << SHIFT
+            starts, tlens = array("q"), array("q")
+
+            def _flush():
+                nonlocal in_peaks
+                if not starts:
+                    return
+                s = np.frombuffer(starts, dtype=np.int64) + base
+                e = s + np.frombuffer(tlens, dtype=np.int64)
+                c, hits = _overlap_counts(p_start, p_end, s, e)
+                counts[:] += c
+                in_peaks += hits
+                del starts[:], tlens[:]
+
+            for read in bam.fetch(contig):
+                tlen = read.template_length
+                if tlen <= 0:
+                    continue
+                starts.append(read.reference_start)
+                tlens.append(tlen)
+                if len(starts) >= CHUNK:
+                    _flush()
+            _flush()
+
+    nz = np.flatnonzero(counts)
+    return {"rows": nz.astype(np.int64), "values": counts[nz], "fragments": fragments, "in_peaks": in_peaks}
+
+def _count_sample(item, contigs, p_start, p_end):
+    sample, bam = item
+    result = count_fragments(bam, contigs, p_start, p_end)
+    logging.info(f"consensus: {sample} {result['in_peaks']}/{result['fragments']} fragments in peaks")
+    return result
+
+def write_mtx(path: str, n_rows: int, columns: List[dict]) -> None:
+    """Matrix Market coordinate file (1-based), column by column."""
+    nnz = sum(len(c["rows"]) for c in columns)
+    tmp = path + ".tmp"
+    with gzip.open(tmp, "wt", compresslevel=1) as f:
+        f.write("%%MatrixMarket matrix coordinate integer general\n")
+        f.write(f"{n_rows} {len(columns)} {nnz}\n")
+        for j, c in enumerate(columns, 1):
+            # one string per column: several times faster than np.savetxt
+            f.write("".join(f"{r} {j} {v}\n" for r, v in zip((c["rows"] + 1).tolist(), c["values"].tolist())))
+    os.replace(tmp, path)
+
+def run_consensus(Configuration):
+    """
+    Consensus peaks across every sample with peaks and a filtered BAM, and
+    their peaks x samples fragment-count matrix (see the module header).
+    """
+    import pysam
+    import pandas as pd
+
+    mode, width = Configuration.consensus_mode, int(Configuration.consensus_width)
+    if mode not in CONSENSUS_MODES:
+        raise ValueError(f"Unknown consensus_mode '{mode}' (expected one of {CONSENSUS_MODES})")
+    inputs = cohort_inputs(Configuration)
+    if not inputs:
+        logging.warning(f"consensus: no sample has both peaks under {Configuration.macs3_dir} and a filtered BAM")
+        return
+
+    with pysam.AlignmentFile(inputs[0][2], "rb") as bam:
+        contigs = list(bam.references)
+        sizes = np.asarray(bam.lengths, dtype=np.int64)
+    index = {c: i for i, c in enumerate(contigs)}
+
+    # every sample's peaks (summit windows or intervals), genome-wide coordinates
+    per_sample = []
+    for sample, peaks_path, _ in inputs:
+        p = _read_narrowpeak(peaks_path, index)
+        if mode == "summit":
+            s, e = _windows(p, width, sizes)
+        else:
+            s, e = (p["tid"] << SHIFT) | p["start"], (p["tid"] << SHIFT) | p["end"]
+        per_sample.append((s, e, p["rank"], p["pval"]))
+    all_s = np.concatenate([s for s, _, _, _ in per_sample])
+    all_e = np.concatenate([e for _, e, _, _ in per_sample])
+    all_rank = np.concatenate([r for _, _, r, _ in per_sample])
+
+    if mode == "summit":
+        # within-sample rank first, -log10(p) to break ties between samples
+        all_pval = np.concatenate([p for _, _, _, p in per_sample])
+        keep = summit_consensus(all_s, all_rank, all_pval, width)
+        p_start, p_end, p_score = all_s[keep], all_e[keep], all_rank[keep]
+    else:
+        p_start, p_end, p_score = union_consensus(all_s, all_e, all_rank)
+
+    support = np.zeros(len(p_start), dtype=np.int64)
+    for s, e, _, _ in per_sample:
+        support += _overlap_counts(p_start, p_end, s, e)[0] > 0
+    keep = support >= Configuration.consensus_min_samples
+    p_start, p_end, p_score, support = p_start[keep], p_end[keep], p_score[keep], support[keep]
+    logging.info(f"consensus ({mode}): {len(p_start)} peaks from {len(all_s)} in {len(inputs)} sample(s)")
+
+    items = [(sample, bam) for sample, _, bam in inputs]
+    call = partial(_count_sample, contigs=contigs, p_start=p_start, p_end=p_end)
+    workers = max(1, min(int(Configuration.threads), len(items)))
+    if workers == 1:
+        columns = [call(i) for i in items]
+    else:
+        with multiprocessing.get_context("fork").Pool(workers) as pool:
+            columns = pool.map(call, items, chunksize=1)
+
+    out_dir = output_dir(Configuration)
+    os.makedirs(out_dir, exist_ok=True)
+    mask = (1 << SHIFT) - 1
+    peaks = pd.DataFrame({
+        "name": [f"consensus_peak_{k}" for k in range(1, len(p_start) + 1)],
+        "chrom": [contigs[t] for t in (p_start >> SHIFT)],
+        "start": p_start & mask,
+        "end": p_end & mask,
+        "score": np.round(p_score, 6),
+        "n_samples": support,
+    })
+    totals = np.zeros(len(p_start), dtype=np.int64)
+    for c in columns:
+        totals[c["rows"]] += c["values"]
+    peaks["fragments"] = totals
+    peaks[["chrom", "start", "end", "name"]].to_csv(
+        os.path.join(out_dir, "consensus_peaks.bed"), sep="\t", header=False, index=False)
+    peaks.to_csv(os.path.join(out_dir, "peaks.tsv"), sep="\t", index=False)
+    pd.DataFrame({
+        "sample": [s for s, _ in items],
+        "fragments": [c["fragments"] for c in columns],
+        "fragments_in_peaks": [c["in_peaks"] for c in columns],
+        "frip": [c["in_peaks"] / c["fragments"] if c["fragments"] else None for c in columns],
+    }).to_csv(os.path.join(out_dir, "samples.tsv"), sep="\t", index=False)
+    write_mtx(os.path.join(out_dir, "counts.mtx.gz"), len(p_start), columns)
+    logging.info(f"consensus: {len(p_start)} peaks x {len(items)} samples written to {out_dir}")
@@ -1,7 +1,25 @@
 import os
 import logging
+from typing import Dict
 from steps.helpers import clean_dir, outputs_exist, run_cmd
 
+COVERAGE_ENGINES = ("bamcoverage", "native")
+
+def track_paths(Configuration, sample: str) -> Dict[str, str]:
+    """
+    {track: bigWig path}. bamCoverage writes only {sample}_coverage.bw; the
+    native engine writes the "raw" track there and every other track of
+    options.coverage_tracks to {sample}_coverage_{track}.bw.
+    """
+    out_dir = os.path.join(Configuration.coverages_dir, sample)
+    main = os.path.join(out_dir, f"{sample}_coverage.bw")
+    if getattr(Configuration, "coverage_engine", "bamcoverage") != "native":
+        return {"bamcoverage": main}
+    paths = {}
+    for track in Configuration.coverage_tracks:
+        paths[track] = main if track == "raw" else os.path.join(out_dir, f"{sample}_coverage_{track}.bw")
+    return paths
+
 def coverage(Configuration):
     logging.info("starting bamcoverage")
 
@@ -11,20 +29,42 @@ def coverage(Configuration):
     coverage_output_dir = os.path.join(Configuration.coverages_dir, sample)
     os.makedirs(coverage_output_dir, exist_ok=True)
 
-    coverage_output_file = os.path.join(coverage_output_dir, f"{sample}_coverage.bw")
+    engine = getattr(Configuration, "coverage_engine", "bamcoverage")
+    if engine not in COVERAGE_ENGINES:
+        raise ValueError(f"Unknown coverage_engine '{engine}' (expected one of {COVERAGE_ENGINES})")
+    out_paths = track_paths(Configuration, sample)
 
-    if (not Configuration.force) and outputs_exist([coverage_output_file]):
+    if (not Configuration.force) and outputs_exist(list(out_paths.values())):
         logging.info("coverage: output exists; skipping (use Configuration.force=True to overwrite)")
         return
 
     if Configuration.force:
         clean_dir(coverage_output_dir)
 
-    threads = str(getattr(Configuration, "threads", 4))
+    if engine == "native":
+        from steps import align, pileup
+        from steps.fragments import fragments_path
+
+        pileup.write_tracks(
+            filtered_align_file,
+            out_paths,
+            bin_size=Configuration.coverage_bin_size,
+            threads=Configuration.threads,
+            # options.fragments_input: the fragments file instead of the BAM's reads
+            fragments_path=fragments_path(Configuration, sample) if Configuration.fragments_input else None,
+            min_mapq=Configuration.min_mapq,
+            exclude_flags=align.FILTER_EXCLUDE_FLAGS,
+            require_flags=align.FILTER_REQUIRE_FLAGS,
+            effective_genome_size=getattr(Configuration, "effective_genome_size", None),
+        )
+        return
+
+    coverage_output_file = out_paths["bamcoverage"]
+    threads = str(Configuration.threads)
 
     run_cmd(
         f"bamCoverage -p {threads} -b {filtered_align_file} -of bigwig -o {coverage_output_file} "
         f"--samFlagInclude 2 --samFlagExclude 1804 --minMappingQuality 30",
         shell=True,
         check=True,
-    )
\ No newline at end of file
+    )
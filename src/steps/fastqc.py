@@ -26,7 +26,7 @@ def run_fastqc(Configuration, input_files, output_dir):
         logging.info(f"fastqc: outputs exist in {output_dir}; skipping (use --force to overwrite)")
         return
 
-    threads = str(getattr(Configuration, "threads", 8))
+    threads = str(Configuration.threads)
     cmd = ["fastqc", "-o", output_dir, "-t", threads] + input_files
     run_cmd(cmd, check=True)
 
@@ -0,0 +1,144 @@
+########################################
+# fixed-bin fragment length histograms
+#
+# one uint64 array per sample ({sample}_fragment_lengths.npy): bin i counts
+# fragments of length i for 0..MAX_LENGTH, the last bin counts everything
+# longer. cohort statistics and the figure work on the stacked
+# (samples x bins) matrix in one go.
+########################################
+
+import os
+from typing import Dict, Iterable, List, Tuple
+
+import numpy as np
+
+MAX_LENGTH = 2000
+N_BINS = MAX_LENGTH + 2   # 0..MAX_LENGTH, then > MAX_LENGTH
+
+# fragment classes, half-open [lo, hi) bp
+NFR = (0, 150)
+MONO = (150, 300)
+DI = (300, 500)
+
+# helical (~10.5 bp) periodicity is measured on sub-nucleosomal fragments
+PERIODICITY_RANGE = (40, 250)
+HELICAL_PERIOD = (10.0, 11.0)
+PERIOD_BAND = (5.0, 50.0)
+
+def from_pairs(pairs: Iterable[Tuple[int, int]]) -> np.ndarray:
+    """Fixed-bin array from (length, count) pairs."""
+    counts = np.zeros(N_BINS, dtype=np.uint64)
+    for length, n in pairs:
+        counts[min(int(length), MAX_LENGTH + 1)] += int(n)
+    return counts
+
+def from_fragments(path: str) -> np.ndarray:
+    """Fixed-bin array of the fragment lengths (TLEN) in a fragments file (steps/fragments.py)."""
+    from steps.fragments import iter_fragments, unshift
+
+    counts = np.zeros(N_BINS, dtype=np.uint64)
+    for _, starts, ends, _ in iter_fragments(path):
+        s, e = unshift(starts, ends)
+        counts += np.bincount(np.minimum(e - s, MAX_LENGTH + 1), minlength=N_BINS).astype(np.uint64)
+    return counts
+
+def save(path: str, counts: np.ndarray) -> None:
+    tmp = path + ".tmp.npy"
+    np.save(tmp, np.asarray(counts, dtype=np.uint64))
+    os.replace(tmp, path)
+
+def load(path: str) -> np.ndarray:
+    counts = np.load(path)
+    if counts.dtype != np.uint64 or counts.shape != (N_BINS,):
+        raise ValueError(f"{path}: expected uint64[{N_BINS}], found {counts.dtype}{list(counts.shape)}")
+    return counts
+
+def load_text(path: str) -> np.ndarray:
+    """Legacy "count length" text output (any leading whitespace)."""
+    pairs = []
+    with open(path) as f:
+        for line in f:
+            parts = line.split()
+            if len(parts) >= 2:
+                pairs.append((int(parts[1]), int(parts[0])))
+    return from_pairs(pairs)
+
+def stack(hists: List[np.ndarray]) -> np.ndarray:
+    """(samples x bins) uint64 matrix."""
+    if not hists:
+        return np.zeros((0, N_BINS), dtype=np.uint64)
+    return np.vstack(hists).astype(np.uint64, copy=False)
+
+def normalise(mat: np.ndarray) -> np.ndarray:
+    """Row-wise fractions (all-zero rows stay zero)."""
+    mat = mat.astype(np.float64)
+    totals = mat.sum(axis=1, keepdims=True)
+    return np.divide(mat, totals, out=np.zeros_like(mat), where=totals > 0)
+
+def _band(frac: np.ndarray, lo_hi: Tuple[int, int]) -> np.ndarray:
+    return frac[:, lo_hi[0]:lo_hi[1]].sum(axis=1)
+
+def periodicity_score(frac: np.ndarray) -> np.ndarray:
+    """
+    Share of the spectral power (periods 5-50 bp) that sits at the ~10.5 bp
+    helical period, after removing the smooth trend with a 21 bp moving
+    average. Higher means a clearer ladder in the sub-nucleosomal range.
+    """
+    lo, hi = PERIODICITY_RANGE
+    seg = frac[:, lo:hi]
+    window = 21
+    cs = np.cumsum(np.pad(seg, ((0, 0), (window // 2, window // 2)), mode="edge"), axis=1)
+    cs = np.concatenate([np.zeros((len(seg), 1)), cs], axis=1)
+    trend = (cs[:, window:] - cs[:, :-window]) / window
+    detrended = seg - trend
+
+    power = np.abs(np.fft.rfft(detrended, axis=1)) ** 2
+    freqs = np.fft.rfftfreq(seg.shape[1])
+    with np.errstate(divide="ignore"):
+        periods = np.where(freqs > 0, 1.0 / freqs, np.inf)
+    helical = (periods >= HELICAL_PERIOD[0]) & (periods <= HELICAL_PERIOD[1])
+    band = (periods >= PERIOD_BAND[0]) & (periods <= PERIOD_BAND[1])
+    total = power[:, band].sum(axis=1)
+    return np.divide(power[:, helical].sum(axis=1), total, out=np.zeros(len(seg)), where=total > 0)
+
+def summarise(mat: np.ndarray) -> Dict[str, np.ndarray]:
+    """Per-sample fragment statistics from the stacked matrix."""
+    frac = normalise(mat)
+    lengths = np.arange(N_BINS, dtype=np.float64)
+    lengths[-1] = MAX_LENGTH + 1
+    totals = mat.sum(axis=1).astype(np.float64)
+    nfr, mono, di = _band(frac, NFR), _band(frac, MONO), _band(frac, DI)
+    return {
+        "fragments": totals,
+        "median_fragment_length": np.argmax(np.cumsum(frac, axis=1) >= 0.5, axis=1),
+        "mean_fragment_length": (frac * lengths).sum(axis=1),
+        "nfr_fraction": nfr,
+        "mono_nucleosome_fraction": mono,
+        "di_nucleosome_fraction": di,
+        "nfr_mono_ratio": np.divide(nfr, mono, out=np.full(len(mat), np.nan), where=mono > 0),
+        "helical_periodicity_score": periodicity_score(frac),
+    }
+
+def plot_cohort(mat: np.ndarray, labels: List[str], out_png: str) -> None:
+    """All samples' normalised distributions in one figure (one plot call)."""
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    frac = normalise(mat)[:, 1:MAX_LENGTH + 1]
+    x = np.arange(1, MAX_LENGTH + 1)
+    fig, ax = plt.subplots()
+    if len(frac):
+        # zeros would be dropped by the log axis anyway
+        lines = ax.plot(x, np.where(frac > 0, frac, np.nan).T)
+        if len(labels) <= 20:
+            ax.legend(lines, labels, fontsize=6)
+    ax.set_xlim(1, 1000)
+    ax.set_ylim(1e-5, 1e-1)
+    ax.set_yscale("log")
+    ax.set_xlabel("fragment length (bp)")
+    ax.set_ylabel("fraction of fragments")
+    tmp = out_png + ".tmp.png"
+    fig.savefig(tmp)
+    plt.close(fig)
+    os.replace(tmp, out_png)
@@ -0,0 +1,169 @@
+########################################
+# fragments file ({sample}_fragments.tsv.gz)
+#
+# one line per deduplicated fragment of the filtered BAM, in the 10x /
+# ArchR / Signac layout: chrom, start, end, sample, duplicate count. start
+# and end are Tn5-adjusted (the fragment's leftmost base +4, its end -5), so
+# the two cut sites are start and end - 1. the file is BGZF-compressed in
+# genome order with a tabix index (.tbi), so single-cell tools and
+# `tabix` read it as is.
+#
+# the count column is the number of read pairs of the aligned BAM (before
+# duplicate removal, through the same filters) with the fragment's ends;
+# without the aligned BAM (options.streaming_alignment) it is 1.
+#
+# FRiP, fragment lengths, TSS enrichment and the native coverage tracks can
+# read this file instead of decoding the BAM again (options.fragments_input).
+# each BAM shard (steps/shards.py) is written by its own worker as BGZF
+# blocks, and the shards are joined in genome order without recompressing.
+########################################
+
+import os
+import logging
+from array import array
+from typing import Iterator, Optional, Tuple
+
+import numpy as np
+
+from steps import shards
+from steps.tsse import TN5_SHIFT_MINUS, TN5_SHIFT_PLUS
+
+SUFFIX = "_fragments.tsv.gz"
+
+def fragments_path(Configuration, sample: str) -> str:
+    return os.path.join(Configuration.cleaned_alignments_dir, sample, f"{sample}{SUFFIX}")
+
+def unshift(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """File coordinates -> the fragment's aligned span [leftmost start, start + TLEN)."""
+    return starts - TN5_SHIFT_PLUS, ends - TN5_SHIFT_MINUS
+
+def _fragment_keys(bam, shard, keep=None) -> np.ndarray:
+    """start << 32 | TLEN for the leftmost mate of every pair in the shard passing keep."""
+    keys = array("q")
+    for read in shards.fetch(bam, shard):
+        tlen = read.template_length
+        if tlen <= 0 or (keep is not None and not keep(read)):
+            continue
+        keys.append(read.reference_start << 32 | tlen)
+    return np.frombuffer(keys, dtype=np.int64)
+
+def _shard_worker(shard, *, bam_path: str, dup_bam: Optional[str], work: str, name: str,
+                  filter_args: dict) -> dict:
+    """Fragments starting in one shard, to a BGZF part file; returns counts."""
+    import pysam
+    from steps.bamfilter import ReadFilter
+
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        keys, counts = np.unique(_fragment_keys(bam, shard), return_counts=True)
+    pairs = int(counts.sum())
+    if dup_bam is not None and len(keys):
+        with pysam.AlignmentFile(dup_bam, "rb") as bam:
+            all_keys, all_counts = np.unique(_fragment_keys(bam, shard, ReadFilter(**filter_args)),
+                                             return_counts=True)
+        i = np.searchsorted(all_keys, keys)
+        found = i < len(all_keys)
+        found[found] = all_keys[i[found]] == keys[found]
+        counts[found] = np.maximum(counts[found], all_counts[i[found]])
+
+    starts = (keys >> 32) + TN5_SHIFT_PLUS
+    ends = np.maximum((keys >> 32) + (keys & 0xFFFFFFFF) + TN5_SHIFT_MINUS, starts + 1)
+    with pysam.BGZFile(os.path.join(work, shard.name + SUFFIX), "wb") as out:
+        out.write("".join(
+            f"{shard.contig}\t{s}\t{e}\t{name}\t{n}\n"
+            for s, e, n in zip(starts.tolist(), ends.tolist(), counts.tolist())
+        ).encode())
+    return {"fragments": len(keys), "pairs": pairs, "read_pairs": int(counts.sum())}
+
+def write_fragments(
+    bam_path: str,
+    out_path: str,
+    *,
+    name: str,
+    dup_bam: Optional[str] = None,
+    filter_args: Optional[dict] = None,
+    threads: int = 1,
+    tmp_dir: Optional[str] = None,
+) -> dict:
+    """
+    Fragments file of bam_path (indexed, coordinate-sorted) to out_path and
+    its tabix index (out_path + ".tbi"). With dup_bam (the BAM before
+    duplicate removal) and the filtered BAM's filter_args, the count column
+    holds the read pairs with each fragment's ends.
+    """
+    import pysam
+
+    plan = shards.plan(bam_path)
+    shards.log_plan("fragments", plan, threads)
+    tmp = out_path + ".tmp.gz"
+    with shards.workdir(out_path, tmp_dir) as work:
+        results = shards.run(_shard_worker, plan, threads=threads, bam_path=bam_path, dup_bam=dup_bam,
+                             work=work, name=name, filter_args=filter_args or {})
+        # BGZF files concatenate into one BGZF file
+        shards.concat_files([os.path.join(work, s.name + SUFFIX) for s in plan], tmp)
+    pysam.tabix_index(tmp, preset="bed", force=True, keep_original=True)
+    os.replace(tmp + ".tbi", out_path + ".tbi")
+    os.replace(tmp, out_path)
+
+    counts = shards.sum_counts(results)
+    logging.info(
+        f"fragments: {os.path.basename(out_path)} {counts.get('fragments', 0)} fragments"
+        + (f" from {counts.get('read_pairs', 0)} read pairs before dedup" if dup_bam else "")
+    )
+    return counts
+
+def iter_fragments(path: str, *, chunk_size: int = 2_000_000) -> Iterator[Tuple[str, np.ndarray, np.ndarray, np.ndarray]]:
+    """
+    (chrom, starts, ends, counts) in file order and coordinates (Tn5-adjusted),
+    a chromosome at a time within chunks of chunk_size lines.
+    """
+    import pandas as pd
+
+    reader = pd.read_csv(path, sep="\t", header=None, comment="#", usecols=[0, 1, 2, 4],
+                         names=["chrom", "start", "end", "name", "count"],
+                         dtype={"chrom": str, "start": np.int64, "end": np.int64, "count": np.int64},
+                         chunksize=chunk_size)
+    for chunk in reader:
+        chroms = chunk["chrom"].to_numpy()
+        starts = chunk["start"].to_numpy()
+        ends = chunk["end"].to_numpy()
+        counts = chunk["count"].to_numpy()
+        # the file is grouped by chromosome: split the chunk where it changes
+        edges = np.flatnonzero(chroms[1:] != chroms[:-1]) + 1
+        for lo, hi in zip(np.r_[0, edges], np.r_[edges, len(chroms)]):
+            yield chroms[lo], starts[lo:hi], ends[lo:hi], counts[lo:hi]
+
+def run_fragments(Configuration):
+    """
+    {cleaned_alignments_dir}/{sample}/{sample}_fragments.tsv.gz (+ .tbi) from
+    the filtered BAM, with duplicate counts from the aligned BAM when it is
+    there.
+    """
+    from steps.align import _filter_options
+    from steps.helpers import outputs_exist
+
+    sample = Configuration.file_to_process
+    bam_file = os.path.join(Configuration.cleaned_alignments_dir, sample, f"{sample}_align_dedup_filtered.bam")
+    if not os.path.exists(bam_file):
+        raise FileNotFoundError(f"Fragments input BAM not found: {bam_file}")
+
+    out_path = fragments_path(Configuration, sample)
+    if (not Configuration.force) and outputs_exist([out_path, out_path + ".tbi"]):
+        logging.info("fragments: outputs exist; skipping (use --force to overwrite)")
+        return
+
+    dup_bam = None
+    if not Configuration.streaming_alignment:
+        dup_bam = os.path.join(Configuration.aligned_dir, sample, f"{sample}_align.bam")
+        if not os.path.exists(dup_bam + ".bai"):
+            logging.warning(f"fragments: {dup_bam} (+ .bai) not found; duplicate counts left at 1")
+            dup_bam = None
+
+    write_fragments(
+        bam_file,
+        out_path,
+        name=sample,
+        dup_bam=dup_bam,
+        filter_args=_filter_options(Configuration) if dup_bam else None,
+        threads=Configuration.threads,
+        tmp_dir=os.environ.get("TMPDIR"),
+    )
@@ -0,0 +1,230 @@
+########################################
+# QC gates (options.qc_gates)
+#
+# cheap checks between the steps of a sample, so a failed library stops
+# before the expensive ones:
+#   - trimming: fastp JSON (share of reads passing, pairs left)
+#   - align:    aligned BAM index (mapping rate, chrM fraction)
+#   - dedup:    DuplicationMetrics / idxstats (duplication, unique pairs,
+#               library size, chrM fraction after dedup)
+# each rule compares one metric with a min / max and names an action:
+#   flag  - record the reason, carry on
+#   cheap - skip the steps in cheap_skip (coverage, Tn5 shift, ATACseqQC, ...)
+#   halt  - skip everything left for the sample
+# a gate step writes {logs_dir}/{sample}/{sample}_qc_gate_{gate}.json (logs_dir:
+# align_qc empties the sample's QC directory when it reruns); the scheduler
+# reads the decision when the step finishes (pipeline.Step.decision). the
+# outcome goes into the sample's QC metrics: qc_status, qc_reasons and the
+# gate metrics; a halted sample gets a metrics row of its own.
+########################################
+
+import os
+import json
+import logging
+from typing import Dict, List, Optional, Set, Tuple
+
+RECORD = "{logs_dir}/{sample}/{sample}_qc_gate_{gate}.json"
+
+GATES = ("trimming", "align", "dedup")
+ACTIONS = ("flag", "cheap", "halt")    # in increasing severity
+METRICS = {
+    "trimming": ("reads_before", "reads_after", "passing_fraction", "pairs"),
+    "align": ("mapped_reads", "mapping_rate", "mito_fraction"),
+    "dedup": ("pairs", "duplication", "unique_pairs", "estimated_library_size", "mito_fraction"),
+}
+MITO_CONTIGS = ("chrM", "MT", "M")
+
+# options.qc_gates: true
+DEFAULT_RULES = {
+    "trimming": [
+        {"metric": "passing_fraction", "min": 0.5, "action": "halt"},
+        {"metric": "pairs", "min": 1_000_000, "action": "flag"},
+    ],
+    "align": [
+        {"metric": "mapping_rate", "min": 0.5, "action": "halt"},
+        {"metric": "mito_fraction", "max": 0.8, "action": "halt"},
+        {"metric": "mito_fraction", "max": 0.5, "action": "flag"},
+    ],
+    "dedup": [
+        {"metric": "duplication", "max": 0.8, "action": "cheap"},
+        {"metric": "duplication", "max": 0.5, "action": "flag"},
+        {"metric": "unique_pairs", "min": 2_000_000, "action": "cheap"},
+    ],
+}
+# steps a "cheap" decision skips (options.qc_gates.cheap_skip)
+CHEAP_SKIP = ["fastqc_after_trimming", "coverage", "tn5shift", "ATACseqQC"]
+
+def rules(Configuration) -> Dict[str, List[dict]]:
+    """The configured rules per gate ({} when gates are off), validated."""
+    spec = getattr(Configuration, "qc_gates", None)
+    if not spec:
+        return {}
+    if spec is True:
+        spec = DEFAULT_RULES
+    out = {}
+    for gate, gate_rules in spec.items():
+        if gate == "cheap_skip":
+            continue
+        if gate not in GATES:
+            raise ValueError(f"qc_gates: unknown gate {gate!r} (expected one of {GATES})")
+        for r in gate_rules or []:
+            if r.get("metric") not in METRICS[gate]:
+                raise ValueError(f"qc_gates.{gate}: unknown metric {r.get('metric')!r} (expected one of {METRICS[gate]})")
+            if r.get("action", "flag") not in ACTIONS:
+                raise ValueError(f"qc_gates.{gate}: unknown action {r.get('action')!r} (expected one of {ACTIONS})")
+            if "min" not in r and "max" not in r:
+                raise ValueError(f"qc_gates.{gate}: rule for {r['metric']} needs a min or a max")
+        if gate_rules:
+            out[gate] = [dict(r, action=r.get("action", "flag")) for r in gate_rules]
+    return out
+
+def cheap_skip(Configuration) -> List[str]:
+    spec = getattr(Configuration, "qc_gates", None)
+    if isinstance(spec, dict) and spec.get("cheap_skip") is not None:
+        return list(spec["cheap_skip"])
+    return list(CHEAP_SKIP)
+
+def record_path(Configuration, sample: str, gate: str) -> str:
+    return RECORD.format(logs_dir=Configuration.logs_dir, sample=sample, gate=gate)
+
+def _fmt(v) -> str:
+    return str(int(v)) if float(v).is_integer() else f"{v:.4g}"
+
+def evaluate(gate_rules: List[dict], metrics: Dict[str, Optional[float]]) -> Tuple[str, List[str]]:
+    """(status, reasons): the most severe action among the failed rules, or "pass"."""
+    status, reasons = "pass", []
+    for r in gate_rules:
+        value = metrics.get(r["metric"])
+        if value is None:
+            continue
+        if "min" in r and value < r["min"]:
+            reasons.append(f"{r['metric']} {_fmt(value)} < {_fmt(r['min'])} ({r['action']})")
+        elif "max" in r and value > r["max"]:
+            reasons.append(f"{r['metric']} {_fmt(value)} > {_fmt(r['max'])} ({r['action']})")
+        else:
+            continue
+        if status == "pass" or ACTIONS.index(r["action"]) > ACTIONS.index(status):
+            status = r["action"]
+    return status, reasons
+
+def _run_gate(Configuration, gate: str, metrics: Dict[str, Optional[float]]) -> None:
+    sample = Configuration.file_to_process
+    status, reasons = evaluate(rules(Configuration).get(gate, []), metrics)
+    record = {"gate": gate, "status": status, "reasons": reasons, "metrics": metrics}
+    # the later gates' records describe an earlier run of this sample
+    for later in GATES[GATES.index(gate) + 1:]:
+        if os.path.exists(record_path(Configuration, sample, later)):
+            os.remove(record_path(Configuration, sample, later))
+    path = record_path(Configuration, sample, gate)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, "w") as f:
+        json.dump(record, f, indent=2)
+
+    log = logging.info if status == "pass" else logging.warning
+    log(f"qc gate {gate}: {sample} {status}" + (f" ({'; '.join(reasons)})" if reasons else ""))
+    if status == "halt":
+        _record_halt(Configuration, sample)
+
+def _load(Configuration, sample: str, gate: str) -> Optional[dict]:
+    path = record_path(Configuration, sample, gate)
+    if not os.path.exists(path):
+        return None
+    with open(path) as f:
+        return json.load(f)
+
+def decision(Configuration, sample: str, gate: str) -> Tuple[str, Optional[Set[str]]]:
+    """
+    For the scheduler, once gate has run: (status, steps to skip). halt
+    skips every remaining step (None), cheap the cheap_skip steps.
+    """
+    record = _load(Configuration, sample, gate)
+    status = record["status"] if record else "pass"
+    if status == "halt":
+        return status, None
+    if status == "cheap":
+        return status, set(cheap_skip(Configuration))
+    return status, set()
+
+def qc_columns(Configuration, sample: str) -> Dict[str, object]:
+    """qc_status (the worst gate outcome), qc_reasons and every gate metric, for the QC metrics row."""
+    records = [r for r in (_load(Configuration, sample, g) for g in rules(Configuration)) if r]
+    if not records:
+        return {}
+    order = ("pass",) + ACTIONS
+    columns = {
+        "qc_status": max((r["status"] for r in records), key=order.index),
+        "qc_reasons": "; ".join(f"{r['gate']}: {reason}" for r in records for reason in r["reasons"]),
+    }
+    for r in records:
+        for k, v in r["metrics"].items():
+            columns[f"{r['gate']}_{k}"] = v
+    return columns
+
+def _record_halt(Configuration, sample: str) -> None:
+    """A halted sample never reaches qc: write its QC metrics row from the gates."""
+    import pandas as pd
+    from steps import qcstore
+
+    metrics = dict(sample=sample, **qc_columns(Configuration, sample))
+    qc_dir = os.path.join(Configuration.other_qc_dir, sample)
+    os.makedirs(qc_dir, exist_ok=True)
+    pd.DataFrame([metrics]).to_csv(os.path.join(qc_dir, f"{sample}_qc_metrics.tsv"), sep="\t", index=False)
+    qcstore.upsert_sample(Configuration, sample, metrics, qcstore.sample_fragments(qc_dir, sample))
+
+def gate_trimming(Configuration):
+    """Gate on the fastp JSON: share of reads passing the filters, read pairs left."""
+    sample = Configuration.file_to_process
+    with open(os.path.join(Configuration.Reads_quality_dir, sample, f"{sample}.fastp.json")) as f:
+        summary = json.load(f)["summary"]
+    before = summary["before_filtering"]["total_reads"]
+    after = summary["after_filtering"]["total_reads"]
+    _run_gate(Configuration, "trimming", {
+        "reads_before": before,
+        "reads_after": after,
+        "passing_fraction": after / before if before else None,
+        "pairs": after // 2,
+    })
+
+def gate_align(Configuration):
+    """Gate on the aligned BAM's index: mapping rate and chrM fraction, without reading the BAM."""
+    import pysam
+
+    sample = Configuration.file_to_process
+    bam_path = os.path.join(Configuration.aligned_dir, sample, f"{sample}_align.bam")
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        stats = bam.get_index_statistics()
+        unplaced = bam.nocoordinate
+    mapped = sum(s.mapped for s in stats)
+    total = mapped + sum(s.unmapped for s in stats) + unplaced
+    mito = sum(s.mapped for s in stats if s.contig in MITO_CONTIGS)
+    _run_gate(Configuration, "align", {
+        "mapped_reads": mapped,
+        "mapping_rate": mapped / total if total else None,
+        "mito_fraction": mito / mapped if mapped else None,
+    })
+
+def gate_dedup(Configuration):
+    """Gate on the duplicate metrics and the deduplicated idxstats."""
+    from steps.qc import _parse_picard_markdup, _read_idxstats
+
+    sample = Configuration.file_to_process
+    qc_dir = os.path.join(Configuration.other_qc_dir, sample)
+    md = _parse_picard_markdup(os.path.join(qc_dir, f"{sample}_markdup_qc.txt"))
+
+    def _number(key):
+        try:
+            return float(md[key])
+        except (KeyError, ValueError):
+            return None
+
+    pairs, pair_dups = _number("READ_PAIRS_EXAMINED"), _number("READ_PAIR_DUPLICATES")
+    idx_rows = _read_idxstats(os.path.join(qc_dir, f"{sample}_idxstats.txt")) or []
+    mapped = sum(r["mapped"] for r in idx_rows)
+    mito = sum(r["mapped"] for r in idx_rows if r["rname"] in MITO_CONTIGS)
+    _run_gate(Configuration, "dedup", {
+        "pairs": pairs,
+        "duplication": _number("PERCENT_DUPLICATION"),
+        "unique_pairs": pairs - pair_dups if pairs is not None and pair_dups is not None else None,
+        "estimated_library_size": _number("ESTIMATED_LIBRARY_SIZE"),
+        "mito_fraction": mito / mapped if mapped else None,
+    })
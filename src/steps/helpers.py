@@ -1,9 +1,21 @@
 import os
+import json
+import time
+import hashlib
+import fcntl
 import shutil
+import socket
 import logging
+import resource
 import subprocess
+from contextlib import contextmanager
 from typing import List, Union, Optional
 
+# where run_cmd / run_pipe records go; set per task by profile_step()
+_profile = {"sample": None, "step": None, "timeline": None}
+
+_hash_memo = {}
+
 def clean_dir(dir_path: str) -> None:
     """
     Delete contents of a directory (not the directory itself).
@@ -30,6 +42,114 @@ def outputs_exist(paths: List[str]) -> bool:
             return False
     return True
 
+def sha256_file(path: str) -> str:
+    """Content hash of a file (memoised per process on size + mtime)."""
+    st = os.stat(path)
+    memo_key = (path, st.st_size, st.st_mtime_ns)
+    if memo_key not in _hash_memo:
+        h = hashlib.sha256()
+        with open(path, "rb") as f:
+            for block in iter(lambda: f.read(1 << 20), b""):
+                h.update(block)
+        _hash_memo[memo_key] = h.hexdigest()
+    return _hash_memo[memo_key]
+
+def timeline_path(Configuration, sample: str) -> str:
+    """Per-sample JSONL timeline written by run_cmd / run_pipe / profile_step."""
+    return os.path.join(Configuration.logs_dir, sample, f"{sample}_timeline.jsonl")
+
+def _read_proc_io(pid) -> dict:
+    """I/O counters from /proc/<pid>/io (empty if unavailable)."""
+    try:
+        with open(f"/proc/{pid}/io") as f:
+            fields = dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return {}
+    return {k: int(fields[k]) for k in ("rchar", "wchar", "read_bytes", "write_bytes") if k in fields}
+
+def _record(entry: dict) -> None:
+    path = _profile["timeline"]
+    if not path:
+        return
+    entry.update(sample=_profile["sample"], step=_profile["step"], host=socket.gethostname())
+    line = json.dumps(entry, sort_keys=True) + "\n"
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, "a") as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            f.write(line)
+    except OSError as e:
+        logging.warning(f"could not write timeline entry to {path}: {e}")
+
+def wait_profiled(proc: subprocess.Popen, label: str, start: float) -> int:
+    """
+    Reap proc and record its wall time, CPU, max RSS (wait4) and I/O
+    (/proc/<pid>/io, read while the child is a zombie). Usage covers the
+    child and everything it reaped, so shell pipelines are counted in full.
+    Returns the exit code (also stored on proc.returncode).
+    """
+    io = {}
+    try:
+        os.waitid(os.P_PID, proc.pid, os.WEXITED | os.WNOWAIT)
+        io = _read_proc_io(proc.pid)
+    except (AttributeError, ChildProcessError):
+        pass
+    _, status, ru = os.wait4(proc.pid, 0)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+
+    end = time.time()
+    _record({
+        "kind": "cmd",
+        "label": label,
+        "start": start,
+        "end": end,
+        "wall_s": round(end - start, 3),
+        "user_s": round(ru.ru_utime, 3),
+        "sys_s": round(ru.ru_stime, 3),
+        "max_rss_kb": ru.ru_maxrss,
+        "returncode": proc.returncode,
+        **io,
+    })
+    return proc.returncode
+
+@contextmanager
+def profile_step(Configuration, step: str):
+    """
+    Tag every command run inside the block with (sample, step) and add one
+    "step" record for the whole block, including in-process work (pysam
+    engines). Meant to be used once per task process.
+    """
+    sample = Configuration.file_to_process
+    _profile.update(
+        sample=sample,
+        step=step,
+        timeline=timeline_path(Configuration, sample or "cohort"),
+    )
+
+    start = time.time()
+    ru0 = [resource.getrusage(w) for w in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+    io0 = _read_proc_io("self")
+    status = "failed"
+    try:
+        yield
+        status = "ok"
+    finally:
+        ru1 = [resource.getrusage(w) for w in (resource.RUSAGE_SELF, resource.RUSAGE_CHILDREN)]
+        io1 = _read_proc_io("self")
+        end = time.time()
+        _record({
+            "kind": "step",
+            "label": step,
+            "start": start,
+            "end": end,
+            "wall_s": round(end - start, 3),
+            "user_s": round(sum(b.ru_utime - a.ru_utime for a, b in zip(ru0, ru1)), 3),
+            "sys_s": round(sum(b.ru_stime - a.ru_stime for a, b in zip(ru0, ru1)), 3),
+            "max_rss_kb": max(r.ru_maxrss for r in ru1),
+            "status": status,
+            **{k: io1[k] - io0.get(k, 0) for k in io1},
+        })
+
 def run_cmd(
     cmd: Union[List[str], str],
     *,
@@ -38,39 +158,44 @@ def run_cmd(
     cwd: Optional[str] = None,
     env: Optional[dict] = None,
 ) -> subprocess.CompletedProcess:
+    """
+    Run a command (list, or string with shell=True under bash) and record its
+    resource usage in the sample timeline.
+    """
     printable = " ".join(cmd) if isinstance(cmd, list) else cmd
     logging.info(f"CMD: {printable}")
 
-    if shell:
-        return subprocess.run(
-            cmd,
-            shell=True,
-            executable="/bin/bash",
-            check=check,
-            cwd=cwd,
-            env=env,
-        )
+    start = time.time()
+    proc = subprocess.Popen(
+        cmd,
+        shell=shell,
+        executable="/bin/bash" if shell else None,
+        cwd=cwd,
+        env=env,
+    )
+    try:
+        rc = wait_profiled(proc, printable, start)
+    except BaseException:
+        proc.kill()
+        raise
 
-    return subprocess.run(cmd, shell=False, check=check, cwd=cwd, env=env)
+    if check and rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+    return subprocess.CompletedProcess(cmd, rc)
 
 def run_pipe(
     cmd1: List[str],
     cmd2: List[str],
     *,
     check: bool = True,
+    timeout: Optional[float] = None,
 ) -> None:
     """
-    Run cmd1 | cmd2, and fail if either side fails.
-    Ensures cmd1 stdout is closed on the parent side to avoid deadlocks.
+    Run cmd1 | cmd2, and fail if either side fails or both are still running
+    after timeout seconds (steps.procpipe, which also takes longer chains,
+    redirections and atomic outputs). Both sides are recorded in the sample
+    timeline.
     """
-    logging.info(f"PIPE: {' '.join(cmd1)} | {' '.join(cmd2)}")
-    p1 = subprocess.Popen(cmd1, stdout=subprocess.PIPE)
-    p2 = subprocess.Popen(cmd2, stdin=p1.stdout)
-    if p1.stdout is not None:
-        p1.stdout.close()
-
-    p2_rc = p2.wait()
-    p1_rc = p1.wait()
+    from steps.procpipe import run_pipeline
 
-    if check and (p1_rc != 0 or p2_rc != 0):
-        raise RuntimeError(f"Pipe failed: cmd1_rc={p1_rc}, cmd2_rc={p2_rc}")
\ No newline at end of file
+    run_pipeline([cmd1, cmd2], check=check, timeout=timeout)
@@ -0,0 +1,173 @@
+########################################
+# in-memory sorted interval index
+#
+# per-chromosome merged, half-open [start, end) intervals held as sorted
+# numpy arrays. used for blacklist subtraction and region overlap tests
+# instead of bedtools/pybedtools temp files.
+########################################
+
+import os
+import gzip
+import json
+from typing import Dict, Iterable, Optional, Tuple
+
+import numpy as np
+
+def _open_text(path: str):
+    if path.endswith(".gz"):
+        return gzip.open(path, "rt")
+    return open(path)
+
+def _merge(starts: np.ndarray, ends: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """Sort and merge overlapping or book-ended intervals."""
+    if len(starts) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0, dtype=np.int64)
+
+    order = np.argsort(starts, kind="stable")
+    starts = starts[order]
+    ends = ends[order]
+
+    # a new block starts where the start is past every end seen so far
+    running_end = np.maximum.accumulate(ends)
+    new_block = np.empty(len(starts), dtype=bool)
+    new_block[0] = True
+    new_block[1:] = starts[1:] > running_end[:-1]
+
+    block_id = np.cumsum(new_block) - 1
+    merged_starts = starts[new_block]
+    merged_ends = np.zeros(len(merged_starts), dtype=np.int64)
+    np.maximum.at(merged_ends, block_id, ends)
+    return merged_starts, merged_ends
+
+class IntervalSet:
+    """
+    Merged, sorted intervals per chromosome.
+
+    Supports single queries (overlaps), vectorised queries over many
+    intervals of one chromosome (overlaps_many), and a monotone sweep for
+    coordinate-sorted input (sweeper).
+    """
+
+    def __init__(self, chroms: Dict[str, Tuple[np.ndarray, np.ndarray]]):
+        self.chroms = chroms
+
+    @classmethod
+    def from_intervals(cls, intervals: Iterable[Tuple[str, int, int]]) -> "IntervalSet":
+        raw: Dict[str, Tuple[list, list]] = {}
+        for chrom, start, end in intervals:
+            s, e = raw.setdefault(chrom, ([], []))
+            s.append(start)
+            e.append(end)
+        return cls({
+            c: _merge(np.asarray(s, dtype=np.int64), np.asarray(e, dtype=np.int64))
+            for c, (s, e) in raw.items()
+        })
+
+    @classmethod
+    def from_bed(
+        cls,
+        path: str,
+        *,
+        slop: int = 0,
+        chrom_sizes: Optional[Dict[str, int]] = None,
+    ) -> "IntervalSet":
+        """
+        Load a BED / BED.GZ file. slop widens both sides (bedtools slop -b),
+        clipped to chrom_sizes when given.
+        """
+        def _iter():
+            with _open_text(path) as f:
+                for line in f:
+                    if not line.strip() or line.startswith(("#", "track", "browser")):
+                        continue
+                    parts = line.split("\t")
+                    chrom, start, end = parts[0], int(parts[1]), int(parts[2])
+                    if slop:
+                        start = max(0, start - slop)
+                        end = end + slop
+                        if chrom_sizes is not None and chrom in chrom_sizes:
+                            end = min(end, chrom_sizes[chrom])
+                    yield chrom, start, end
+
+        return cls.from_intervals(_iter())
+
+    def save(self, directory: str) -> None:
+        """
+        Write as two flat int64 arrays (starts.npy, ends.npy, chromosomes
+        back to back) plus chroms.json with each chromosome's [lo, hi) slice.
+        """
+        os.makedirs(directory, exist_ok=True)
+        names = sorted(self.chroms)
+        offsets, lo = {}, 0
+        for c in names:
+            hi = lo + len(self.chroms[c][0])
+            offsets[c] = [lo, hi]
+            lo = hi
+        empty = np.zeros(0, dtype=np.int64)
+        np.save(os.path.join(directory, "starts.npy"),
+                np.concatenate([self.chroms[c][0] for c in names] or [empty]).astype(np.int64))
+        np.save(os.path.join(directory, "ends.npy"),
+                np.concatenate([self.chroms[c][1] for c in names] or [empty]).astype(np.int64))
+        with open(os.path.join(directory, "chroms.json"), "w") as f:
+            json.dump(offsets, f)
+
+    @classmethod
+    def load(cls, directory: str, *, mmap: bool = True) -> "IntervalSet":
+        """Read a save()d set; with mmap the arrays are mapped, not read."""
+        mode = "r" if mmap else None
+        starts = np.load(os.path.join(directory, "starts.npy"), mmap_mode=mode)
+        ends = np.load(os.path.join(directory, "ends.npy"), mmap_mode=mode)
+        with open(os.path.join(directory, "chroms.json")) as f:
+            offsets = json.load(f)
+        return cls({c: (starts[lo:hi], ends[lo:hi]) for c, (lo, hi) in offsets.items()})
+
+    def __len__(self) -> int:
+        return sum(len(s) for s, _ in self.chroms.values())
+
+    def total_length(self) -> int:
+        return int(sum((e - s).sum() for s, e in self.chroms.values()))
+
+    def overlaps(self, chrom: str, start: int, end: int) -> bool:
+        """True if [start, end) overlaps any interval by at least 1 bp."""
+        iv = self.chroms.get(chrom)
+        if iv is None:
+            return False
+        starts, ends = iv
+        i = int(np.searchsorted(ends, start, side="right"))
+        return i < len(starts) and starts[i] < end
+
+    def overlaps_many(self, chrom: str, starts: np.ndarray, ends: np.ndarray) -> np.ndarray:
+        """Vectorised overlaps() for many query intervals on one chromosome."""
+        iv = self.chroms.get(chrom)
+        if iv is None or len(iv[0]) == 0:
+            return np.zeros(len(starts), dtype=bool)
+        iv_starts, iv_ends = iv
+        # first merged interval whose end lies past the query start
+        i = np.searchsorted(iv_ends, starts, side="right")
+        hit = i < len(iv_starts)
+        hit[hit] = iv_starts[i[hit]] < ends[hit]
+        return hit
+
+    def sweeper(self, chrom: str):
+        """
+        Return overlaps(start, end) for queries arriving in non-decreasing
+        start order (a coordinate-sorted BAM). The cursor only moves forward,
+        so a whole contig costs O(reads + intervals).
+        """
+        iv = self.chroms.get(chrom)
+        if iv is None or len(iv[0]) == 0:
+            return lambda start, end: False
+
+        starts = iv[0].tolist()
+        ends = iv[1].tolist()
+        n = len(starts)
+        cursor = [0]
+
+        def _overlaps(start: int, end: int) -> bool:
+            j = cursor[0]
+            while j < n and ends[j] <= start:
+                j += 1
+            cursor[0] = j
+            return j < n and starts[j] < end
+
+        return _overlaps
@@ -0,0 +1,484 @@
+########################################
+# native duplicate marking (options.markdup_engine: native)
+#
+# stands in for Picard MarkDuplicates in align_qc, without the JVM:
+#   - pass 1 streams the coordinate-sorted BAM. a pair is keyed on its
+#     library and both unclipped 5' ends (contig, position, strand); reads
+#     without a mapped mate are keyed on their own end. within a duplicate
+#     set the pair with the highest sum of base qualities (>= 15) is kept,
+#     as in Picard. a first mate waits in `pending` until its mate arrives,
+#     and a duplicate set stays open until the stream has moved past every
+#     position its members can start at, so memory holds the sets of about
+#     one fragment length of genome, not the whole BAM. every duplicate
+#     record is keyed on (contig, start, read name); the keys are spilled
+#     to sorted chunk files in a scratch directory every SPILL keys
+#   - pass 2 merges the chunks in coordinate order alongside the BAM and
+#     writes it without (REMOVE_DUPLICATES) or with flagged duplicates,
+#     plus its index. an unmapped mate sits at its mate's position and is
+#     dropped with it; secondary and supplementary records are not marked
+#     (bowtie2 writes none for the pairs it reports)
+#   - the DuplicationMetrics file is in Picard's layout (qc.py, MultiQC),
+#     with the duplicate set size histogram
+#   - the same histogram gives a preseq-style complexity curve: expected
+#     distinct pairs when sequencing less (exact interpolation) or more
+#     (rational approximation of the Good-Toulmin series) of the library
+# optical duplicates are not told apart (READ_PAIR_OPTICAL_DUPLICATES is 0).
+########################################
+
+import os
+import math
+import heapq
+import logging
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from steps.bamstats import (
+    DUPLICATION_COLUMNS, FDUP, FMUNMAP, FPAIRED, FREVERSE, FSECONDARY, FSUPPLEMENTARY, FUNMAP,
+    write_picard_metrics,
+)
+
+# Picard's default for the SUM_OF_BASE_QUALITIES scoring strategy
+MIN_SCORE_QUALITY = 15
+# complexity curve: folds of the sequenced depth, and the Pade degrees tried (highest first)
+COMPLEXITY_FOLDS = [round(0.1 * i, 1) for i in range(1, 10)] + list(range(1, 11)) + [15, 20, 30, 50, 100]
+MAX_PADE_DEGREE = 6
+# duplicate keys held in memory before they are spilled as a sorted chunk
+SPILL = 1_000_000
+
+class DuplicateStats:
+    """Counters and the duplicate set size histogram of one marking pass."""
+
+    def __init__(self):
+        self.unpaired = 0
+        self.pairs = 0
+        self.secondary_or_supplementary = 0
+        self.unmapped = 0
+        self.unpaired_duplicates = 0
+        self.pair_duplicates = 0
+        # duplicate set size -> number of sets (pairs; fragments when there are no pairs)
+        self.pair_sets: Dict[int, int] = {}
+        self.fragment_sets: Dict[int, int] = {}
+
+    @property
+    def set_sizes(self) -> Dict[int, int]:
+        return self.pair_sets if self.pairs else self.fragment_sets
+
+    def percent_duplication(self) -> float:
+        examined = self.unpaired + 2 * self.pairs
+        return (self.unpaired_duplicates + 2 * self.pair_duplicates) / examined if examined else 0.0
+
+class DuplicateKeys:
+    """(contig, start, read name) of the duplicate records, in sorted chunk files under work_dir."""
+
+    def __init__(self, work_dir: str):
+        self.work_dir = work_dir
+        self.chunks: List[str] = []
+        self._buffer: List[Tuple[int, int, str]] = []
+
+    def add(self, keys) -> None:
+        self._buffer.extend(keys)
+        if len(self._buffer) >= SPILL:
+            self.spill()
+
+    def spill(self) -> None:
+        if not self._buffer:
+            return
+        self._buffer.sort()
+        path = os.path.join(self.work_dir, f"duplicates.{len(self.chunks)}.tsv")
+        with open(path, "w") as f:
+            f.writelines(f"{tid}\t{pos}\t{name}\n" for tid, pos, name in self._buffer)
+        self.chunks.append(path)
+        self._buffer.clear()
+
+    def __iter__(self) -> Iterator[Tuple[int, int, str]]:
+        """Every key, in coordinate order."""
+        self.spill()
+        files = [open(path) for path in self.chunks]
+        try:
+            yield from heapq.merge(*(map(_parse_key, f) for f in files))
+        finally:
+            for f in files:
+                f.close()
+
+def _parse_key(line: str) -> Tuple[int, int, str]:
+    tid, pos, name = line.rstrip("\n").split("\t")
+    return int(tid), int(pos), name
+
+def _clip(op_len) -> int:
+    return op_len[1] if op_len[0] in (4, 5) else 0
+
+def _five_prime(read) -> Tuple[int, int, bool]:
+    """(contig, unclipped 5' position, reverse) of a mapped read."""
+    cigar = read.cigartuples
+    if read.flag & FREVERSE:
+        clip = _clip(cigar[-1]) + (_clip(cigar[-2]) if len(cigar) > 1 and cigar[-1][0] == 5 else 0)
+        return read.reference_id, read.reference_end - 1 + clip, True
+    clip = _clip(cigar[0]) + (_clip(cigar[1]) if len(cigar) > 1 and cigar[0][0] == 5 else 0)
+    return read.reference_id, read.reference_start - clip, False
+
+# base quality -> its contribution to the score (0 below MIN_SCORE_QUALITY)
+_SCORE_TABLE = bytes(q if q >= MIN_SCORE_QUALITY else 0 for q in range(256))
+
+def _score(read) -> int:
+    q = read.query_qualities
+    return sum(bytes(q).translate(_SCORE_TABLE)) if q is not None else 0
+
+def _libraries(header) -> Dict[str, str]:
+    """Read group ID -> library (LB), as Picard groups duplicates."""
+    return {rg["ID"]: rg.get("LB", "Unknown Library") for rg in header.to_dict().get("RG", [])}
+
+def find_duplicates(bam_path: str, work_dir: str, *, threads: int = 1) -> Tuple[DuplicateKeys, DuplicateStats]:
+    """
+    Pass 1: (DuplicateKeys spilled under work_dir, DuplicateStats).
+    Needs a coordinate-sorted BAM.
+    """
+    import pysam
+
+    stats = DuplicateStats()
+    dups = DuplicateKeys(work_dir)
+    pending = {}            # read name -> (end, score, library, key) of the first mate seen
+    pending_heap = []       # (mate contig, mate start, name)
+    pairs = {}              # key -> [set size, best score, best record keys]
+    pair_heap = []          # (contig, position of the later end, key)
+    fragments = {}          # (library, end) -> [set size, best score, best record keys, paired reads with this end]
+    fragment_heap = []
+    margin = 0              # longest read seen: how far a record can start from its 5' end
+
+    def fragment_group(lib, end):
+        key = (lib, end)
+        group = fragments.get(key)
+        if group is None:
+            group = fragments[key] = [0, -1, None, 0]
+            heapq.heappush(fragment_heap, (end[0], end[1], key))
+        return group
+
+    def add_fragment(lib, end, score, records):
+        group = fragment_group(lib, end)
+        group[0] += 1
+        if group[2] is None:
+            group[1], group[2] = score, records
+            return
+        stats.unpaired_duplicates += 1
+        if score > group[1]:
+            dups.add(group[2])
+            group[1], group[2] = score, records
+        else:
+            dups.add(records)
+
+    def add_pair(lib, end1, end2, score, records):
+        a, b = (end1, end2) if end1 <= end2 else (end2, end1)
+        key = (lib, a, b)
+        stats.pairs += 1
+        group = pairs.get(key)
+        if group is None:
+            pairs[key] = [1, score, records]
+            heapq.heappush(pair_heap, (b[0], b[1], key))
+            return
+        group[0] += 1
+        stats.pair_duplicates += 1
+        if score > group[1]:
+            dups.add(group[2])
+            group[1], group[2] = score, records
+        else:
+            dups.add(records)
+
+    def orphan(name):
+        end, score, lib, key = pending.pop(name)
+        group = fragments.get((lib, end))
+        if group is not None:
+            group[3] -= 1
+        stats.unpaired += 1
+        add_fragment(lib, end, score, (key,))
+
+    def flush(tid, pos):
+        """Close everything the stream at (tid, pos) has moved past."""
+        while pending_heap and (pending_heap[0][0], pending_heap[0][1]) < (tid, pos):
+            _, _, name = heapq.heappop(pending_heap)
+            if name in pending:
+                orphan(name)
+        while pair_heap and (pair_heap[0][0], pair_heap[0][1]) < (tid, pos - margin):
+            size = pairs.pop(heapq.heappop(pair_heap)[2])[0]
+            stats.pair_sets[size] = stats.pair_sets.get(size, 0) + 1
+        while fragment_heap and (fragment_heap[0][0], fragment_heap[0][1]) < (tid, pos - margin):
+            size, _, best, has_pair = fragments.pop(heapq.heappop(fragment_heap)[2])
+            if has_pair > 0 and best is not None:
+                # fragments sharing an end with a pair are all duplicates
+                dups.add(best)
+                stats.unpaired_duplicates += 1
+            if size:
+                stats.fragment_sets[size] = stats.fragment_sets.get(size, 0) + 1
+
+    with pysam.AlignmentFile(bam_path, "rb", threads=max(1, threads)) as bam:
+        libraries = _libraries(bam.header)
+        single_library = len(set(libraries.values())) <= 1
+        default_lib = next(iter(libraries.values()), "Unknown Library")
+        last = (-1, -1)
+        for read in bam.fetch(until_eof=True):
+            flag = read.flag
+            if flag & (FSECONDARY | FSUPPLEMENTARY):
+                stats.secondary_or_supplementary += 1
+                continue
+            if flag & FUNMAP:
+                stats.unmapped += 1
+                continue
+            tid, start = read.reference_id, read.reference_start
+            if (tid, start) < last:
+                raise ValueError(f"{bam_path} is not coordinate-sorted (at {read.query_name})")
+            if (tid, start) != last:
+                flush(tid, start)
+                last = (tid, start)
+            margin = max(margin, read.query_length)
+
+            lib = default_lib if single_library else libraries.get(
+                read.get_tag("RG") if read.has_tag("RG") else None, default_lib)
+            end = _five_prime(read)
+            score = _score(read)
+            name = read.query_name
+            key = (tid, start, name)
+
+            if not (flag & FPAIRED) or flag & FMUNMAP:
+                stats.unpaired += 1
+                add_fragment(lib, end, score, (key,))
+                continue
+            mate = pending.pop(name, None)
+            if mate is None and (read.next_reference_id, read.next_reference_start) < (tid, start):
+                # the mate should have come first: it is missing from the BAM
+                stats.unpaired += 1
+                add_fragment(lib, end, score, (key,))
+                continue
+            fragment_group(lib, end)[3] += 1
+            if mate is not None:
+                add_pair(lib, mate[0], end, mate[1] + score, (mate[3], key))
+            else:
+                pending[name] = (end, score, lib, key)
+                heapq.heappush(pending_heap, (read.next_reference_id, read.next_reference_start, name))
+
+    for name in list(pending):
+        orphan(name)
+    margin = 0
+    flush(float("inf"), float("inf"))
+    dups.spill()
+    return dups, stats
+
+def write_marked(bam_path: str, out_bam: str, duplicates: DuplicateKeys, *, remove: bool = True, threads: int = 1) -> int:
+    """
+    Pass 2: copy bam_path without (remove) or with flagged duplicates, and
+    index it. Written under procpipe.partial_path and renamed once indexed.
+    Returns records dropped.
+    """
+    import pysam
+    from steps.procpipe import partial_path
+
+    dropped = 0
+    tmp_bam, tmp_bai = partial_path(out_bam), partial_path(out_bam + ".bai")
+    keys = iter(duplicates)
+    upcoming = next(keys, None)
+    here, names = None, set()
+
+    try:
+        with pysam.AlignmentFile(bam_path, "rb", threads=max(1, threads)) as bam, \
+                pysam.AlignmentFile(tmp_bam, "wb", template=bam, threads=max(1, threads)) as out:
+            for read in bam.fetch(until_eof=True):
+                tid, start = read.reference_id, read.reference_start
+                if tid >= 0 and (tid, start) != here:
+                    # the names of the duplicates at this position
+                    here, names = (tid, start), set()
+                    while upcoming is not None and upcoming[:2] < here:
+                        upcoming = next(keys, None)
+                    while upcoming is not None and upcoming[:2] == here:
+                        names.add(upcoming[2])
+                        upcoming = next(keys, None)
+                dup = tid >= 0 and read.query_name in names
+                if dup and remove:
+                    dropped += 1
+                    continue
+                read.flag = (read.flag | FDUP) if dup else (read.flag & ~FDUP)
+                out.write(read)
+        pysam.index(tmp_bam, tmp_bai)
+    except BaseException:
+        for p in (tmp_bam, tmp_bai):
+            if os.path.exists(p):
+                os.remove(p)
+        raise
+    os.replace(tmp_bam, out_bam)
+    os.replace(tmp_bai, out_bam + ".bai")
+    return dropped
+
+def estimate_library_size(pairs: int, unique: int) -> Optional[float]:
+    """
+    Picard's library size estimate: the L with unique / L = 1 - exp(-pairs / L),
+    by bisection. None when there are no duplicates to fit.
+    """
+    if pairs <= 0 or unique <= 0 or unique >= pairs:
+        return None
+
+    def f(x):
+        return unique / x - 1 + math.exp(-pairs / x)
+
+    lo, hi = 1.0, 100.0
+    if f(lo * unique) < 0:
+        return None
+    while f(hi * unique) > 0:
+        hi *= 10
+    for _ in range(60):
+        mid = (lo + hi) / 2
+        if f(mid * unique) > 0:
+            lo = mid
+        else:
+            hi = mid
+    return unique * (lo + hi) / 2
+
+def _pade(counts: List[float], degree: int):
+    """
+    Numerator / denominator coefficients (lowest first) of the [degree-1/degree]
+    Pade approximant of sum_i counts[i] t^i, or None when it does not exist.
+    """
+    import numpy as np
+
+    if len(counts) < 2 * degree:
+        return None
+    a = np.asarray(counts[:2 * degree], dtype=float)
+    system = np.array([[a[i - j] if i >= j else 0.0 for j in range(1, degree + 1)] for i in range(degree, 2 * degree)])
+    try:
+        q = np.linalg.solve(system, -a[degree:2 * degree])
+    except np.linalg.LinAlgError:
+        return None
+    den = np.concatenate([[1.0], q])
+    num = np.array([sum(den[j] * a[i - j] for j in range(i + 1)) for i in range(degree)])
+    return num, den
+
+def complexity_curve(set_sizes: Dict[int, int], folds: Optional[List[float]] = None) -> List[dict]:
+    """
+    Expected distinct fragments against depth, from n_j = number of duplicate
+    sets of size j (preseq c_curve / lc_extrap):
+
+    - fold <= 1: exact expectation when sampling that share of the reads,
+      sum_j n_j (1 - (1 - fold)^j)
+    - fold > 1: distinct + G(fold - 1) with the Good-Toulmin series
+      G(t) = sum_j (-1)^(j+1) n_j t^j, summed through its Pade approximant
+      of the highest degree (<= MAX_PADE_DEGREE) that stays finite,
+      increasing and concave over all folds. When none does, the
+      Lander-Waterman curve of Picard's library size estimate is used.
+
+    The library size model is reported alongside for every fold.
+    """
+    import numpy as np
+
+    folds = folds or COMPLEXITY_FOLDS
+    total = sum(j * n for j, n in set_sizes.items())
+    distinct = sum(set_sizes.values())
+    if not total:
+        return []
+    library = estimate_library_size(total, distinct)
+
+    def model(fold):
+        if library is None:
+            return distinct * fold
+        return library * (1 - math.exp(-fold * total / library))
+
+    extrapolate = sorted(f for f in folds if f > 1)
+    best, method = None, "library_size_model"
+    max_j = max(set_sizes)
+    series = [(-1) ** j * set_sizes.get(j + 1, 0) for j in range(min(max_j, 2 * MAX_PADE_DEGREE))]
+    for degree in range(MAX_PADE_DEGREE, 0, -1):
+        pade = _pade(series, degree)
+        if pade is None:
+            continue
+        num, den = pade
+        t = np.array([0.0] + [f - 1 for f in extrapolate])
+        values = distinct + t * np.polyval(num[::-1], t) / np.polyval(den[::-1], t)
+        steps = np.diff(values) / np.diff(t) if len(t) > 1 else np.zeros(0)
+        denominators = np.polyval(den[::-1], np.linspace(0, t[-1], 512))
+        if (np.all(np.isfinite(values)) and np.all(denominators > 0) and np.all(steps >= 0)
+                and np.all(np.diff(steps) <= 1e-9 * max(1.0, steps.max(initial=0)))):
+            best, method = dict(zip(extrapolate, values[1:])), f"pade_{degree}"
+            break
+
+    rows = []
+    for fold in sorted(folds):
+        if fold <= 1:
+            expected = float(sum(n * (1 - (1 - fold) ** j) for j, n in set_sizes.items()))
+            how = "interpolated"
+        else:
+            expected = best[fold] if best else model(fold)
+            how = method
+        rows.append({
+            "fold": fold,
+            "total_pairs": int(round(fold * total)),
+            "expected_distinct": expected,
+            "expected_distinct_library_model": model(fold),
+            "method": how,
+        })
+    return rows
+
+def write_complexity_curve(path: str, rows: List[dict]) -> None:
+    columns = ["fold", "total_pairs", "expected_distinct", "expected_distinct_library_model", "method"]
+    with open(path, "w") as f:
+        f.write("\t".join(columns) + "\n")
+        for row in rows:
+            f.write("\t".join(f"{row[c]:.1f}" if isinstance(row[c], float) else str(row[c]) for c in columns) + "\n")
+
+def write_duplication_metrics(path: str, stats: DuplicateStats, *, library: str, input_path: Optional[str] = None) -> None:
+    """DuplicationMetrics in Picard's layout, with its ROI / duplicate set histogram."""
+    unique = stats.pairs - stats.pair_duplicates
+    library_size = estimate_library_size(stats.pairs, unique)
+    row = {
+        "LIBRARY": library,
+        "UNPAIRED_READS_EXAMINED": stats.unpaired,
+        "READ_PAIRS_EXAMINED": stats.pairs,
+        "SECONDARY_OR_SUPPLEMENTARY_RDS": stats.secondary_or_supplementary,
+        "UNMAPPED_READS": stats.unmapped,
+        "UNPAIRED_READ_DUPLICATES": stats.unpaired_duplicates,
+        "READ_PAIR_DUPLICATES": stats.pair_duplicates,
+        "READ_PAIR_OPTICAL_DUPLICATES": 0,
+        "PERCENT_DUPLICATION": stats.percent_duplication(),
+        "ESTIMATED_LIBRARY_SIZE": int(library_size) if library_size else None,
+    }
+    sets = stats.set_sizes
+    histogram = []
+    for x in range(1, max(100, max(sets, default=0)) + 1):
+        # Picard's return on investment: unique pairs at x times the depth over those seen now
+        roi = library_size * (1 - math.exp(-x * stats.pairs / library_size)) / unique if library_size and x <= 100 else None
+        histogram.append((float(x), roi, float(sets.get(x, 0)), float(sets.get(x, 0))))
+    write_picard_metrics(
+        path,
+        "picard.sam.markduplicates.MarkDuplicates (native)",
+        "picard.sam.DuplicationMetrics",
+        [row],
+        columns=DUPLICATION_COLUMNS,
+        histogram=histogram,
+        histogram_header=["BIN", "CoverageMult", "all_sets", "non_optical_sets"],
+        input_path=input_path,
+    )
+
+def mark_duplicates(
+    bam_path: str,
+    out_bam: str,
+    metrics_path: str,
+    *,
+    complexity_path: Optional[str] = None,
+    remove: bool = True,
+    threads: int = 1,
+    tmp_dir: Optional[str] = None,
+) -> DuplicateStats:
+    """
+    MarkDuplicates REMOVE_DUPLICATES=true CREATE_INDEX=true, natively; optionally
+    the complexity curve too. The duplicate keys are spilled under tmp_dir
+    (else next to out_bam).
+    """
+    import pysam
+    from steps import shards
+
+    with shards.workdir(out_bam, tmp_dir) as work:
+        duplicates, stats = find_duplicates(bam_path, work, threads=threads)
+        dropped = write_marked(bam_path, out_bam, duplicates, remove=remove, threads=threads)
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        libraries = sorted(set(_libraries(bam.header).values()))
+    write_duplication_metrics(metrics_path, stats, library=",".join(libraries) or "Unknown Library", input_path=bam_path)
+    if complexity_path:
+        write_complexity_curve(complexity_path, complexity_curve(stats.set_sizes))
+    logging.info(
+        f"markdup: {stats.pairs} pairs ({stats.pair_duplicates} duplicates), {stats.unpaired} unpaired reads "
+        f"({stats.unpaired_duplicates} duplicates); {stats.percent_duplication():.4f} duplication, "
+        f"{dropped} records {'removed' if remove else 'flagged'}"
+    )
+    return stats
@@ -0,0 +1,282 @@
+########################################
+# native fragment pileup -> bigWig
+#
+# one decode of the filtered BAM (shards of it across a process pool) builds
+# every requested track at bin resolution with numpy: fragment coverage
+# from difference arrays over full bins plus the partial first / last bin
+# of each fragment, and Tn5 cut sites with a bincount. normalised tracks
+# (CPM, RPGC) are scaled from the raw bins once the fragment total is known,
+# so adding a track costs no extra pass over the BAM. pileup_fragments builds
+# the same tracks from the fragments file (steps/fragments.py).
+########################################
+
+import os
+import logging
+from array import array
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+
+from steps import fraglen, shards
+from steps.tsse import TN5_SHIFT_MINUS, TN5_SHIFT_PLUS
+
+# track name -> what it shows
+TRACKS = {
+    "raw": "fragment coverage",
+    "cpm": "fragment coverage per million fragments",
+    "rpgc": "fragment coverage normalised to 1x genome coverage",
+    "cutsites": "Tn5 cut sites per bin",
+    "nfr": "coverage of nucleosome-free (< 150 bp) fragments",
+}
+DEFAULT_TRACKS = ("raw", "cpm", "cutsites", "nfr")
+DEFAULT_BIN_SIZE = 50
+
+def _fragment_bins(starts: np.ndarray, ends: np.ndarray, bin_size: int, n_bins: int) -> np.ndarray:
+    """Per-bin sum of base coverage of the fragments [starts, ends)."""
+    first, last = starts // bin_size, (ends - 1) // bin_size
+    one = first == last
+    total = np.zeros(n_bins)
+    total += np.bincount(first[one], weights=(ends - starts)[one], minlength=n_bins)
+
+    s, e, fb, lb = starts[~one], ends[~one], first[~one], last[~one]
+    total += np.bincount(fb, weights=(fb + 1) * bin_size - s, minlength=n_bins)
+    total += np.bincount(lb, weights=e - lb * bin_size, minlength=n_bins)
+    # full bins strictly between first and last: difference array on bin starts
+    diff = np.bincount(fb + 1, minlength=n_bins + 1)[:n_bins + 1] - np.bincount(lb, minlength=n_bins + 1)[:n_bins + 1]
+    total += np.cumsum(diff)[:n_bins] * bin_size
+    return total
+
+def _add_fragments(sums: Dict[str, np.ndarray], s: np.ndarray, e: np.ndarray, *, tracks, bin_size: int,
+                   length: int, origin: int) -> None:
+    """
+    Add fragments [s, e) (contig coordinates, e clipped to length) to the
+    per-bin sums, which start at origin and grow to the last fragment end
+    (or + strand cut, for very short fragments).
+    """
+    top = min(length, max(int(e.max()), int(s.max()) + TN5_SHIFT_PLUS + 1))
+    n_bins = -(-(top - origin) // bin_size)
+    for key, arr in sums.items():
+        if len(arr) < n_bins:
+            sums[key] = np.concatenate([arr, np.zeros(n_bins - len(arr))])
+    s, e = s - origin, e - origin
+    if "raw" in tracks or "cpm" in tracks or "rpgc" in tracks:
+        sums["raw"] += _fragment_bins(s, e, bin_size, len(sums["raw"]))
+    if "nfr" in tracks:
+        short = (e - s) < fraglen.NFR[1]
+        sums["nfr"] += _fragment_bins(s[short], e[short], bin_size, len(sums["nfr"]))
+    if "cutsites" in tracks:
+        cuts = np.concatenate([s + TN5_SHIFT_PLUS, e - 1 + TN5_SHIFT_MINUS])
+        cuts = np.clip(cuts, -origin, length - 1 - origin)
+        sums["cutsites"] += np.bincount(cuts // bin_size, minlength=len(sums["cutsites"]))
+
+def _shard_worker(shard, *, bam_path: str, tracks, bin_size: int, min_mapq: int,
+                  exclude_flags: int, require_flags: int, chunk_size: int) -> Tuple[int, Dict[str, np.ndarray], int, int]:
+    """
+    (first bin, {"raw" / "nfr" / "cutsites": per-bin sums}, fragments,
+    fragment bases) for the fragments starting in one shard. The arrays
+    start at the bin of the shard's first possible cut site and grow to the
+    last fragment end.
+    """
+    import pysam
+
+    # a - strand cut can land up to 6 bp before the first fragment start
+    first_bin = max(0, shard.start + TN5_SHIFT_MINUS - 1) // bin_size
+    origin = first_bin * bin_size
+    sums = {"raw": np.zeros(0), "nfr": np.zeros(0), "cutsites": np.zeros(0)}
+    n_fragments = n_bases = 0
+
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        length = bam.get_reference_length(shard.contig)
+
+        def _flush(starts, ends):
+            nonlocal n_fragments, n_bases
+            s = np.frombuffer(starts, dtype=np.int64)
+            e = np.minimum(np.frombuffer(ends, dtype=np.int64), length)
+            n_fragments += len(s)
+            n_bases += int((e - s).sum())
+            _add_fragments(sums, s, e, tracks=tracks, bin_size=bin_size, length=length, origin=origin)
+
+        starts, ends = array("q"), array("q")
+        for read in shards.fetch(bam, shard):
+            flag = read.flag
+            # one record per fragment: the leftmost mate of a pair passing the filtered-BAM flags
+            if flag & exclude_flags or (flag & require_flags) != require_flags:
+                continue
+            if read.mapping_quality < min_mapq or read.template_length <= 0:
+                continue
+            starts.append(read.reference_start)
+            ends.append(read.reference_start + read.template_length)
+            if len(starts) >= chunk_size:
+                _flush(starts, ends)
+                starts, ends = array("q"), array("q")
+        if starts:
+            _flush(starts, ends)
+
+    return first_bin, sums, n_fragments, n_bases
+
+def pileup_tracks(
+    bam_path: str,
+    tracks: List[str],
+    *,
+    bin_size: int = DEFAULT_BIN_SIZE,
+    min_mapq: int = 30,
+    exclude_flags: int = 1804,
+    require_flags: int = 2,
+    effective_genome_size: Optional[int] = None,
+    threads: int = 1,
+    chunk_size: int = 500000,
+) -> Tuple[Dict[str, int], List[Tuple[str, Dict[str, np.ndarray]]], dict]:
+    """
+    Per-bin values of every track in `tracks` (see TRACKS), one BAM pass.
+
+    Returns (chrom sizes, [(chrom, {track: values})] in header order, totals).
+    RPGC scales to 1x over effective_genome_size (default: the summed
+    contig lengths of the BAM header).
+    """
+    import pysam
+
+    unknown = [t for t in tracks if t not in TRACKS]
+    if unknown:
+        raise ValueError(f"Unknown coverage track(s) {unknown} (expected any of {list(TRACKS)})")
+
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        sizes = dict(zip(bam.references, bam.lengths))
+    plan = shards.plan(bam_path)
+    shards.log_plan("pileup", plan, threads)
+    results = shards.run(
+        _shard_worker, plan, threads=threads, bam_path=bam_path, tracks=tuple(tracks), bin_size=bin_size,
+        min_mapq=min_mapq, exclude_flags=exclude_flags, require_flags=require_flags, chunk_size=chunk_size,
+    )
+
+    # add each shard's bins into its contig at the shard's offset
+    contigs: Dict[str, Dict[str, np.ndarray]] = {}
+    for shard, (first_bin, sums, _, _) in zip(plan, results):
+        if shard.contig not in contigs:
+            n_bins = -(-sizes[shard.contig] // bin_size)
+            contigs[shard.contig] = {k: np.zeros(n_bins) for k in ("raw", "nfr", "cutsites")}
+        full = contigs[shard.contig]
+        for key in ("raw", "nfr", "cutsites"):
+            full[key][first_bin:first_bin + len(sums[key])] += sums[key]
+
+    chroms, totals = _finish(sizes, contigs, tracks, sum(r[2] for r in results), sum(r[3] for r in results),
+                             bin_size=bin_size, effective_genome_size=effective_genome_size)
+    return sizes, chroms, totals
+
+def pileup_fragments(
+    path: str,
+    tracks: List[str],
+    sizes: Dict[str, int],
+    *,
+    bin_size: int = DEFAULT_BIN_SIZE,
+    effective_genome_size: Optional[int] = None,
+) -> Tuple[Dict[str, int], List[Tuple[str, Dict[str, np.ndarray]]], dict]:
+    """
+    pileup_tracks from a fragments file (steps/fragments.py), whose lines
+    are already filtered; sizes are the BAM header's contig lengths.
+    """
+    from steps.fragments import iter_fragments, unshift
+
+    unknown = [t for t in tracks if t not in TRACKS]
+    if unknown:
+        raise ValueError(f"Unknown coverage track(s) {unknown} (expected any of {list(TRACKS)})")
+
+    contigs: Dict[str, Dict[str, np.ndarray]] = {}
+    n_fragments = n_bases = 0
+    for chrom, starts, ends, _ in iter_fragments(path):
+        if chrom not in sizes:
+            continue
+        full = contigs.setdefault(chrom, {k: np.zeros(0) for k in ("raw", "nfr", "cutsites")})
+        s, e = unshift(starts, ends)
+        e = np.minimum(e, sizes[chrom])
+        n_fragments += len(s)
+        n_bases += int((e - s).sum())
+        _add_fragments(full, s, e, tracks=tuple(tracks), bin_size=bin_size, length=sizes[chrom], origin=0)
+    for chrom, full in contigs.items():
+        n_bins = -(-sizes[chrom] // bin_size)
+        for key, arr in full.items():
+            full[key] = np.concatenate([arr, np.zeros(n_bins - len(arr))])
+
+    chroms, totals = _finish(sizes, contigs, tracks, n_fragments, n_bases,
+                             bin_size=bin_size, effective_genome_size=effective_genome_size)
+    return sizes, chroms, totals
+
+def _finish(sizes, contigs, tracks, n_fragments: int, n_bases: int, *, bin_size: int,
+            effective_genome_size: Optional[int]):
+    """Per-contig bin sums -> ([(chrom, {track: values})], totals)."""
+    genome = effective_genome_size or sum(sizes.values())
+    scale = {
+        "cpm": 1e6 / n_fragments if n_fragments else 0.0,
+        "rpgc": genome / n_bases if n_bases else 0.0,
+    }
+
+    chroms = []
+    for chrom, full in contigs.items():
+        # base-coverage sums -> mean coverage per bin (the last bin may be short)
+        widths = np.full(len(full["raw"]), bin_size, dtype=np.float64)
+        if len(widths):
+            widths[-1] = sizes[chrom] - (len(widths) - 1) * bin_size
+        values = {}
+        for track in tracks:
+            if track == "cutsites":
+                values[track] = full["cutsites"]
+            elif track == "nfr":
+                values[track] = full["nfr"] / widths
+            else:
+                values[track] = full["raw"] / widths * scale.get(track, 1.0)
+        chroms.append((chrom, values))
+
+    totals = {"fragments": n_fragments, "fragment_bases": n_bases, **{f"scale_{k}": v for k, v in scale.items()}}
+    return chroms, totals
+
+def write_bigwig(path: str, sizes: Dict[str, int], chroms: List[Tuple[str, np.ndarray]], bin_size: int) -> None:
+    """Non-zero bins of each chromosome as bedGraph-style bigWig entries."""
+    import pyBigWig
+
+    tmp = path + ".tmp.bw"
+    bw = pyBigWig.open(tmp, "w")
+    try:
+        bw.addHeader(list(sizes.items()))
+        for chrom, values in chroms:
+            idx = np.flatnonzero(values)
+            if not len(idx):
+                continue
+            starts = idx * bin_size
+            ends = np.minimum(starts + bin_size, sizes[chrom])
+            bw.addEntries([chrom] * len(idx), starts.tolist(), ends=ends.tolist(),
+                          values=values[idx].astype(np.float64).tolist())
+    finally:
+        bw.close()
+    os.replace(tmp, path)
+
+def write_tracks(
+    bam_path: str,
+    out_paths: Dict[str, str],
+    *,
+    bin_size: int = DEFAULT_BIN_SIZE,
+    threads: int = 1,
+    fragments_path: Optional[str] = None,
+    **filters,
+) -> dict:
+    """
+    pileup_tracks for the tracks in out_paths ({track: bigWig path}), written
+    as bigWigs. With fragments_path the fragments come from that file
+    (pileup_fragments) and only bam_path's header is read.
+    """
+    if fragments_path:
+        import pysam
+
+        with pysam.AlignmentFile(bam_path, "rb") as bam:
+            sizes = dict(zip(bam.references, bam.lengths))
+        sizes, chroms, totals = pileup_fragments(
+            fragments_path, list(out_paths), sizes, bin_size=bin_size,
+            effective_genome_size=filters.get("effective_genome_size"),
+        )
+    else:
+        sizes, chroms, totals = pileup_tracks(bam_path, list(out_paths), bin_size=bin_size, threads=threads, **filters)
+    for track, path in out_paths.items():
+        write_bigwig(path, sizes, [(c, values[track]) for c, values in chroms], bin_size)
+    logging.info(
+        f"pileup: {os.path.basename(fragments_path or bam_path)} {totals['fragments']} fragments -> "
+        + ", ".join(out_paths)
+    )
+    return totals
@@ -0,0 +1,280 @@
+########################################
+# preview mode (--preview)
+#
+# runs the normal steps on a subsample of a library, in a separate output
+# tree, to decide whether the full run is worth it:
+#   - every output directory of the Configuration is moved under
+#     preview_dir (default: {common output root}/preview) and RAW_input_dir
+#     points at the subsampled FASTQs there
+#   - preview_subsample streams the raw lanes and keeps either the first N
+#     pairs or a seeded fraction of them. a pair is kept when the hash of its
+#     read name (keyed by the seed) falls below the fraction, so the same
+#     pairs are chosen on every run and R1 / R2 always agree
+#   - preview_report projects the full-depth metrics from the subsample:
+#     ratios (mito fraction, FRiP, TSSE, fragment size profile) carry over;
+#     duplication grows with depth and is extrapolated from the library size
+#     estimate (Picard's model), with the sampling fraction recorded
+########################################
+
+import os
+import gzip
+import json
+import math
+import hashlib
+import logging
+from typing import Dict, Optional
+
+from steps.helpers import outputs_exist
+from steps.markdup import estimate_library_size
+
+# Configuration attributes holding output directories (moved under preview_dir)
+OUTPUT_DIRS = (
+    "Trimmed_dir", "aligned_dir", "Reads_quality_dir", "dedup_alignments_dir",
+    "cleaned_alignments_dir", "macs3_dir", "genrich_dir", "coverages_dir",
+    "other_qc_dir", "fastqc_untrimmed_dir", "fastqc_trimmed_dir", "logs_dir",
+)
+
+# next to the subsampled FASTQs: align_qc clears {other_qc_dir}/{sample} when it reruns
+SAMPLING_JSON = "{RAW_input_dir}/{sample}/{sample}_preview_sampling.json"
+PREVIEW_REPORT = "{other_qc_dir}/{sample}/{sample}_preview_report.tsv"
+
+def parse_spec(spec: str) -> Dict[str, Optional[float]]:
+    """--preview value: a fraction in (0, 1) or a number of read pairs (>= 1)."""
+    value = float(spec)
+    if 0 < value < 1:
+        return {"fraction": value, "pairs": None}
+    if value >= 1 and value == int(value):
+        return {"fraction": None, "pairs": int(value)}
+    raise ValueError(f"--preview expects a fraction in (0, 1) or a whole number of read pairs, got {spec!r}")
+
+def describe(preview: dict) -> str:
+    if preview["pairs"]:
+        return f"first {preview['pairs']} read pairs"
+    return f"{preview['fraction']:g} of the read pairs (seed {preview['seed']})"
+
+def apply_preview(Configuration, spec: str, *, seed: int = 0) -> None:
+    """
+    Switch Configuration to preview mode: record the subsample settings and
+    move every output directory (and RAW_input_dir) under preview_dir, by
+    default "preview" in the output root (the parent of
+    cleaned_alignments_dir). Directories inside the output root keep their
+    layout; any other one goes to preview_dir/<its name>.
+    """
+    Configuration.preview = dict(parse_spec(spec), seed=int(seed))
+    base = os.path.dirname(os.path.abspath(Configuration.cleaned_alignments_dir))
+    root = os.path.abspath(Configuration.preview_dir or os.path.join(base, "preview"))
+
+    names = list(OUTPUT_DIRS) + [k for k in ("atacseqqc_dir", "consensus_dir") if getattr(Configuration, k)]
+    for k in names:
+        path = os.path.abspath(getattr(Configuration, k))
+        rel = os.path.relpath(path, base)
+        if rel.startswith(os.pardir):
+            rel = os.path.basename(path)
+        setattr(Configuration, k, os.path.normpath(os.path.join(root, rel)))
+    Configuration.preview_dir = root
+    Configuration.preview_source_dir = Configuration.RAW_input_dir
+    Configuration.RAW_input_dir = os.path.join(root, "raw")
+    logging.info(f"preview: {describe(Configuration.preview)} -> {root}")
+
+def _keep_threshold(fraction: float) -> int:
+    return int(fraction * 2 ** 64)
+
+def _pair_key(header: str) -> bytes:
+    """Read name without the comment and the /1 /2 suffix."""
+    name = header[1:].split(None, 1)[0]
+    if name.endswith(("/1", "/2")):
+        name = name[:-2]
+    return name.encode()
+
+def _records(f):
+    while True:
+        head = f.readline()
+        if not head:
+            return
+        yield head, f.readline(), f.readline(), f.readline()
+
+def subsample_lanes(R1_paths, R2_paths, out_R1: str, out_R2: str, *, fraction: Optional[float] = None,
+                    pairs: Optional[int] = None, seed: int = 0) -> dict:
+    """
+    Stream the lanes (in order) into one subsampled pair of FASTQs: the first
+    `pairs` pairs, or the pairs whose seeded name hash is below `fraction`.
+
+    Returns the sampling record: pairs seen / kept, the (estimated) total
+    pairs of the library and the effective sampling fraction. With `pairs`
+    the total is extrapolated from the share of the compressed R1 lanes read.
+    """
+    threshold = _keep_threshold(fraction) if fraction is not None else None
+    key = seed.to_bytes(8, "little", signed=True)
+    seen = kept = 0
+    consumed = 0
+    total_bytes = sum(os.path.getsize(p) for p in R1_paths)
+    done = False
+
+    with gzip.open(out_R1, "wt", compresslevel=1) as o1, gzip.open(out_R2, "wt", compresslevel=1) as o2:
+        for r1_path, r2_path in zip(R1_paths, R2_paths):
+            with gzip.open(r1_path, "rt") as i1, gzip.open(r2_path, "rt") as i2:
+                for rec1, rec2 in zip(_records(i1), _records(i2)):
+                    seen += 1
+                    if threshold is not None:
+                        digest = hashlib.blake2b(_pair_key(rec1[0]), digest_size=8, key=key).digest()
+                        if int.from_bytes(digest, "little") >= threshold:
+                            continue
+                    o1.writelines(rec1)
+                    o2.writelines(rec2)
+                    kept += 1
+                    if pairs is not None and kept >= pairs:
+                        done = True
+                        break
+                # compressed bytes of this lane read so far
+                consumed += i1.buffer.fileobj.tell() if done else os.path.getsize(r1_path)
+            if done:
+                break
+
+    if pairs is not None and done and consumed:
+        total = int(round(seen * total_bytes / consumed))
+    else:
+        total = seen
+    return {
+        "mode": "first_pairs" if pairs is not None else "fraction",
+        "requested_pairs": pairs,
+        "requested_fraction": fraction,
+        "seed": seed,
+        "pairs_seen": seen,
+        "pairs_kept": kept,
+        "estimated_total_pairs": total,
+        "total_is_estimate": bool(pairs is not None and done),
+        "sampling_fraction": kept / total if total else 0.0,
+    }
+
+def subsample(Configuration):
+    """
+    Subsample the raw lanes of {preview_source_dir}/{sample} into
+    {RAW_input_dir}/{sample}/{sample}_preview_R1/R2.fastq.gz (the preview
+    tree) and record the sampling next to them in {sample}_preview_sampling.json.
+    """
+    from steps import trimming
+
+    sample = Configuration.file_to_process
+    preview = Configuration.preview
+    source = os.path.join(Configuration.preview_source_dir, sample)
+    out_dir = os.path.join(Configuration.RAW_input_dir, sample)
+    os.makedirs(out_dir, exist_ok=True)
+
+    out_R1 = os.path.join(out_dir, f"{sample}_preview_R1.fastq.gz")
+    out_R2 = os.path.join(out_dir, f"{sample}_preview_R2.fastq.gz")
+    record_path = SAMPLING_JSON.format(RAW_input_dir=Configuration.RAW_input_dir, sample=sample)
+    if (not Configuration.force) and outputs_exist([out_R1, out_R2, record_path]):
+        logging.info("preview_subsample: outputs exist; skipping (use --force to overwrite)")
+        return
+
+    raw_files = sorted(f for f in os.listdir(source) if f.endswith(".gz"))
+    R1_files = [f for f in raw_files if f.endswith(trimming.R1_SUFFIXES)]
+    R2_files = [f for f in raw_files if f.endswith(trimming.R2_SUFFIXES)]
+    if not R1_files or len(R1_files) != len(R2_files):
+        raise FileNotFoundError(f"preview_subsample: no matching R1/R2 lanes in {source}")
+    trimming._pair_lanes(R1_files, R2_files)
+
+    record = subsample_lanes(
+        [os.path.join(source, f) for f in R1_files],
+        [os.path.join(source, f) for f in R2_files],
+        out_R1, out_R2,
+        fraction=preview["fraction"], pairs=preview["pairs"], seed=preview["seed"],
+    )
+    with open(record_path, "w") as f:
+        json.dump(record, f, indent=2)
+    logging.info(
+        f"preview_subsample: {sample} kept {record['pairs_kept']} of {record['pairs_seen']} pairs read "
+        f"(~{record['estimated_total_pairs']} in the library, fraction {record['sampling_fraction']:.4g})"
+    )
+
+def project_duplication(pairs: int, duplicates: int, scale: float) -> Dict[str, Optional[float]]:
+    """Duplicate rate and unique pairs at `scale` times the sampled depth."""
+    unique = pairs - duplicates
+    library = estimate_library_size(pairs, unique)
+    full = pairs * scale
+    if library is None:
+        return {"estimated_library_size": None, "duplication": duplicates / pairs if pairs else None,
+                "unique_pairs": full - duplicates * scale}
+    unique_full = library * (1 - math.exp(-full / library))
+    return {"estimated_library_size": library, "duplication": 1 - unique_full / full, "unique_pairs": unique_full}
+
+def _read_markdup_pairs(path: str):
+    """(pairs examined, duplicate pairs) from a Picard DuplicationMetrics file."""
+    from steps.qc import _parse_picard_markdup
+
+    md = _parse_picard_markdup(path)
+    try:
+        pairs = int(md["READ_PAIRS_EXAMINED"])
+        duplicates = int(md["READ_PAIR_DUPLICATES"])
+    except (KeyError, ValueError):
+        return None
+    return pairs, duplicates
+
+def preview_report(Configuration):
+    """
+    {other_qc_dir}/{sample}/{sample}_preview_report.tsv: each QC metric of
+    the subsample next to its projection at full depth, with the sampling.
+    """
+    import pandas as pd
+    from steps import fraglen
+    from steps.ATACseqQC import get_output_dir
+
+    sample = Configuration.file_to_process
+    qc_dir = os.path.join(Configuration.other_qc_dir, sample)
+    out_path = PREVIEW_REPORT.format(other_qc_dir=Configuration.other_qc_dir, sample=sample)
+
+    with open(SAMPLING_JSON.format(RAW_input_dir=Configuration.RAW_input_dir, sample=sample)) as f:
+        sampling = json.load(f)
+    fraction = sampling["sampling_fraction"]
+    scale = 1 / fraction if fraction else float("nan")
+
+    rows = [
+        ("sampling_fraction", fraction, None, "estimated" if sampling["total_is_estimate"] else "exact"),
+        ("pairs_sampled", sampling["pairs_kept"], sampling["estimated_total_pairs"], "read pairs in the raw FASTQs"),
+    ]
+
+    # deduplicated counts grow like the unique pairs, not like the depth
+    unique_scale, unique_note = scale, "scales with depth"
+    markdup = _read_markdup_pairs(os.path.join(qc_dir, f"{sample}_markdup_qc.txt"))
+    if markdup is not None:
+        pairs, duplicates = markdup
+        projected = project_duplication(pairs, duplicates, scale)
+        rows.append(("duplication", duplicates / pairs if pairs else None, projected["duplication"],
+                     "library size model"))
+        rows.append(("unique_pairs", pairs - duplicates, projected["unique_pairs"], "library size model"))
+        rows.append(("estimated_library_size", projected["estimated_library_size"],
+                     projected["estimated_library_size"], "depth-independent"))
+        if pairs > duplicates:
+            unique_scale, unique_note = projected["unique_pairs"] / (pairs - duplicates), "scales with unique pairs"
+
+    metrics_path = os.path.join(qc_dir, f"{sample}_qc_metrics.tsv")
+    if os.path.exists(metrics_path):
+        metrics = pd.read_csv(metrics_path, sep="\t").iloc[0].to_dict()
+        for k, v in metrics.items():
+            if isinstance(v, str):
+                continue
+            if k.startswith("total_"):
+                rows.append((k, v, v * unique_scale, unique_note))
+            elif k.startswith("frip_") or k == "mito_fraction_mapped":
+                rows.append((k, v, v, "depth-independent"))
+
+    tsse_path = os.path.join(get_output_dir(Configuration, sample), f"{sample}_TSSEscore.txt")
+    if os.path.exists(tsse_path):
+        with open(tsse_path) as f:
+            tsse = float(f.read().split()[0])
+        rows.append(("tsse", tsse, tsse, "depth-independent"))
+
+    npy = os.path.join(qc_dir, f"{sample}_fragment_lengths.npy")
+    if os.path.exists(npy):
+        summary = fraglen.summarise(fraglen.stack([fraglen.load(npy)]))
+        for k in ("median_fragment_length", "nfr_fraction", "mono_nucleosome_fraction",
+                  "di_nucleosome_fraction", "nfr_mono_ratio", "helical_periodicity_score"):
+            v = float(summary[k][0])
+            rows.append((k, v, v, "depth-independent"))
+
+    report = pd.DataFrame(rows, columns=["metric", "preview", "projected_full_depth", "note"])
+    report.insert(0, "sample", sample)
+    report.to_csv(out_path, sep="\t", index=False)
+    logging.info(f"preview_report: {sample} (sampling fraction {fraction:.4g}) -> {out_path}")
+    for _, r in report.iterrows():
+        logging.info(f"preview_report:   {r['metric']}: {r['preview']} -> {r['projected_full_depth']}")
@@ -0,0 +1,303 @@
+########################################
+# external tool pipelines (no shell)
+#
+# a pipeline is a list of stages (argument lists) joined by OS pipes, the
+# equivalent of `a | b | c > out` under `set -o pipefail`, supervised from
+# an asyncio loop:
+#   - every stage is awaited; the first failure, or the timeout, stops the
+#     rest of the chain (SIGTERM, then SIGKILL) and raises PipelineError
+#     naming the stage that failed first. stages that only died of SIGPIPE
+#     or of being stopped are not blamed when another stage failed.
+#   - each stage's stderr goes to
+#     {logs_dir}/{sample}/{sample}_{label}.{n}.{tool}.stderr (label: the
+#     step by default; empty files are removed); the last lines of a failed
+#     stage are in the error. outside a profiled step it is inherited.
+#   - the last stage's stdout (stdout=) and the files the stages write
+#     themselves (outputs=, written under partial_path) get their final
+#     names by rename only when every stage succeeded, so a crashed stage
+#     never leaves a truncated file that outputs_exist accepts.
+#   - run_pipelines runs several independent pipelines at once in one
+#     process; when one fails the others are stopped.
+#   - Watchdog applies the same timeout to Popen chains a step drives
+#     itself (bamio.BamPipeReader, trimming's streamed lanes).
+# options.pipeline_timeout is the timeout the steps pass (default: none).
+# every stage gets a timeline record (helpers.wait_profiled).
+########################################
+
+import os
+import time
+import signal
+import asyncio
+import logging
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, NamedTuple, Optional, Sequence
+
+from steps import helpers
+
+# seconds between SIGTERM and SIGKILL when a chain is stopped
+KILL_GRACE = 5.0
+# lines of a failed stage's stderr quoted in the error
+STDERR_TAIL = 20
+
+class Pipeline(NamedTuple):
+    """stages[0] | stages[1] | ... with stdin / stdout redirected from / to files."""
+    stages: List[List[str]]
+    stdin: Optional[str] = None
+    stdout: Optional[str] = None
+    outputs: Sequence[str] = ()
+    label: Optional[str] = None
+    timeout: Optional[float] = None
+
+class PipelineError(RuntimeError):
+    def __init__(self, message: str, returncodes: List[Optional[int]]):
+        super().__init__(message)
+        self.returncodes = returncodes
+
+def partial_path(path: str) -> str:
+    """Where a pipeline writes path until it succeeds (same directory, same extension)."""
+    d, base = os.path.split(path)
+    return os.path.join(d, f".partial.{base}")
+
+def _printable(p: Pipeline) -> str:
+    text = " | ".join(" ".join(cmd) for cmd in p.stages)
+    if p.stdin:
+        text += f" < {p.stdin}"
+    if p.stdout:
+        text += f" > {p.stdout}"
+    return text
+
+def _stderr_paths(p: Pipeline) -> List[Optional[str]]:
+    timeline = helpers._profile["timeline"]
+    if not timeline:
+        return [None] * len(p.stages)
+    sample = helpers._profile["sample"] or "cohort"
+    label = p.label or helpers._profile["step"] or "pipe"
+    return [
+        os.path.join(os.path.dirname(timeline), f"{sample}_{label}.{n}.{os.path.basename(cmd[0])}.stderr")
+        for n, cmd in enumerate(p.stages)
+    ]
+
+def _spawn(p: Pipeline, stderr_paths: List[Optional[str]]) -> List[subprocess.Popen]:
+    """Start the chain; the parent keeps no pipe ends, so EOF and SIGPIPE propagate."""
+    pipes = [os.pipe() for _ in p.stages[1:]]
+    files = []
+    procs = []
+    try:
+        stdin = stdout = None
+        if p.stdin:
+            stdin = open(p.stdin, "rb")
+            files.append(stdin)
+        if p.stdout:
+            os.makedirs(os.path.dirname(os.path.abspath(p.stdout)), exist_ok=True)
+            stdout = open(partial_path(p.stdout), "wb")
+            files.append(stdout)
+        for n, cmd in enumerate(p.stages):
+            err = None
+            if stderr_paths[n]:
+                os.makedirs(os.path.dirname(stderr_paths[n]), exist_ok=True)
+                err = open(stderr_paths[n], "ab")
+                files.append(err)
+            procs.append(subprocess.Popen(
+                cmd,
+                stdin=pipes[n - 1][0] if n else stdin,
+                stdout=pipes[n][1] if n < len(pipes) else stdout,
+                stderr=err,
+            ))
+    except BaseException:
+        for proc in procs:
+            proc.kill()
+            proc.wait()
+        _discard(p)
+        raise
+    finally:
+        for read_end, write_end in pipes:
+            os.close(read_end)
+            os.close(write_end)
+        for f in files:
+            f.close()
+    return procs
+
+def _signal(procs: List[subprocess.Popen], sig: int, stopped: Optional[set] = None) -> None:
+    # os.kill, not Popen.send_signal: that polls, and would reap a stage
+    # from under its wait_profiled thread
+    for n, proc in enumerate(procs):
+        if proc.returncode is None:
+            if stopped is not None:
+                stopped.add(n)
+            try:
+                os.kill(proc.pid, sig)
+            except ProcessLookupError:
+                pass
+
+def _stop(procs: List[subprocess.Popen], stopped: set) -> None:
+    """SIGTERM every stage still running, SIGKILL after KILL_GRACE."""
+    _signal(procs, signal.SIGTERM, stopped)
+    asyncio.get_running_loop().call_later(KILL_GRACE, _signal, procs, signal.SIGKILL)
+
+class Watchdog:
+    """
+    Stop procs (SIGTERM, then SIGKILL after KILL_GRACE) once timeout seconds
+    have passed, unless cancel() came first; expired tells the caller why
+    its stages died. A timeout of None never fires.
+    """
+
+    def __init__(self, procs: List[subprocess.Popen], timeout: Optional[float]):
+        self.procs = procs
+        self.timeout = timeout
+        self.expired = False
+        self._timers: List[threading.Timer] = []
+        if timeout is not None:
+            self._later(timeout, self._expire)
+
+    def _later(self, delay: float, func, *args) -> None:
+        timer = threading.Timer(delay, func, args)
+        timer.daemon = True
+        timer.start()
+        self._timers.append(timer)
+
+    def _expire(self) -> None:
+        self.expired = True
+        _signal(self.procs, signal.SIGTERM)
+        self._later(KILL_GRACE, _signal, self.procs, signal.SIGKILL)
+
+    def cancel(self) -> None:
+        for timer in self._timers:
+            timer.cancel()
+
+    def kill(self) -> None:
+        """SIGKILL every stage still running, leaving the reaping to the caller."""
+        _signal(self.procs, signal.SIGKILL)
+
+def _blame(order: List[int], returncodes: List[Optional[int]], stopped: set) -> int:
+    """
+    The stage that failed first (in exit order), preferring stages that were
+    neither stopped by us nor killed by SIGPIPE after a downstream failure.
+    """
+    failed = [n for n in order if returncodes[n] != 0]
+    own = [n for n in failed if n not in stopped]
+    first_cause = [n for n in own if returncodes[n] != -signal.SIGPIPE]
+    return (first_cause or own or failed)[0]
+
+def _tail(path: Optional[str]) -> str:
+    if not path or not os.path.exists(path):
+        return ""
+    with open(path, "rb") as f:
+        lines = f.read().decode(errors="replace").splitlines()[-STDERR_TAIL:]
+    return "".join(f"\n    {line}" for line in lines)
+
+def _drop_empty(paths: List[Optional[str]]) -> None:
+    for path in paths:
+        if path and os.path.exists(path) and os.path.getsize(path) == 0:
+            os.remove(path)
+
+def _discard(p: Pipeline) -> None:
+    for path in ([p.stdout] if p.stdout else []) + list(p.outputs):
+        if os.path.exists(partial_path(path)):
+            os.remove(partial_path(path))
+
+def _commit(p: Pipeline) -> None:
+    for path in ([p.stdout] if p.stdout else []) + list(p.outputs):
+        if not os.path.exists(partial_path(path)):
+            raise PipelineError(f"Pipeline succeeded but did not write {partial_path(path)}: {_printable(p)}", [])
+    for path in ([p.stdout] if p.stdout else []) + list(p.outputs):
+        os.replace(partial_path(path), path)
+
+async def _supervise(p: Pipeline, executor: ThreadPoolExecutor, check: bool) -> List[Optional[int]]:
+    loop = asyncio.get_running_loop()
+    logging.info(f"PIPE: {_printable(p)}")
+    stderr_paths = _stderr_paths(p)
+    start = time.time()
+    procs = _spawn(p, stderr_paths)
+    waits = {
+        loop.run_in_executor(executor, helpers.wait_profiled, proc, " ".join(cmd), start): n
+        for n, (cmd, proc) in enumerate(zip(p.stages, procs))
+    }
+    returncodes: List[Optional[int]] = [None] * len(procs)
+    order: List[int] = []
+    stopped: set = set()
+    timed_out = False
+    deadline = None if p.timeout is None else loop.time() + p.timeout
+    pending = set(waits)
+    try:
+        while pending:
+            timeout = None if deadline is None or stopped or timed_out else max(0.0, deadline - loop.time())
+            done, pending = await asyncio.wait(pending, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                timed_out = True
+                _stop(procs, stopped)
+                continue
+            for fut in done:
+                n = waits[fut]
+                returncodes[n] = fut.result()
+                order.append(n)
+            if pending and not stopped and any(returncodes[n] != 0 for n in order):
+                _stop(procs, stopped)
+    except BaseException:
+        # cancelled (a sibling pipeline failed) or interrupted: stop and reap
+        _stop(procs, stopped)
+        if pending:
+            await asyncio.wait(pending)
+        _discard(p)
+        _drop_empty(stderr_paths)
+        raise
+
+    _drop_empty(stderr_paths)
+    failed = timed_out or any(rc != 0 for rc in returncodes)
+    if not failed:
+        _commit(p)
+        return returncodes
+    _discard(p)
+    if not check:
+        return returncodes
+
+    if timed_out:
+        message = f"Pipeline timed out after {p.timeout}s (return codes {returncodes}): {_printable(p)}"
+    else:
+        n = _blame(order, returncodes, stopped)
+        message = (
+            f"Pipeline failed at stage {n + 1}/{len(procs)} ({' '.join(p.stages[n])}, exit {returncodes[n]}; "
+            f"return codes {returncodes}): {_printable(p)}"
+        )
+        tail = _tail(stderr_paths[n])
+        if tail:
+            message += f"\n  stderr ({stderr_paths[n]}):{tail}"
+    raise PipelineError(message, returncodes)
+
+async def _run_all(pipelines: Sequence[Pipeline], check: bool) -> List[List[Optional[int]]]:
+    with ThreadPoolExecutor(max_workers=max(1, sum(len(p.stages) for p in pipelines))) as executor:
+        tasks = [asyncio.ensure_future(_supervise(p, executor, check)) for p in pipelines]
+        done, pending = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        failed = [t for t in tasks if t in done and t.exception() is not None]
+        if failed:
+            for t in pending:
+                t.cancel()
+            if pending:
+                await asyncio.wait(pending)
+            raise failed[0].exception()
+        return [t.result() for t in tasks]
+
+def run_pipelines(pipelines: Sequence[Pipeline], *, check: bool = True) -> List[List[Optional[int]]]:
+    """
+    Run independent pipelines concurrently; returns each one's stage return
+    codes. With check, the first failure stops the others and is raised.
+    """
+    return asyncio.run(_run_all(list(pipelines), check))
+
+def run_pipeline(
+    stages: List[List[str]],
+    *,
+    stdin: Optional[str] = None,
+    stdout: Optional[str] = None,
+    outputs: Sequence[str] = (),
+    label: Optional[str] = None,
+    timeout: Optional[float] = None,
+    check: bool = True,
+) -> List[Optional[int]]:
+    """
+    stages[0] | ... | stages[-1] < stdin > stdout, pipefail-style. Stages
+    writing files themselves write them to partial_path(output) and list
+    output in outputs.
+    """
+    return run_pipelines([Pipeline(stages, stdin, stdout, outputs, label, timeout)], check=check)[0]
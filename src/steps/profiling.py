@@ -0,0 +1,116 @@
+########################################
+# cohort resource report from the per-sample timelines
+#
+# run_cmd / run_pipe / profile_step append JSONL records to
+# {logs_dir}/{sample}/{sample}_timeline.jsonl; this step summarises them
+# per sample and step and draws a Gantt-style chart of the run.
+########################################
+
+import os
+import glob
+import json
+import logging
+
+def load_timelines(logs_dir: str):
+    import pandas as pd
+
+    rows = []
+    for path in sorted(glob.glob(os.path.join(logs_dir, "*", "*_timeline.jsonl"))):
+        with open(path) as f:
+            for line in f:
+                line = line.strip()
+                if not line:
+                    continue
+                try:
+                    rows.append(json.loads(line))
+                except ValueError:
+                    logging.warning(f"profile_report: skipping malformed line in {path}")
+    return pd.DataFrame(rows)
+
+def _summarise_steps(steps):
+    df = steps.copy()
+    df["sample"] = df["sample"].fillna("cohort")
+    df["cpu_s"] = df["user_s"] + df["sys_s"]
+    df["cpu_efficiency"] = df["cpu_s"] / df["wall_s"].where(df["wall_s"] > 0)
+    df["max_rss_gb"] = df["max_rss_kb"] / 1024 ** 2
+    for col in ("read_bytes", "write_bytes", "rchar", "wchar"):
+        if col not in df:
+            df[col] = 0
+    df["read_gb"] = df["rchar"].fillna(0) / 1024 ** 3
+    df["write_gb"] = df["wchar"].fillna(0) / 1024 ** 3
+    cols = ["sample", "step", "status", "wall_s", "cpu_s", "cpu_efficiency", "max_rss_gb", "read_gb", "write_gb", "host"]
+    # last run of each (sample, step)
+    return df.sort_values("start").groupby(["sample", "step"]).tail(1)[cols]
+
+def _plot_gantt(steps, out_png: str) -> None:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    df = steps.sort_values("start")
+    t0 = df["start"].min()
+    df = df.assign(sample=df["sample"].fillna("cohort"))
+    samples = list(dict.fromkeys(df["sample"]))
+    step_names = list(dict.fromkeys(df["step"]))
+    colours = {s: plt.cm.tab20(i % 20) for i, s in enumerate(step_names)}
+
+    fig, ax = plt.subplots(figsize=(12, max(3, 0.35 * len(samples) + 1)))
+    for _, r in df.iterrows():
+        y = samples.index(r["sample"])
+        ax.barh(
+            y, (r["end"] - r["start"]) / 3600, left=(r["start"] - t0) / 3600,
+            color=colours[r["step"]], edgecolor="black" if r.get("status") == "failed" else None,
+        )
+    ax.set_yticks(range(len(samples)))
+    ax.set_yticklabels(samples, fontsize=7)
+    ax.invert_yaxis()
+    ax.set_xlabel("hours since first step")
+    handles = [plt.Rectangle((0, 0), 1, 1, color=colours[s]) for s in step_names]
+    ax.legend(handles, step_names, fontsize=7, loc="upper left", bbox_to_anchor=(1.01, 1))
+    fig.tight_layout()
+    fig.savefig(out_png, dpi=120)
+    plt.close(fig)
+
+def profile_report(Configuration):
+    """
+    Write, under {logs_dir}:
+      - profile_summary.tsv: one row per (sample, step): wall, CPU, CPU
+        efficiency, max RSS, bytes read / written
+      - profile_steps.tsv: per step across samples (median / max), for
+        sizing SLURM requests
+      - profile_commands.tsv: every recorded command
+      - profile_gantt.png: timeline of all steps
+    """
+    logs_dir = Configuration.logs_dir
+    df = load_timelines(logs_dir)
+    if df.empty:
+        logging.warning(f"profile_report: no timelines found under {logs_dir}")
+        return
+
+    steps = df[df["kind"] == "step"]
+    cmds = df[df["kind"] == "cmd"]
+
+    if not cmds.empty:
+        cmds.to_csv(os.path.join(logs_dir, "profile_commands.tsv"), sep="\t", index=False)
+
+    if steps.empty:
+        logging.warning("profile_report: no step records yet")
+        return
+
+    summary = _summarise_steps(steps)
+    summary.to_csv(os.path.join(logs_dir, "profile_summary.tsv"), sep="\t", index=False)
+
+    per_step = summary.groupby("step").agg(
+        samples=("sample", "count"),
+        wall_s_median=("wall_s", "median"),
+        wall_s_max=("wall_s", "max"),
+        cpu_efficiency_median=("cpu_efficiency", "median"),
+        max_rss_gb_median=("max_rss_gb", "median"),
+        max_rss_gb_max=("max_rss_gb", "max"),
+        read_gb_median=("read_gb", "median"),
+        write_gb_median=("write_gb", "median"),
+    )
+    per_step.to_csv(os.path.join(logs_dir, "profile_steps.tsv"), sep="\t")
+
+    _plot_gantt(steps, os.path.join(logs_dir, "profile_gantt.png"))
+    logging.info(f"profile_report: wrote summary and Gantt chart to {logs_dir}")
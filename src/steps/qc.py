@@ -1,18 +1,18 @@
 import os
-import glob
 import logging
-import subprocess
-import pandas as pd
-import pybedtools as pbed
-import matplotlib.pyplot as plt
 
-os.makedirs("/mnt/iusers01/jw01/x25633jb/scratch/temp_pybedtools/", exist_ok=True)
-pbed.helpers.set_tempdir("/mnt/iusers01/jw01/x25633jb/scratch/temp_pybedtools/")
-bed_genome_file = "/mnt/jw01-aruk-home01/projects/functional_genomics/common_files/data/external/reference/Homo_sapiens/hg38/Sequence/WholeGenomeFasta/genome.genome"
+# pandas, pysam and the FRiP / interval engines are imported in the functions
+# that need them, so importing this module is cheap
 
-def _samtools_count(bam_path: str) -> int:
-    out = subprocess.check_output(["samtools", "view", "-c", bam_path])
-    return int(out.decode().strip())
+# default TSS set for FRiP(TSS); override with references.tss_bed
+TSS_SITES = "/mnt/jw01-aruk-home01/projects/psa_functional_genomics/NEW_references/genes/gencode.v29.TSS_sites_protein_coding_sorted.bed"
+TSS_SLOP = 2000
+
+def _chrom_sizes(bam_path: str) -> dict:
+    import pysam
+
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        return dict(zip(bam.references, bam.lengths))
 
 def _parse_picard_markdup(metrics_path: str):
     """
@@ -70,6 +70,11 @@ def _read_idxstats(idxstats_path: str):
     return rows
 
 def run_qc(Configuration):
+    import pandas as pd
+    from steps.frip import compute_frip
+    from steps.intervals import IntervalSet
+    from steps import gates, qcstore, refcache
+
     sample = Configuration.file_to_process
 
     # Paths
@@ -87,26 +92,34 @@ def run_qc(Configuration):
     if not os.path.exists(peaks_narrow):
         raise FileNotFoundError(f"MACS3 peaks not found: {peaks_narrow}")
 
-    # TSS for FRiP(TSS)
-    tss_sites = "/mnt/jw01-aruk-home01/projects/psa_functional_genomics/NEW_references/genes/gencode.v29.TSS_sites_protein_coding_sorted.bed"
-    tss_bed = pbed.BedTool(tss_sites).slop(b=2000, g=bed_genome_file)
-
-    def wccount(filename):
-        out = subprocess.check_output(["wc", "-l", filename])
-        return int(out.split()[0])
-
-    def calculate_frip(tss_bed, peak_bed, bam_file):
-        bam_bed = pbed.BedTool(bam_file)
-        reads_in_tss = wccount(bam_bed.intersect(tss_bed, bed=True, u=True).fn)
-        reads_in_peaks = wccount(bam_bed.intersect(peak_bed, bed=True, u=True).fn)
-        total_reads = _samtools_count(bam_bed.fn)
-        return reads_in_tss / total_reads, reads_in_peaks / total_reads, total_reads
-
-    frip_tss, frip_peaks, total_reads = calculate_frip(
-        tss_bed,
-        pbed.BedTool(peaks_narrow),
-        filtered_bam
-    )
+    # Region sets for FRiP: TSS +/- 2 kb (clipped to the genome's, else the
+    # BAM's, contig lengths), MACS3 peaks, plus any extra named sets from
+    # options.frip_regions. reference-derived sets come from the reference cache
+    chrom_sizes = refcache.chrom_sizes(Configuration) or _chrom_sizes(filtered_bam)
+    region_sets = {
+        "tss_2kb": refcache.tss_windows(Configuration, chrom_sizes),
+        "peaks_macs3": IntervalSet.from_bed(peaks_narrow),
+    }
+    for name, bed in (getattr(Configuration, "frip_regions", None) or {}).items():
+        region_sets[name] = refcache.intervals(Configuration, bed, kind="regions")
+
+    frip_mode = getattr(Configuration, "frip_mode", "read")
+    if Configuration.fragments_input:
+        # the fragments file has one line per fragment: FRiP is per fragment
+        from steps.fragments import fragments_path
+        from steps.frip import compute_frip_fragments
+
+        if frip_mode != "fragment":
+            logging.info(f"qc: fragments_input counts FRiP per fragment (frip_mode '{frip_mode}' ignored)")
+        frip_mode = "fragment"
+        frip = compute_frip_fragments(fragments_path(Configuration, sample), region_sets)
+    else:
+        frip = compute_frip(
+            filtered_bam,
+            region_sets,
+            mode=frip_mode,
+            threads=Configuration.threads,
+        )
 
     # Mito fraction from idxstats (produced in dedup_QC_alignments)
     mito_fraction = None
@@ -127,45 +140,31 @@ def run_qc(Configuration):
             dup_rate = None
 
     # Write per-sample metrics
+    total_key = "total_reads_filtered_bam" if frip_mode == "read" else "total_fragments_filtered_bam"
     metrics = {
         "sample": sample,
-        "total_reads_filtered_bam": total_reads,
-        "frip_tss_2kb": frip_tss,
-        "frip_peaks_macs3": frip_peaks,
-        "mito_fraction_mapped": mito_fraction,
-        "picard_percent_duplication": dup_rate,
+        "frip_mode": frip_mode,
+        total_key: frip["total"],
     }
+    for name in region_sets:
+        metrics[f"frip_{name}"] = frip[f"frip_{name}"]
+    metrics["mito_fraction_mapped"] = mito_fraction
+    metrics["picard_percent_duplication"] = dup_rate
+    # QC gate outcomes (options.qc_gates): qc_status, qc_reasons, gate metrics
+    metrics.update(gates.qc_columns(Configuration, sample))
 
     out_path = os.path.join(qc_dir, f"{sample}_qc_metrics.tsv")
     pd.DataFrame([metrics]).to_csv(out_path, sep="\t", index=False)
     logging.info(f"Wrote QC metrics: {out_path}")
 
-    # Update combined metrics table across all samples (scan qc dirs)
-    sample_dirs = [os.path.basename(x) for x in glob.glob(os.path.join(Configuration.other_qc_dir, "*"))]
-    rows = []
-    for s in sample_dirs:
-        p = os.path.join(Configuration.other_qc_dir, s, f"{s}_qc_metrics.tsv")
-        if os.path.exists(p):
-            rows.append(pd.read_csv(p, sep="\t"))
-    if rows:
-        combined = pd.concat(rows, ignore_index=True)
-        combined_out = os.path.join(Configuration.other_qc_dir, "qc_metrics_all_samples.tsv")
-        combined.to_csv(combined_out, sep="\t", index=False)
-        logging.info(f"Updated combined QC metrics: {combined_out}")
-
-    # Fragment length plot across all samples (as you had)
-    raw_samples = [os.path.basename(x) for x in glob.glob(os.path.join(Configuration.RAW_input_dir, "*"))]
-    plt.figure()
-    for s in raw_samples:
-        frag_file = os.path.join(Configuration.other_qc_dir, s, f"{s}_fragment_length_count.txt")
-        if not os.path.exists(frag_file):
-            continue
-        data = pd.read_csv(frag_file, sep=" ", header=None)
-        plt.plot(data[1].to_numpy(), (data[0] / sum(data[0])).to_numpy(), label=s)
-
-    plt.xlim(1, 1000)
-    plt.ylim(1e-5, 1e-1)
-    plt.yscale("log")
-    plt.legend()
-    plt.savefig(os.path.join(Configuration.other_qc_dir, "fraglength_fig.png"))
-    plt.close()
\ No newline at end of file
+    # cohort table / fragment length figure: this sample's row goes into the
+    # QC store; qc_report builds the combined outputs once per cohort
+    # (with options.fragments_input, the filtered fragments' lengths)
+    if Configuration.fragments_input:
+        from steps import fraglen
+        from steps.fragments import fragments_path
+
+        fragments = fraglen.from_fragments(fragments_path(Configuration, sample))
+    else:
+        fragments = qcstore.sample_fragments(qc_dir, sample)
+    qcstore.upsert_sample(Configuration, sample, metrics, fragments)
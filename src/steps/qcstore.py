@@ -0,0 +1,166 @@
+########################################
+# cohort QC store
+#
+# run_qc upserts one row per sample (metrics + fixed-bin fragment length
+# histogram, steps.fraglen)
+# into {other_qc_dir}/qc_store.sqlite; the combined TSV and the fragment
+# length figure are built from the store once per cohort (qc_report step)
+# instead of every sample rereading every other sample's files.
+#
+# writers take an flock on a side file around each transaction: sqlite's own
+# locking is not reliable on Lustre / NFS, and the journal is kept in the
+# default rollback mode (WAL needs shared memory across nodes).
+########################################
+
+import os
+import json
+import time
+import glob
+import fcntl
+import sqlite3
+import logging
+from contextlib import contextmanager
+from typing import Dict, Optional
+
+import numpy as np
+
+from steps import fraglen
+
+STORE_NAME = "qc_store.sqlite"
+COMBINED_TSV = "qc_metrics_all_samples.tsv"
+FRAGLEN_FIG = "fraglength_fig.png"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS metrics (
+    sample TEXT PRIMARY KEY,
+    updated REAL NOT NULL,
+    metrics TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS fraglen_bins (
+    sample TEXT PRIMARY KEY,
+    updated REAL NOT NULL,
+    counts BLOB NOT NULL
+);
+"""
+
+def store_path(Configuration) -> str:
+    return os.path.join(Configuration.other_qc_dir, STORE_NAME)
+
+@contextmanager
+def open_store(Configuration, *, write: bool = False):
+    """sqlite connection to the cohort store; write=True holds the lock until commit."""
+    path = store_path(Configuration)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path + ".lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX if write else fcntl.LOCK_SH)
+        except OSError as e:
+            # filesystem mounted without flock support: fall back to sqlite's own locking
+            logging.warning(f"qc store: could not lock {path}.lock ({e})")
+        conn = sqlite3.connect(path, timeout=600)
+        try:
+            conn.executescript(_SCHEMA)
+            yield conn
+            conn.commit()
+        finally:
+            conn.close()
+
+def sample_fragments(qc_dir: str, sample: str) -> Optional[np.ndarray]:
+    """The sample's fixed-bin histogram (.npy, else the legacy text file), or None."""
+    npy = os.path.join(qc_dir, f"{sample}_fragment_lengths.npy")
+    if os.path.exists(npy):
+        return fraglen.load(npy)
+    text = os.path.join(qc_dir, f"{sample}_fragment_length_count.txt")
+    if os.path.exists(text):
+        return fraglen.load_text(text)
+    return None
+
+def _json(value) -> str:
+    # numpy scalars -> python
+    return json.dumps(value, default=lambda v: v.item() if hasattr(v, "item") else str(v))
+
+def _put_fragments(conn, sample: str, updated: float, counts: np.ndarray) -> None:
+    conn.execute(
+        "INSERT OR REPLACE INTO fraglen_bins (sample, updated, counts) VALUES (?, ?, ?)",
+        (sample, updated, np.ascontiguousarray(counts, dtype="<u8").tobytes()),
+    )
+
+def upsert_sample(Configuration, sample: str, metrics: Dict[str, object],
+                  fragments: Optional[np.ndarray] = None) -> None:
+    """Insert or replace one sample's QC row (and fragment length histogram)."""
+    now = time.time()
+    with open_store(Configuration, write=True) as conn:
+        conn.execute(
+            "INSERT OR REPLACE INTO metrics (sample, updated, metrics) VALUES (?, ?, ?)",
+            (sample, now, _json(metrics)),
+        )
+        if fragments is not None:
+            _put_fragments(conn, sample, now, fragments)
+    logging.info(f"qc store: updated {sample}")
+
+def _backfill(Configuration, conn) -> int:
+    """Add samples whose per-sample QC files predate the store (only those)."""
+    import pandas as pd
+
+    known = {r[0] for r in conn.execute("SELECT sample FROM metrics")}
+    known_fragments = {r[0] for r in conn.execute("SELECT sample FROM fraglen_bins")}
+    added = 0
+    for p in glob.glob(os.path.join(Configuration.other_qc_dir, "*", "*_qc_metrics.tsv")):
+        s = os.path.basename(os.path.dirname(p))
+        if os.path.basename(p) != f"{s}_qc_metrics.tsv":
+            continue
+        if s not in known:
+            row = pd.read_csv(p, sep="\t").iloc[0].to_dict()
+            conn.execute(
+                "INSERT OR REPLACE INTO metrics (sample, updated, metrics) VALUES (?, ?, ?)",
+                (s, os.path.getmtime(p), _json({k: (None if pd.isna(v) else v) for k, v in row.items()})),
+            )
+            added += 1
+        if s not in known_fragments:
+            counts = sample_fragments(os.path.dirname(p), s)
+            if counts is not None:
+                _put_fragments(conn, s, time.time(), counts)
+    return added
+
+def _atomic(path: str) -> str:
+    return f"{path}.tmp.{os.getpid()}"
+
+def qc_report(Configuration):
+    """
+    Cohort QC outputs, from the store:
+      - {other_qc_dir}/qc_metrics_all_samples.tsv, with the fragment length
+        statistics of steps.fraglen.summarise (NFR / mono / di fractions,
+        helical periodicity, ...)
+      - {other_qc_dir}/fraglength_fig.png
+    Samples with per-sample QC files but no store row yet are imported first.
+    """
+    import pandas as pd
+
+    with open_store(Configuration, write=True) as conn:
+        added = _backfill(Configuration, conn)
+        if added:
+            logging.info(f"qc store: imported {added} sample(s) from existing QC files")
+        metrics = [json.loads(m) for (m,) in conn.execute("SELECT metrics FROM metrics ORDER BY sample")]
+        rows = conn.execute("SELECT sample, counts FROM fraglen_bins ORDER BY sample").fetchall()
+
+    if not metrics:
+        logging.warning("qc_report: no samples in the QC store yet")
+        return
+
+    # one (samples x bins) matrix for the statistics and the figure
+    labels = [s for s, _ in rows]
+    mat = fraglen.stack([np.frombuffer(b, dtype="<u8") for _, b in rows])
+
+    table = pd.DataFrame(metrics)
+    if labels:
+        stats = pd.DataFrame(fraglen.summarise(mat))
+        stats.insert(0, "sample", labels)
+        table = table.merge(stats, on="sample", how="left")
+
+    combined_out = os.path.join(Configuration.other_qc_dir, COMBINED_TSV)
+    tmp = _atomic(combined_out)
+    table.to_csv(tmp, sep="\t", index=False)
+    os.replace(tmp, combined_out)
+    logging.info(f"Updated combined QC metrics: {combined_out} ({len(metrics)} samples)")
+
+    fraglen.plot_cohort(mat, labels, os.path.join(Configuration.other_qc_dir, FRAGLEN_FIG))
@@ -0,0 +1,210 @@
+########################################
+# per-genome reference cache
+#
+# interval sets derived from reference files (TSS +/- slop windows, the
+# blacklist, extra FRiP region sets) and the chromosome sizes are built once
+# and stored under {reference_cache_dir}/<kind>-<key>/ as flat sorted int64
+# arrays (IntervalSet.save), which later steps memory-map instead of
+# reparsing the BED. the key is a hash of the source file's sha256 and the
+# build parameters, so an edited reference gets a new entry.
+#
+# entries are built in a temporary directory and renamed into place, so
+# concurrent array tasks never see a half-written entry.
+########################################
+
+import os
+import json
+import shutil
+import hashlib
+import logging
+import tempfile
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from steps.helpers import sha256_file
+from steps.intervals import IntervalSet, _open_text
+
+CACHE_VERSION = 1
+
+def cache_dir(Configuration) -> str:
+    return Configuration.reference_cache_dir
+
+def enabled(Configuration) -> bool:
+    return bool(getattr(Configuration, "reference_cache", True)) and bool(getattr(Configuration, "reference_cache_dir", None))
+
+def _key(**parts) -> str:
+    return hashlib.sha256(json.dumps(dict(parts, version=CACHE_VERSION), sort_keys=True).encode()).hexdigest()[:20]
+
+def _entry(Configuration, kind: str, key: str, build, source: str) -> str:
+    """Directory of the cache entry, building it with build(tmp_dir) if needed."""
+    root = cache_dir(Configuration)
+    target = os.path.join(root, f"{kind}-{key}")
+    if os.path.exists(os.path.join(target, "meta.json")):
+        return target
+
+    os.makedirs(root, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix=f".{kind}-", dir=root)
+    try:
+        build(tmp)
+        with open(os.path.join(tmp, "meta.json"), "w") as f:
+            json.dump({"kind": kind, "source": source, "key": key, "version": CACHE_VERSION}, f, indent=1)
+        os.rename(tmp, target)
+        logging.info(f"reference cache: built {kind} from {source}")
+    except OSError:
+        # another task renamed the same entry into place first
+        shutil.rmtree(tmp, ignore_errors=True)
+        if not os.path.exists(os.path.join(target, "meta.json")):
+            raise
+    except BaseException:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return target
+
+def chrom_sizes(Configuration) -> Optional[Dict[str, int]]:
+    """Chromosome sizes of references.genome_fasta (from its .fai), or None."""
+    fasta = getattr(Configuration, "genome_fasta", None)
+    fai = f"{fasta}.fai" if fasta else None
+    if not fai or not os.path.exists(fai):
+        return None
+    if not enabled(Configuration):
+        return _read_fai(fai)
+
+    def _build(tmp):
+        with open(os.path.join(tmp, "chrom.sizes"), "w") as f:
+            for chrom, size in _read_fai(fai).items():
+                f.write(f"{chrom}\t{size}\n")
+
+    entry = _entry(Configuration, "chrom_sizes", _key(kind="chrom_sizes", source=sha256_file(fai)), _build, fai)
+    with open(os.path.join(entry, "chrom.sizes")) as f:
+        return {c: int(n) for c, n in (line.split("\t")[:2] for line in f if line.strip())}
+
+def _read_fai(path: str) -> Dict[str, int]:
+    sizes = {}
+    with open(path) as f:
+        for line in f:
+            parts = line.split("\t")
+            if len(parts) >= 2:
+                sizes[parts[0]] = int(parts[1])
+    return sizes
+
+def intervals(
+    Configuration,
+    bed_path: str,
+    *,
+    slop: int = 0,
+    chrom_sizes: Optional[Dict[str, int]] = None,
+    kind: str = "bed",
+) -> IntervalSet:
+    """
+    IntervalSet.from_bed(bed_path, slop=..., chrom_sizes=...), served from
+    the cache (memory-mapped) when options.reference_cache is on.
+    """
+    if not enabled(Configuration):
+        return IntervalSet.from_bed(bed_path, slop=slop, chrom_sizes=chrom_sizes)
+
+    sizes_digest = None
+    if slop and chrom_sizes is not None:
+        sizes_digest = hashlib.sha256(json.dumps(sorted(chrom_sizes.items())).encode()).hexdigest()
+    key = _key(kind=kind, source=sha256_file(bed_path), slop=slop, chrom_sizes=sizes_digest)
+
+    def _build(tmp):
+        IntervalSet.from_bed(bed_path, slop=slop, chrom_sizes=chrom_sizes).save(tmp)
+
+    return IntervalSet.load(_entry(Configuration, kind, key, _build, bed_path))
+
+def tss_windows(Configuration, chrom_sizes: Optional[Dict[str, int]] = None) -> IntervalSet:
+    """Merged TSS +/- qc.TSS_SLOP windows (references.tss_bed, else the qc.py default)."""
+    from steps import qc
+
+    tss_bed = getattr(Configuration, "tss_bed", None) or qc.TSS_SITES
+    return intervals(Configuration, tss_bed, slop=qc.TSS_SLOP, chrom_sizes=chrom_sizes, kind="tss_windows")
+
+def _read_tss_sites(bed_path: str) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    Unique (position, strand) TSSs per chromosome, sorted by position. The
+    TSS is the BED start on + (or unstranded) lines and end - 1 on - lines.
+    """
+    raw: Dict[str, set] = {}
+    with _open_text(bed_path) as f:
+        for line in f:
+            if not line.strip() or line.startswith(("#", "track", "browser")):
+                continue
+            parts = line.rstrip("\n").split("\t")
+            chrom, start, end = parts[0], int(parts[1]), int(parts[2])
+            minus = len(parts) > 5 and parts[5] == "-"
+            raw.setdefault(chrom, set()).add((end - 1, -1) if minus else (start, 1))
+    sites = {}
+    for chrom, entries in raw.items():
+        arr = np.array(sorted(entries), dtype=np.int64).reshape(-1, 2)
+        sites[chrom] = (arr[:, 0].copy(), arr[:, 1].astype(np.int8))
+    return sites
+
+def tss_sites(Configuration) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+    """
+    {chrom: (positions, strands)} of references.tss_bed (else the qc.py
+    default): sorted int64 positions and +1 / -1 int8 strands, memory-mapped
+    from the cache.
+    """
+    from steps import qc
+
+    tss_bed = getattr(Configuration, "tss_bed", None) or qc.TSS_SITES
+    if not enabled(Configuration):
+        return _read_tss_sites(tss_bed)
+
+    def _build(tmp):
+        sites = _read_tss_sites(tss_bed)
+        names = sorted(sites)
+        offsets, lo = {}, 0
+        for c in names:
+            offsets[c] = [lo, lo + len(sites[c][0])]
+            lo += len(sites[c][0])
+        np.save(os.path.join(tmp, "positions.npy"),
+                np.concatenate([sites[c][0] for c in names] or [np.zeros(0, dtype=np.int64)]))
+        np.save(os.path.join(tmp, "strands.npy"),
+                np.concatenate([sites[c][1] for c in names] or [np.zeros(0, dtype=np.int8)]))
+        with open(os.path.join(tmp, "chroms.json"), "w") as f:
+            json.dump(offsets, f)
+
+    entry = _entry(Configuration, "tss_sites", _key(kind="tss_sites", source=sha256_file(tss_bed)), _build, tss_bed)
+    positions = np.load(os.path.join(entry, "positions.npy"), mmap_mode="r")
+    strands = np.load(os.path.join(entry, "strands.npy"), mmap_mode="r")
+    with open(os.path.join(entry, "chroms.json")) as f:
+        offsets = json.load(f)
+    return {c: (positions[lo:hi], strands[lo:hi]) for c, (lo, hi) in offsets.items()}
+
+def blacklist(Configuration) -> Optional[IntervalSet]:
+    """Merged options.blacklist_bed, or None when unset."""
+    bl = getattr(Configuration, "blacklist_bed", None)
+    if not bl:
+        return None
+    return intervals(Configuration, bl, kind="blacklist")
+
+def prepare_references(Configuration):
+    """
+    Build the cache entries for this configuration ahead of the sample
+    steps: chromosome sizes, TSS windows, blacklist and options.frip_regions.
+    Missing sources are reported and left to the steps that need them.
+    """
+    if not enabled(Configuration):
+        logging.info("prepare_references: reference cache disabled")
+        return
+
+    sizes = chrom_sizes(Configuration)
+    if sizes is None:
+        logging.warning("prepare_references: no genome_fasta .fai; TSS windows will be clipped to each BAM's header")
+
+    jobs = [("TSS windows", lambda: tss_windows(Configuration, sizes)),
+            ("TSS sites", lambda: tss_sites(Configuration)),
+            ("blacklist", lambda: blacklist(Configuration))]
+    for name, bed in (getattr(Configuration, "frip_regions", None) or {}).items():
+        jobs.append((f"FRiP regions {name}", lambda bed=bed: intervals(Configuration, bed, kind="regions")))
+
+    for label, job in jobs:
+        try:
+            result = job()
+        except FileNotFoundError as e:
+            logging.warning(f"prepare_references: {label}: {e}")
+            continue
+        if result is not None:
+            logging.info(f"prepare_references: {label}: {len(result)} entries")
@@ -0,0 +1,149 @@
+########################################
+# contig / region sharding of indexed BAMs
+#
+# a coordinate-sorted, indexed BAM is split into shards through its index:
+# one per contig, and large contigs into equal-width regions so every shard
+# holds about SHARD_READS mapped reads. a step's per-shard function runs in
+# a process pool (fork), one shard at a time per worker, and the results
+# come back in genome order for a step-specific reducer:
+#   - concat_bams: shard BAMs -> one BAM + index, in shard order, no re-sort
+#   - concat_files: shard text / gzip files -> one file
+#   - sum_counts: dicts of counts
+# a record belongs to the shard its reference_start falls in (fetch), so
+# records spanning a region boundary are seen exactly once.
+########################################
+
+import os
+import shutil
+import logging
+import tempfile
+import multiprocessing
+from contextlib import contextmanager
+from functools import partial
+from typing import Callable, Dict, Iterable, List, NamedTuple, Optional
+
+from steps.procpipe import partial_path, run_pipeline
+
+# mapped reads per shard; contigs with more are split into regions
+SHARD_READS = 5_000_000
+
+class Shard(NamedTuple):
+    """Records of `contig` starting in [start, end); index is the shard's position in genome order."""
+    index: int
+    contig: str
+    start: int
+    end: int
+
+    @property
+    def name(self) -> str:
+        return f"{self.index:05d}"
+
+def plan(
+    bam_path: str,
+    *,
+    contigs: Optional[Iterable[str]] = None,
+    exclude: Iterable[str] = (),
+    shard_reads: Optional[int] = None,
+    include_unmapped: bool = False,
+) -> List[Shard]:
+    """
+    Shards of the mapped contigs of bam_path (optionally only `contigs`,
+    never `exclude`), in header order, about shard_reads (default
+    SHARD_READS) mapped reads each. include_unmapped also counts (and
+    keeps contigs holding only) unmapped reads placed by their mate;
+    unplaced reads are never part of a shard. Needs the BAM index.
+    """
+    import pysam
+
+    shard_reads = shard_reads or SHARD_READS
+
+    wanted = set(contigs) if contigs is not None else None
+    skip = set(exclude)
+    shards = []
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        if not bam.has_index():
+            raise FileNotFoundError(f"sharding needs an indexed BAM: {bam_path}")
+        for stat in bam.get_index_statistics():
+            contig = stat.contig
+            reads = stat.total if include_unmapped else stat.mapped
+            if not reads or contig in skip or (wanted is not None and contig not in wanted):
+                continue
+            length = bam.get_reference_length(contig)
+            n = max(1, min(-(-reads // max(1, shard_reads)), length))
+            bounds = [length * i // n for i in range(n + 1)]
+            for lo, hi in zip(bounds[:-1], bounds[1:]):
+                shards.append(Shard(len(shards), contig, lo, hi))
+    return shards
+
+def fetch(bam, shard: Shard):
+    """Records of the shard from an open pysam.AlignmentFile."""
+    start = shard.start
+    for read in bam.fetch(shard.contig, start, shard.end):
+        if read.reference_start >= start:
+            yield read
+
+def run(func: Callable, shards: List[Shard], *, threads: int = 1, **kwargs) -> list:
+    """[func(shard, **kwargs) for shard in shards], across up to `threads` processes, in shard order."""
+    call = partial(func, **kwargs)
+    workers = max(1, min(threads, len(shards)))
+    if workers == 1:
+        return [call(s) for s in shards]
+    with multiprocessing.get_context("fork").Pool(workers) as pool:
+        return pool.map(call, shards, chunksize=1)
+
+@contextmanager
+def workdir(near: str, tmp_dir: Optional[str] = None):
+    """Scratch directory for shard files ($TMPDIR-style tmp_dir, else next to `near`), removed afterwards."""
+    path = tempfile.mkdtemp(prefix=".shards-", dir=tmp_dir or os.path.dirname(os.path.abspath(near)))
+    try:
+        yield path
+    finally:
+        shutil.rmtree(path, ignore_errors=True)
+
+def shard_writer(path: str, header):
+    """Uncompressed BAM for one shard; concat_bams compresses once, with every thread."""
+    import pysam
+
+    return pysam.AlignmentFile(path, "wbu", header=header)
+
+def concat_bams(parts: List[str], out_bam: str, *, header_from: str, threads: int = 1,
+                timeout: Optional[float] = None) -> None:
+    """Shard BAMs, in order, into out_bam with its .bai written in the same pass (procpipe timeout)."""
+    import pysam
+
+    index = out_bam + ".bai"
+    if not parts:
+        with pysam.AlignmentFile(header_from, "rb") as bam, \
+                pysam.AlignmentFile(out_bam, "wb", header=bam.header):
+            pass
+        pysam.index(out_bam, index)
+        return
+    run_pipeline(
+        [
+            ["samtools", "cat", "-o", "-"] + list(parts),
+            ["samtools", "view", "-b", "-@", str(max(1, threads)),
+             "--write-index", "-o", f"{partial_path(out_bam)}##idx##{partial_path(index)}", "-"],
+        ],
+        outputs=[out_bam, index],
+        timeout=timeout,
+    )
+
+def concat_files(parts: List[str], out_path: str) -> None:
+    """Byte-concatenate shard files (gzip members concatenate into valid gzip)."""
+    tmp = out_path + ".tmp"
+    with open(tmp, "wb") as out:
+        for p in parts:
+            with open(p, "rb") as f:
+                shutil.copyfileobj(f, out)
+    os.replace(tmp, out_path)
+
+def sum_counts(counts: List[Dict[str, int]]) -> Dict[str, int]:
+    total: Dict[str, int] = {}
+    for c in counts:
+        for k, v in c.items():
+            total[k] = total.get(k, 0) + v
+    return total
+
+def log_plan(label: str, shards: List[Shard], threads: int) -> None:
+    contigs = len({s.contig for s in shards})
+    logging.info(f"{label}: {len(shards)} shards over {contigs} contigs, {max(1, min(threads, len(shards)))} workers")
@@ -0,0 +1,208 @@
+########################################
+# parallel Tn5-shifted BAM
+#
+# the native replacement for ATACseqQC::shiftGAlignmentsList. each shard
+# (steps/shards.py) of the filtered BAM is read through the index by a pool
+# worker, which moves + strand alignments by +4 bp and - strand alignments
+# by -5 bp, fixes the mate position and TLEN to match, and writes a shard
+# BAM. shifting moves
+# records by at most 9 bp relative to each other, so a small reorder buffer
+# keeps each shard sorted; a record goes to the shard its shifted start
+# falls in. shards are concatenated in genome order (no global re-sort) and
+# the index is written in the same pass.
+#
+# shards are written uncompressed (to $TMPDIR when set), so the workers do
+# no compression and the final samtools view compresses with every thread.
+# the same pass can write the shifted reads as BED and the shifted
+# fragments (one line per pair).
+########################################
+
+import os
+import gzip
+import heapq
+import logging
+from typing import Dict, Optional
+
+from steps import shards
+from steps.helpers import outputs_exist
+from steps.tsse import TN5_SHIFT_MINUS, TN5_SHIFT_PLUS
+
+SHIFT_OUTPUTS = ("bed", "fragments")
+
+# reorder window: a record can move ahead of one that started this far before it
+_MAX_MOVE = TN5_SHIFT_PLUS - TN5_SHIFT_MINUS
+
+def output_paths(out_dir: str, sample: str, extra=()) -> Dict[str, str]:
+    paths = {
+        "bam": os.path.join(out_dir, f"{sample}_shifted.bam"),
+        "bai": os.path.join(out_dir, f"{sample}_shifted.bam.bai"),
+    }
+    if "bed" in extra:
+        paths["bed"] = os.path.join(out_dir, f"{sample}_shifted.bed.gz")
+    if "fragments" in extra:
+        paths["fragments"] = os.path.join(out_dir, f"{sample}_shifted_fragments.bed.gz")
+    return paths
+
+def _offset(is_reverse: bool) -> int:
+    return TN5_SHIFT_MINUS if is_reverse else TN5_SHIFT_PLUS
+
+def shift_read(read, length: int) -> None:
+    """Move a mapped record by its Tn5 offset (clipped to the contig) and fix mate position / TLEN."""
+    own = _offset(read.is_reverse)
+    span = read.reference_length or 0
+    read.reference_start = min(max(0, read.reference_start + own), max(0, length - span))
+    if read.is_paired and not read.mate_is_unmapped:
+        mate = _offset(read.mate_is_reverse)
+        read.next_reference_start = max(0, read.next_reference_start + mate)
+        if read.template_length:
+            # TLEN runs from the leftmost to the rightmost end of the pair; each
+            # end moves with its own read, whichever side this read is on
+            read.template_length = read.template_length + mate - own
+
+class _Reorder:
+    """Emit items in position order, given positions that lag the input by at most _MAX_MOVE."""
+
+    def __init__(self, emit):
+        self.emit = emit
+        self._heap = []
+        self._n = 0
+
+    def push(self, pos: int, item) -> None:
+        heapq.heappush(self._heap, (pos, self._n, item))
+        self._n += 1
+
+    def release(self, upto: int) -> None:
+        heap = self._heap
+        while heap and heap[0][0] < upto:
+            self.emit(heapq.heappop(heap)[2])
+
+    def flush(self) -> None:
+        self.release(float("inf"))
+
+def _open_text(path: Optional[str]):
+    if path is None:
+        return None
+    return gzip.open(path, "wt", compresslevel=4)
+
+def _shard_worker(shard, *, bam_path: str, work: str, extra) -> dict:
+    """
+    Shift the records whose shifted start falls in the shard into shard
+    files; returns the record / fragment counts.
+    """
+    import pysam
+
+    base = os.path.join(work, shard.name)
+    counts = {"reads": 0, "fragments": 0}
+    with pysam.AlignmentFile(bam_path, "rb") as bam, shards.shard_writer(base + ".bam", bam.header) as out:
+        length = bam.get_reference_length(shard.contig)
+        bed = _open_text(base + ".bed.gz" if "bed" in extra else None)
+        frags = _open_text(base + ".fragments.bed.gz" if "fragments" in extra else None)
+        try:
+            records = _Reorder(out.write)
+            bed_lines = _Reorder(bed.write) if bed else None
+            frag_lines = _Reorder(frags.write) if frags else None
+
+            # + strand records starting up to 4 bp before the shard and - strand
+            # records starting up to 5 bp after it shift into it
+            lo = max(0, shard.start - TN5_SHIFT_PLUS)
+            hi = min(length, shard.end - TN5_SHIFT_MINUS)
+            for read in bam.fetch(shard.contig, lo, hi):
+                if read.is_unmapped or read.reference_start < lo:
+                    continue
+                upto = read.reference_start - _MAX_MOVE
+                shift_read(read, length)
+                start = read.reference_start
+                if not shard.start <= start < shard.end:
+                    continue
+                records.push(start, read)
+                records.release(upto)
+                counts["reads"] += 1
+
+                if bed_lines is not None:
+                    strand = "-" if read.is_reverse else "+"
+                    bed_lines.push(start, f"{shard.contig}\t{start}\t{read.reference_end}\t{read.query_name}\t{read.mapping_quality}\t{strand}\n")
+                    bed_lines.release(upto)
+                if frag_lines is not None:
+                    if read.is_proper_pair and read.template_length > 0:
+                        frag_lines.push(start, f"{shard.contig}\t{start}\t{start + read.template_length}\t{read.query_name}\n")
+                        counts["fragments"] += 1
+                    frag_lines.release(upto)
+
+            for buf in (records, bed_lines, frag_lines):
+                if buf is not None:
+                    buf.flush()
+        finally:
+            for f in (bed, frags):
+                if f is not None:
+                    f.close()
+    return counts
+
+def shift_bam(
+    bam_path: str,
+    out_paths: Dict[str, str],
+    *,
+    threads: int = 1,
+    tmp_dir: Optional[str] = None,
+    timeout: Optional[float] = None,
+) -> dict:
+    """
+    Write the Tn5-shifted copy of bam_path (indexed, coordinate-sorted) to
+    out_paths["bam"] (+ .bai), and the optional "bed" / "fragments"
+    outputs. Unplaced reads are dropped, as in ATACseqQC. timeout applies
+    to the shard concatenation pipeline.
+    """
+    plan = shards.plan(bam_path)
+    shards.log_plan("tn5shift", plan, threads)
+    extra = [k for k in SHIFT_OUTPUTS if k in out_paths]
+    with shards.workdir(out_paths["bam"], tmp_dir) as work:
+        results = shards.run(_shard_worker, plan, threads=threads, bam_path=bam_path, work=work, extra=extra)
+        parts = [os.path.join(work, s.name) for s in plan]
+        shards.concat_bams([p + ".bam" for p in parts], out_paths["bam"], header_from=bam_path, threads=threads,
+                           timeout=timeout)
+        for key, suffix in (("bed", ".bed.gz"), ("fragments", ".fragments.bed.gz")):
+            if key in out_paths:
+                shards.concat_files([p + suffix for p in parts], out_paths[key])
+
+    counts = shards.sum_counts(results)
+    counts["contigs"] = len({s.contig for s in plan})
+    logging.info(
+        f"tn5shift: {os.path.basename(out_paths['bam'])} {counts.get('reads', 0)} reads over {counts['contigs']} contigs"
+        + (f", {counts.get('fragments', 0)} fragments" if "fragments" in out_paths else "")
+    )
+    return counts
+
+def run_tn5shift(Configuration):
+    """
+    Tn5-shifted copy of the filtered BAM:
+      {cleaned_alignments_dir}/{sample}/{sample}_align_dedup_filtered.bam
+
+    Outputs go to the ATACseqQC directory ({other_qc_dir}/{sample}/ATACseqQC/):
+      - {sample}_shifted.bam (+ .bai)
+      - {sample}_shifted.bed.gz             with options.shifted_outputs: [bed]
+      - {sample}_shifted_fragments.bed.gz   with options.shifted_outputs: [fragments]
+    """
+    from steps.ATACseqQC import get_output_dir
+
+    sample = Configuration.file_to_process
+    bam_file = os.path.join(
+        Configuration.cleaned_alignments_dir,
+        sample,
+        f"{sample}_align_dedup_filtered.bam"
+    )
+    if not os.path.exists(bam_file):
+        raise FileNotFoundError(f"Tn5 shift input BAM not found: {bam_file}")
+
+    extra = list(getattr(Configuration, "shifted_outputs", None) or [])
+    unknown = [k for k in extra if k not in SHIFT_OUTPUTS]
+    if unknown:
+        raise ValueError(f"Unknown shifted_outputs {unknown} (expected any of {SHIFT_OUTPUTS})")
+
+    out_dir = get_output_dir(Configuration, sample)
+    os.makedirs(out_dir, exist_ok=True)
+    out = output_paths(out_dir, sample, extra)
+    if (not Configuration.force) and outputs_exist(list(out.values())):
+        logging.info("tn5shift: outputs exist; skipping (use --force to overwrite)")
+        return
+
+    shift_bam(bam_file, out, threads=Configuration.threads, tmp_dir=os.environ.get("TMPDIR"),
+              timeout=Configuration.pipeline_timeout)
@@ -1,11 +1,135 @@
 import os
+import time
+import shutil
 import logging
-from steps.helpers import outputs_exist, clean_dir, run_cmd
+import subprocess
+from steps.helpers import outputs_exist, clean_dir, run_cmd, wait_profiled
+from steps.procpipe import Pipeline, Watchdog, run_pipelines
+
+# Nextera / Tn5 adapter; override with options.adapter_sequence(_r2)
+DEFAULT_ADAPTER = "AGATGTGTATAAGAGACAG"
+LENGTH_REQUIRED = 30
+
+R1_SUFFIXES = ("1.fq.gz", "1.fastq.gz")
+R2_SUFFIXES = ("2.fq.gz", "2.fastq.gz")
+
+def _lane_key(name: str, suffixes) -> str:
+    for s in suffixes:
+        if name.endswith(s):
+            return name[: -len(s)]
+    return name
+
+def _pair_lanes(R1_files, R2_files):
+    """
+    Check that the sorted R1 and R2 lists pair up lane by lane (same name
+    apart from the read number), so R1 and R2 are concatenated in the same
+    lane order.
+    """
+    for r1, r2 in zip(R1_files, R2_files):
+        if _lane_key(r1, R1_SUFFIXES) != _lane_key(r2, R2_SUFFIXES):
+            raise RuntimeError(f"R1/R2 lanes do not pair up: {r1} vs {r2}")
+
+def _decompress_cmd(paths):
+    """pigz when installed, else gzip; -dc of several lanes writes them back to back."""
+    return ["pigz" if shutil.which("pigz") else "gzip", "-dc", *paths]
+
+def _interleave(r1, r2, out, *, block_size: int = 1 << 22) -> int:
+    """
+    Copy two FASTQ streams to out as interleaved FASTQ (R1 record, then its
+    R2 record), a block at a time: the lines are split and rejoined in C,
+    never parsed. Returns the number of pairs.
+    """
+    pairs = 0
+    rest = [b"", b""]
+    done = [False, False]
+    while True:
+        lines = []
+        for i, stream in enumerate((r1, r2)):
+            block = b"" if done[i] else stream.read(block_size)
+            done[i] = done[i] or not block
+            split = (rest[i] + block).split(b"\n")
+            if done[i] and split[-1]:
+                # no newline at the end of the stream
+                split.append(b"")
+            lines.append(split)
+        # the last element is the incomplete line after the last newline
+        n = min((len(split) - 1) // 4 for split in lines)
+        if n:
+            records = [None] * (8 * n)
+            for j in range(4):
+                records[j::8] = lines[0][j:4 * n:4]
+                records[4 + j::8] = lines[1][j:4 * n:4]
+            records.append(b"")
+            out.write(b"\n".join(records))
+            pairs += n
+        rest = [b"\n".join(split[4 * n:]) for split in lines]
+        if any(d and not r for d, r in zip(done, rest)) and any(rest):
+            raise RuntimeError(f"R1 and R2 lanes hold different numbers of reads (after {pairs} pairs)")
+        if all(done):
+            return pairs
+
+def _fastp_streamed(cmd, R1_paths, R2_paths, *, timeout=None) -> None:
+    """
+    Run fastp (cmd, reading --stdin --interleaved_in) on the lanes: one
+    pigz / gzip -dc per mate decompresses its lanes in order, and the two
+    streams are interleaved into fastp's stdin. fastp opens a file input
+    twice (evaluation, then trimming), so the lanes cannot go through named
+    pipes. All three are stopped after timeout seconds.
+    """
+    printable = " ".join(cmd)
+    start = time.time()
+    readers = []
+    for paths in (R1_paths, R2_paths):
+        reader_cmd = _decompress_cmd(paths)
+        logging.info(f"CMD: {' '.join(reader_cmd)}")
+        readers.append((reader_cmd, subprocess.Popen(reader_cmd, stdout=subprocess.PIPE)))
+    logging.info(f"CMD: {printable} < interleaved lanes")
+    proc = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+    watchdog = Watchdog([p for _, p in readers] + [proc], timeout)
+    fed = False
+    try:
+        pairs = _interleave(readers[0][1].stdout, readers[1][1].stdout, proc.stdin)
+        proc.stdin.close()
+        fed = True
+        logging.info(f"fed {pairs} read pairs from {len(R1_paths)} lanes to fastp "
+                     f"in {time.time() - start:.1f}s")
+    except BrokenPipeError:
+        # fastp exited before reading everything; its exit code says why
+        pass
+    except BaseException:
+        watchdog.cancel()
+        watchdog.kill()
+        for c, p in readers + [(cmd, proc)]:
+            wait_profiled(p, " ".join(c), start)
+        raise
+    finally:
+        try:
+            proc.stdin.close()
+        except BrokenPipeError:
+            pass
+
+    for _, p in readers:
+        if not fed:
+            p.kill()
+        p.stdout.close()
+    failed = [(c, rc) for c, rc in ((c, wait_profiled(p, " ".join(c), start)) for c, p in readers) if rc != 0]
+    rc = wait_profiled(proc, printable, start)
+    watchdog.cancel()
+    if watchdog.expired and (rc != 0 or failed or not fed):
+        raise RuntimeError(f"fastp on the streamed lanes timed out after {timeout}s")
+    if rc != 0:
+        raise subprocess.CalledProcessError(rc, cmd)
+    if fed and failed:
+        raise subprocess.CalledProcessError(failed[0][1], failed[0][0])
+    if not fed:
+        raise RuntimeError("fastp exited before reading all the lanes")
 
 def run_fastp(Configuration):
     """
     UNIVERSAL trimming:
-    - If multiple lanes: merge raw R1 and R2 files first
+    - If multiple lanes: merge the raw R1 and R2 lanes into _merged_R1/R2
+      files (or stream them into fastp's stdin as interleaved FASTQ with
+      options.stream_lanes)
     - If only one lane: use raw R1 and R2 directly
     - Then run fastp once on the final R1/R2 pair
     """
@@ -36,41 +160,59 @@ def run_fastp(Configuration):
     if len(raw_files) == 0:
         raise FileNotFoundError(f"No FASTQ files found in {input_dir}")
 
-    R1_files = [f for f in raw_files if f.endswith("1.fq.gz") or f.endswith("1.fastq.gz")]
-    R2_files = [f for f in raw_files if f.endswith("2.fq.gz") or f.endswith("2.fastq.gz")]
+    R1_files = [f for f in raw_files if f.endswith(R1_SUFFIXES)]
+    R2_files = [f for f in raw_files if f.endswith(R2_SUFFIXES)]
 
     if len(R1_files) == 0 or len(R2_files) == 0:
         raise FileNotFoundError(f"Could not find R1/R2 files for {sample}")
 
     if len(R1_files) != len(R2_files):
         raise RuntimeError(f"Mismatched number of R1 and R2 files in {input_dir}")
+    _pair_lanes(R1_files, R2_files)
 
     logging.info(f"Found {len(R1_files)} raw lanes for sample {sample}")
 
+    R1_paths = [os.path.join(input_dir, f) for f in R1_files]
+    R2_paths = [os.path.join(input_dir, f) for f in R2_files]
+    stream_lanes = len(R1_files) > 1 and getattr(Configuration, "stream_lanes", False)
+
     if len(R1_files) == 1:
         logging.info("Single lane detected – skipping merge step")
-        input_R1 = os.path.join(input_dir, R1_files[0])
-        input_R2 = os.path.join(input_dir, R2_files[0])
+        input_R1 = R1_paths[0]
+        input_R2 = R2_paths[0]
+    elif stream_lanes:
+        logging.info("Streaming lanes into fastp")
     else:
         input_R1 = os.path.join(output_dir, f"{sample}_merged_R1.fastq.gz")
         input_R2 = os.path.join(output_dir, f"{sample}_merged_R2.fastq.gz")
 
-        logging.info("Merging raw R1 files...")
-        run_cmd("cat " + " ".join([os.path.join(input_dir, f) for f in R1_files]) + f" > {input_R1}",
-                shell=True, check=True)
-
-        logging.info("Merging raw R2 files...")
-        run_cmd("cat " + " ".join([os.path.join(input_dir, f) for f in R2_files]) + f" > {input_R2}",
-                shell=True, check=True)
+        # R1 and R2 at once; each file is renamed into place only when its cat succeeded
+        logging.info("Merging raw R1 and R2 files...")
+        run_pipelines([
+            Pipeline([["cat"] + R1_paths], stdout=input_R1, label="merge_R1", timeout=Configuration.pipeline_timeout),
+            Pipeline([["cat"] + R2_paths], stdout=input_R2, label="merge_R2", timeout=Configuration.pipeline_timeout),
+        ])
 
         logging.info("Finished merging raw FASTQs")
 
-    threads = str(getattr(Configuration, "threads", 8))
+    threads = str(Configuration.threads)
 
-    cmd = [
+    if stream_lanes:
+        cmd = _fastp_cmd(Configuration, sample, ["--stdin", "--interleaved_in"],
+                         trimmed_R1, trimmed_R2, html_out, json_out, threads)
+        logging.info("Running fastp...")
+        _fastp_streamed(cmd, R1_paths, R2_paths, timeout=Configuration.pipeline_timeout)
+    else:
+        cmd = _fastp_cmd(Configuration, sample, ["-i", input_R1, "-I", input_R2],
+                         trimmed_R1, trimmed_R2, html_out, json_out, threads)
+        logging.info("Running fastp...")
+        run_cmd(cmd, check=True)
+    logging.info(f"fastp complete for sample: {sample}")
+
+def _fastp_cmd(Configuration, sample, inputs, trimmed_R1, trimmed_R2, html_out, json_out, threads):
+    return [
         "fastp",
-        "-i", input_R1,
-        "-I", input_R2,
+        *inputs,
         "-o", trimmed_R1,
         "-O", trimmed_R2,
         "-w", threads,
@@ -78,13 +220,9 @@ def run_fastp(Configuration):
         "-j", json_out,
         "-R", sample,
         "-p",
-        "--adapter_sequence=AGATGTGTATAAGAGACAG",
-        "--adapter_sequence_r2=AGATGTGTATAAGAGACAG",
+        f"--adapter_sequence={getattr(Configuration, 'adapter_sequence', DEFAULT_ADAPTER)}",
+        f"--adapter_sequence_r2={getattr(Configuration, 'adapter_sequence_r2', DEFAULT_ADAPTER)}",
         "--trim_poly_g",
         "--trim_poly_x",
-        "--length_required=30"
-    ]
-
-    logging.info("Running fastp...")
-    run_cmd(cmd, check=True)
-    logging.info(f"fastp complete for sample: {sample}")
\ No newline at end of file
+        f"--length_required={LENGTH_REQUIRED}"
+    ]
\ No newline at end of file
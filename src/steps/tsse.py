@@ -0,0 +1,265 @@
+########################################
+# streaming TSS enrichment
+#
+# every mapped read of the filtered BAM contributes its Tn5 cut site (5' end
+# shifted +4 on the + strand, -5 on the - strand). cut sites are matched to
+# the TSSs within +/- TSS_FLANK bp with numpy searchsorted on chunks of reads
+# and added to a per-base aggregate profile and a per-TSS binned matrix, so
+# memory is bounded by the TSS set, not the library depth. shards of the BAM
+# (steps/shards.py) are processed in parallel; tss_enrichment_fragments
+# reads the cut sites from the fragments file instead.
+#
+# the score follows ATACseqQC::TSSEscore: the aggregate signal in 100 bp
+# windows over +/- 1 kb, divided by the mean of the two outermost windows,
+# and the TSSE score is the maximum of that profile.
+########################################
+
+import os
+import logging
+from array import array
+from typing import Dict, List, Tuple
+
+import numpy as np
+
+from steps import shards
+from steps.helpers import outputs_exist
+
+# Tn5 cut site offsets from the read's 5' end
+TN5_SHIFT_PLUS = 4
+TN5_SHIFT_MINUS = -5
+
+TSS_FLANK = 1000          # bp either side of the TSS
+SCORE_WINDOW = 100        # ATACseqQC TSSEscore window / end-flank size
+MATRIX_BIN = 10           # per-TSS matrix resolution (bp)
+
+def output_paths(out_dir: str, sample: str) -> Dict[str, str]:
+    return {
+        "score": os.path.join(out_dir, f"{sample}_TSSEscore.txt"),
+        "plot": os.path.join(out_dir, f"{sample}_TSSE_enrichment_plot.png"),
+        "profile": os.path.join(out_dir, f"{sample}_TSSE_profile.tsv"),
+        "matrix": os.path.join(out_dir, f"{sample}_TSSE_matrix.npz"),
+    }
+
+def cut_site(read) -> int:
+    """Tn5 insertion position of a mapped read."""
+    if read.is_reverse:
+        return read.reference_end - 1 + TN5_SHIFT_MINUS
+    return read.reference_start + TN5_SHIFT_PLUS
+
+def _add_cuts(cuts: np.ndarray, positions: np.ndarray, strands: np.ndarray,
+              profile: np.ndarray, matrix: np.ndarray) -> None:
+    """Add one chunk of cut sites to profile (2 * TSS_FLANK) and matrix (TSSs x bins)."""
+    lo = np.searchsorted(positions, cuts - TSS_FLANK, side="left")
+    hi = np.searchsorted(positions, cuts + TSS_FLANK, side="right")
+    n = hi - lo
+    total = int(n.sum())
+    if not total:
+        return
+
+    # one entry per (cut, TSS within range) pair
+    idx = np.repeat(lo, n) + (np.arange(total) - np.repeat(np.cumsum(n) - n, n))
+    offset = (np.repeat(cuts, n) - positions[idx]) * strands[idx]
+    rel = offset + TSS_FLANK
+    keep = rel < 2 * TSS_FLANK
+    idx, rel = idx[keep], rel[keep]
+    if not len(idx):
+        return
+
+    profile += np.bincount(rel, minlength=2 * TSS_FLANK)
+    n_cols = matrix.shape[1]
+    first = int(idx.min())
+    flat = (idx - first) * n_cols + rel // MATRIX_BIN
+    span = (int(idx.max()) - first + 1) * n_cols
+    matrix[first:first + span // n_cols] += np.bincount(flat, minlength=span).reshape(-1, n_cols).astype(matrix.dtype)
+
+def _shard_worker(shard, *, bam_path: str, sites, chunk_size: int) -> Tuple[np.ndarray, np.ndarray, int]:
+    """(profile, matrix over the contig's TSSs, cut sites) for one shard."""
+    import pysam
+
+    positions, strands = (np.asarray(a) for a in sites[shard.contig])
+    profile = np.zeros(2 * TSS_FLANK, dtype=np.int64)
+    matrix = np.zeros((len(positions), 2 * TSS_FLANK // MATRIX_BIN), dtype=np.uint32)
+    n_cuts = 0
+
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        cuts = array("q")
+        for read in shards.fetch(bam, shard):
+            if read.is_unmapped:
+                continue
+            cuts.append(cut_site(read))
+            if len(cuts) >= chunk_size:
+                _add_cuts(np.frombuffer(cuts, dtype=np.int64), positions, strands, profile, matrix)
+                n_cuts += len(cuts)
+                cuts = array("q")
+        if cuts:
+            _add_cuts(np.frombuffer(cuts, dtype=np.int64), positions, strands, profile, matrix)
+            n_cuts += len(cuts)
+
+    return profile, matrix, n_cuts
+
+def tss_enrichment(
+    bam_path: str,
+    sites: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    *,
+    threads: int = 1,
+    chunk_size: int = 200000,
+) -> dict:
+    """
+    Aggregate cut-site profile around the TSSs of `sites` ({chrom: (positions,
+    strands)}, see refcache.tss_sites).
+
+    Returns {"score", "profile" (per-base, 2 * TSS_FLANK), "windows" (per
+    SCORE_WINDOW, normalised), "matrix" (TSSs x bins, uint32), "chroms",
+    "positions", "strands", "cuts"}; matrix rows follow the order of
+    chroms / positions.
+    """
+    import pysam
+
+    with pysam.AlignmentFile(bam_path, "rb") as bam:
+        contigs = [c for c in bam.references if c in sites and len(sites[c][0])]
+    plan = shards.plan(bam_path, contigs=contigs)
+    shards.log_plan("tsse", plan, threads)
+    sites = {c: sites[c] for c in contigs}
+    results = shards.run(_shard_worker, plan, threads=threads, bam_path=bam_path, sites=sites, chunk_size=chunk_size)
+
+    # sum the shards of each contig
+    profile = np.zeros(2 * TSS_FLANK, dtype=np.int64)
+    matrices = {c: _empty_matrix(len(sites[c][0])) for c in contigs}
+    for shard, (p, m, _) in zip(plan, results):
+        profile += p
+        matrices[shard.contig] += m
+    return _result(contigs, sites, profile, matrices, sum(r[2] for r in results))
+
+def tss_enrichment_fragments(
+    path: str,
+    sites: Dict[str, Tuple[np.ndarray, np.ndarray]],
+    *,
+    contigs: List[str],
+    chunk_size: int = 200000,
+) -> dict:
+    """
+    tss_enrichment from a fragments file (steps/fragments.py): each fragment
+    gives its two cut sites, start and end - 1. Same as the BAM's except
+    where only one mate of a pair passed the filters. contigs (the BAM
+    header's) sets the matrix rows, as in tss_enrichment.
+    """
+    from steps.fragments import iter_fragments
+
+    contigs = [c for c in contigs if c in sites and len(sites[c][0])]
+    profile = np.zeros(2 * TSS_FLANK, dtype=np.int64)
+    matrices = {c: _empty_matrix(len(sites[c][0])) for c in contigs}
+    n_cuts = 0
+    for chrom, starts, ends, _ in iter_fragments(path, chunk_size=chunk_size):
+        if chrom not in matrices:
+            continue
+        positions, strands = (np.asarray(a) for a in sites[chrom])
+        cuts = np.concatenate([starts, ends - 1])
+        _add_cuts(cuts, positions, strands, profile, matrices[chrom])
+        n_cuts += len(cuts)
+    return _result(contigs, sites, profile, matrices, n_cuts)
+
+def _empty_matrix(n_sites: int) -> np.ndarray:
+    return np.zeros((n_sites, 2 * TSS_FLANK // MATRIX_BIN), dtype=np.uint32)
+
+def _result(contigs, sites, profile: np.ndarray, matrices: Dict[str, np.ndarray], n_cuts: int) -> dict:
+    """The tss_enrichment result from the summed profile and per-contig matrices."""
+    matrix = np.vstack([matrices[c] for c in contigs]) if contigs else _empty_matrix(0)
+
+    windows = profile.reshape(-1, SCORE_WINDOW).sum(axis=1).astype(np.float64)
+    background = (windows[0] + windows[-1]) / 2
+    normalised = windows / background if background > 0 else np.full(len(windows), np.nan)
+    score = float(np.nanmax(normalised)) if background > 0 else float("nan")
+
+    return {
+        "score": score,
+        "profile": profile,
+        "windows": normalised,
+        "matrix": matrix,
+        "chroms": np.array(contigs),
+        "chrom_index": np.concatenate([np.full(len(sites[c][0]), i, dtype=np.int32) for i, c in enumerate(contigs)])
+        if contigs else np.zeros(0, dtype=np.int32),
+        "positions": np.concatenate([sites[c][0] for c in contigs]) if contigs else np.zeros(0, dtype=np.int64),
+        "strands": np.concatenate([sites[c][1] for c in contigs]) if contigs else np.zeros(0, dtype=np.int8),
+        "cuts": n_cuts,
+    }
+
+def _plot(windows: np.ndarray, sample: str, out_png: str) -> None:
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    # window centres, as in the R plot: 100 * (-9:10 - .5)
+    x = SCORE_WINDOW * (np.arange(len(windows)) - len(windows) // 2 + 0.5)
+    fig, ax = plt.subplots()
+    ax.plot(x, windows, marker="o")
+    ax.set_xlabel("distance to TSS")
+    ax.set_ylabel("aggregate TSS score")
+    ax.set_title(f"{sample} TSSE")
+    fig.savefig(out_png)
+    plt.close(fig)
+
+def run_tsse(Configuration):
+    """
+    TSS enrichment of the filtered BAM:
+      {cleaned_alignments_dir}/{sample}/{sample}_align_dedup_filtered.bam
+
+    Outputs go to the ATACseqQC directory ({other_qc_dir}/{sample}/ATACseqQC/):
+      - {sample}_TSSEscore.txt            TSSE score
+      - {sample}_TSSE_enrichment_plot.png aggregate profile (100 bp windows)
+      - {sample}_TSSE_profile.tsv         per-base aggregate cut-site counts
+      - {sample}_TSSE_matrix.npz          per-TSS cut-site counts (MATRIX_BIN bp bins)
+
+    With options.fragments_input the cut sites come from the fragments file.
+    """
+    from steps import refcache
+    from steps.ATACseqQC import get_output_dir
+
+    sample = Configuration.file_to_process
+    bam_file = os.path.join(
+        Configuration.cleaned_alignments_dir,
+        sample,
+        f"{sample}_align_dedup_filtered.bam"
+    )
+    if not os.path.exists(bam_file):
+        raise FileNotFoundError(f"TSS enrichment input BAM not found: {bam_file}")
+
+    out_dir = get_output_dir(Configuration, sample)
+    os.makedirs(out_dir, exist_ok=True)
+    out = output_paths(out_dir, sample)
+    if (not Configuration.force) and outputs_exist(list(out.values())):
+        logging.info("tsse: outputs exist; skipping (use --force to overwrite)")
+        return
+
+    if Configuration.fragments_input:
+        import pysam
+        from steps.fragments import fragments_path
+
+        with pysam.AlignmentFile(bam_file, "rb") as bam:
+            contigs = list(bam.references)
+        result = tss_enrichment_fragments(fragments_path(Configuration, sample), refcache.tss_sites(Configuration),
+                                          contigs=contigs)
+    else:
+        result = tss_enrichment(bam_file, refcache.tss_sites(Configuration), threads=Configuration.threads)
+
+    with open(out["score"], "w") as f:
+        f.write(f"{result['score']}\n")
+    with open(out["profile"], "w") as f:
+        f.write("offset\tcuts\n")
+        for offset, n in zip(range(-TSS_FLANK, TSS_FLANK), result["profile"]):
+            f.write(f"{offset}\t{n}\n")
+    np.savez_compressed(
+        out["matrix"],
+        counts=result["matrix"],
+        chroms=result["chroms"],
+        chrom_index=result["chrom_index"],
+        positions=result["positions"],
+        strands=result["strands"],
+        bin_size=MATRIX_BIN,
+        flank=TSS_FLANK,
+    )
+    _plot(result["windows"], sample, out["plot"])
+
+    logging.info(
+        f"tsse: {sample} score={result['score']:.3f} "
+        f"({result['cuts']} cut sites, {len(result['positions'])} TSSs)"
+    )